@@ -0,0 +1,50 @@
+import os
+import concurrent.futures
+import typing
+
+# Work such as decoding image files run off of the UI thread. Finished tasks are only
+# handed back through poll, which the main loop calls once a frame, so anything that
+# touches layers or the UI still happens on the UI thread.
+
+class BackgroundTasks:
+    def __init__(self, max_workers: int = None):
+        '''
+        param: max_workers, threads running tasks at once, defaults to the number of CPUs.
+        pygame releases the GIL while decoding and encoding images, so these run in parallel.
+        '''
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers if max_workers != None else os.cpu_count())
+        self.pending: list[tuple[typing.Any, concurrent.futures.Future]] = []
+    def submit(self, key: typing.Any, function: typing.Callable, *args) -> None:
+        '''
+        param: key, handed back by poll with the result, to tell which task finished.
+        '''
+        self.pending.append((key, self.executor.submit(function, *args)))
+    def get_pending_count(self) -> int:
+        return len(self.pending)
+    def wait(self) -> None:
+        '''
+        Waits for every pending task to finish, the results are then handed back by the next poll.
+        '''
+        concurrent.futures.wait([future for key, future in self.pending])
+    def poll(self) -> list[tuple[typing.Any, typing.Any, BaseException or None]]:
+        '''
+        Never waits. Returns (key, result, exception) for each task finished since the last call, in the order they were submitted.
+        result is None when the task raised exception.
+        '''
+        finished_tasks = []
+        still_pending = []
+        for key, future in self.pending:
+            if not future.done():
+                still_pending.append((key, future))
+                continue
+            exception = future.exception()
+            finished_tasks.append((key, future.result() if exception == None else None, exception))
+        self.pending = still_pending
+        return finished_tasks
+    def shutdown(self, cancel_pending: bool = True) -> None:
+        '''
+        param: cancel_pending, when set the tasks not started yet are dropped and the running ones are not waited for,
+        otherwise waits for every task to finish, such as saves that must not be lost.
+        '''
+        self.executor.shutdown(wait=not cancel_pending, cancel_futures=cancel_pending)
+        self.pending.clear()
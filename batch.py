@@ -0,0 +1,236 @@
+#!/bin/env python3
+
+import os
+import sys
+import itertools
+import concurrent.futures
+
+# No window is ever opened, the dummy driver lets pygame run where there is no display (such as CI).
+# Set before pygame is imported, so the pool workers get it too.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+import paint_tools
+import layer_io
+import indexed_layer
+
+# Headless batch mode. Runs the same script of editor operations over every file given,
+# spread over a pool of processes, then prints a line per file and exits with an error
+# code when any file failed.
+#
+# Operation script, one operation per line, '#' starts a comment:
+#   color <R> <G> <B> [A]       colour used by the operations after it (default 255 255 255 255)
+#   connectivity <4|8>          fill connectivity (default 4)
+#   tolerance <N>               max per channel difference from the start pixel to still fill (default 0)
+#   fill <X> <Y>                bucket fill from the pixel X, Y
+#   resize <W>x<H>              scale the image to W by H pixels
+#   duplicate <PATH>            write the image, as it is at this point of the script, to PATH
+#   rename <PATH>               write the image to PATH at the end, instead of over the file
+# PATH can use {dir}, {name} and {ext} of the file being processed, such as 'out/{name}_small{ext}'.
+# The file, or its renamed path, is only written at the end when the script changed its pixels or renamed it.
+# Indexed (palette) images stay indexed, unless a fill colour is not in their palette, then they are converted to RGBA first.
+
+MAX_LAYER_PIXELS = 8192*8192 # same limit the editor puts on resizing plain layers
+FILES_PER_WORKER_TASK = 16 # files sent to a worker at a time, less overhead than one at a time for thousands of small files
+
+OPERATION_ARG_COUNTS = {
+    "color": (3, 4),
+    "connectivity": (1, 1),
+    "tolerance": (1, 1),
+    "fill": (2, 2),
+    "resize": (1, 1),
+    "duplicate": (1, 1),
+    "rename": (1, 1),
+}
+
+def parse_operation(name: str, args: list[str]) -> (tuple or None, str):
+    '''
+    Returns ((name, parsed args), "") or (None, error string).
+    '''
+    if (name not in OPERATION_ARG_COUNTS):
+        return None, f"unknown operation '{name}'"
+    min_arg_count, max_arg_count = OPERATION_ARG_COUNTS[name]
+    if not (min_arg_count <= len(args) <= max_arg_count):
+        return None, f"'{name}' expects {min_arg_count}{'' if min_arg_count == max_arg_count else f' to {max_arg_count}'} argument(s), got {len(args)}"
+    if (name == "color"):
+        if not all(arg.isdigit() and int(arg) < 256 for arg in args):
+            return None, "color channels should be numbers from 0 to 255"
+        return (name, pygame.Color(*[int(arg) for arg in args])), ""
+    if (name == "connectivity"):
+        if (args[0] not in (str(paint_tools.FILL_CONNECTIVITY_4), str(paint_tools.FILL_CONNECTIVITY_8))):
+            return None, f"connectivity should be {paint_tools.FILL_CONNECTIVITY_4} or {paint_tools.FILL_CONNECTIVITY_8}"
+        return (name, int(args[0])), ""
+    if (name == "tolerance"):
+        if not (args[0].isdigit() and int(args[0]) < 256):
+            return None, "tolerance should be a number from 0 to 255"
+        return (name, int(args[0])), ""
+    if (name == "fill"):
+        if not all(arg.isdigit() for arg in args):
+            return None, "fill position should be two whole numbers"
+        return (name, (int(args[0]), int(args[1]))), ""
+    if (name == "resize"):
+        size_args = args[0].lower().split("x")
+        if (len(size_args) != 2 or not size_args[0].isdigit() or not size_args[1].isdigit() or int(size_args[0]) < 1 or int(size_args[1]) < 1):
+            return None, "size should be <WIDTH>x<HEIGHT>"
+        if (int(size_args[0])*int(size_args[1]) > MAX_LAYER_PIXELS):
+            return None, f"{args[0]} is over {MAX_LAYER_PIXELS} pixels"
+        return (name, (int(size_args[0]), int(size_args[1]))), ""
+    # duplicate and rename, the path template is checked by formatting it with a made up file
+    try:
+        format_path_template(args[0], "file.png")
+    except (KeyError, IndexError, ValueError):
+        return None, f"bad path '{args[0]}', it can only use {{dir}}, {{name}} and {{ext}}"
+    return (name, args[0]), ""
+
+def parse_operation_script(text: str) -> (list[tuple] or None, str):
+    '''
+    Returns (operations, "") or (None, error string naming the line).
+    '''
+    operations = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line_args = line.split("#", 1)[0].split()
+        if (len(line_args) == 0):
+            continue
+        operation, error_string = parse_operation(line_args[0], line_args[1:])
+        if (operation == None):
+            return None, f"line {line_number}: {error_string}"
+        operations.append(operation)
+    return operations, ""
+
+def format_path_template(path_template: str, file_path: str) -> str:
+    file_base, file_extension = os.path.splitext(os.path.basename(file_path))
+    return path_template.format(dir=os.path.dirname(file_path) or ".", name=file_base, ext=file_extension)
+
+def process_file(file_path: str, operations: list[tuple]) -> (str, list[str]):
+    '''
+    Runs the operations on one file, in a pool worker.
+    Returns ("", [paths written]) or (error string, [paths written before the error]).
+    '''
+    written_paths = []
+    try:
+        surface = layer_io.read_layer_file(file_path)
+    except FileNotFoundError:
+        return "could not find the file", written_paths
+    except Exception:
+        return f"could not load the file, {sys.exc_info()[1]}", written_paths
+    color = pygame.Color(255, 255, 255, 255)
+    connectivity = paint_tools.FILL_CONNECTIVITY_4
+    tolerance = 0
+    output_path = file_path
+    modified = False
+    try:
+        for name, value in operations:
+            if (name == "color"):
+                color = value
+            elif (name == "connectivity"):
+                connectivity = value
+            elif (name == "tolerance"):
+                tolerance = value
+            elif (name == "fill"):
+                if not surface.get_rect().collidepoint(value):
+                    return f"fill position {value} is outside the {surface.get_width()}x{surface.get_height()} image", written_paths
+                if (indexed_layer.is_indexed(surface) and indexed_layer.get_nearest_color(surface, color) != color):
+                    # Painting an indexed image gives the nearest palette colour, not the one asked for
+                    surface = indexed_layer.to_rgba(surface)
+                    modified = True
+                if (paint_tools.paint_tool_bucket(surface, pygame.math.Vector2(value), color, None, connectivity, tolerance) != None):
+                    modified = True
+            elif (name == "resize"):
+                if (surface.get_size() != value):
+                    surface = pygame.transform.scale(surface, value)
+                    modified = True
+            elif (name == "duplicate"):
+                duplicate_path = format_path_template(value, file_path)
+                layer_io.write_layer_file(surface, duplicate_path)
+                written_paths.append(duplicate_path)
+            elif (name == "rename"):
+                output_path = format_path_template(value, file_path)
+        if (modified or output_path != file_path):
+            layer_io.write_layer_file(surface, output_path)
+            written_paths.append(output_path)
+    except (OSError, pygame.error):
+        return f"{sys.exc_info()[1]}", written_paths
+    return "", written_paths
+
+def run_batch(operations: list[tuple], file_paths: list[str], job_count: int) -> int:
+    '''
+    Prints a line for each file, in the order given, as they finish. Returns the number of files that failed.
+    '''
+    failed_count = 0
+    if (job_count == 1):
+        results = map(process_file, file_paths, itertools.repeat(operations))
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=job_count)
+        results = executor.map(process_file, file_paths, itertools.repeat(operations), chunksize=FILES_PER_WORKER_TASK)
+    try:
+        for file_path, (error_string, written_paths) in zip(file_paths, results):
+            if (error_string != ""):
+                failed_count += 1
+                print(f"FAIL {file_path}: {error_string}")
+            else:
+                print(f"ok   {file_path}" + (f" -> {', '.join(written_paths)}" if len(written_paths) > 0 else " (unchanged)"))
+    finally:
+        if (executor != None):
+            executor.shutdown(cancel_futures=True)
+    print(f"{len(file_paths)} file(s), {failed_count} failed")
+    return failed_count
+
+def main(argv: list[str]) -> int:
+    '''
+    Exit code 0 when every file was processed, 1 when any file failed and 2 for a bad command line or script.
+    '''
+    job_count = os.cpu_count()
+    script_path = None
+    file_paths = []
+    cli_only_files_remain = False
+    arg_skip_count = 0
+    for arg_index in range(1, len(argv)):
+        if (arg_skip_count > 0):
+            arg_skip_count -= 1
+            continue
+        arg = argv[arg_index]
+        if (arg == "--" and not cli_only_files_remain):
+            cli_only_files_remain = True
+        elif ((arg == "--help" or arg == "-h") and not cli_only_files_remain):
+            print( "Description: Runs a script of image editing operations over many files, without a window")
+            print(f"Usage: python3 {argv[0]} [Options] [--] <SCRIPT> <FILE>...")
+            print(f"Options:")
+            print(f"  --jobs <N>  - number of processes to spread the files over (default {os.cpu_count()})")
+            print(f"Script operations, one per line:")
+            print(f"  color <R> <G> <B> [A], connectivity <4|8>, tolerance <N>, fill <X> <Y>,")
+            print(f"  resize <W>x<H>, duplicate <PATH>, rename <PATH>")
+            print(f"  PATH can use {{dir}}, {{name}} and {{ext}} of the file, such as 'out/{{name}}_small{{ext}}'")
+            return 0
+        elif (arg == "--jobs" and not cli_only_files_remain):
+            if (arg_index+1 >= len(argv) or not argv[arg_index+1].isdigit() or int(argv[arg_index+1]) < 1):
+                print(f"[{arg_index}] argument {arg} expects a number above 0 after it")
+                return 2
+            job_count = int(argv[arg_index+1])
+            arg_skip_count = 1
+        elif (arg[:2] == "--" and not cli_only_files_remain):
+            print(f"[{arg_index}] argument {arg} is not recognised")
+            return 2
+        elif (script_path == None):
+            script_path = arg
+        else:
+            file_paths.append(arg)
+    if (script_path == None or len(file_paths) == 0):
+        print(f"Usage: python3 {argv[0]} [Options] [--] <SCRIPT> <FILE>...")
+        return 2
+    try:
+        with open(script_path) as fileh:
+            operations, error_string = parse_operation_script(fileh.read())
+    except OSError:
+        print(f"Could not read the script '{script_path}', {sys.exc_info()[1]}")
+        return 2
+    if (operations == None):
+        print(f"Error in the script '{script_path}', {error_string}")
+        return 2
+    if (run_batch(operations, file_paths, min(job_count, len(file_paths))) > 0):
+        return 1
+    return 0
+
+if (__name__ == "__main__"):
+    sys.exit(main(sys.argv))
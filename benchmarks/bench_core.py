@@ -0,0 +1,310 @@
+import sys, os
+import json
+import time
+import random
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import logger
+import paint_tools
+import render
+import layer_io
+import raw_layer
+import input_parsing
+import compositor
+import layer_export
+from layer_stack import LayerStack
+from tiled_canvas import TiledCanvas
+
+# Editor core benchmarks over a matrix of layer sizes, run with:
+#   python benchmarks/bench_core.py [--sizes 256,1024,4096] [--repeat N] [--output FILE] [--compare BASELINE]
+# Results are written as JSON (to FILE, or stdout) so runs of different releases can be compared.
+# With --compare, each result is compared to the same benchmark in BASELINE, and the exit code is 1
+# when any is more than REGRESSION_RATIO slower.
+
+DEFAULT_SIZES = [256, 1024, 4096]
+DEFAULT_REPEAT = 3
+REGRESSION_RATIO = 1.25
+SCREEN_SIZE = (1280, 720)
+RENDER_ZOOMS = [1/16, 1/4, 1, 4, 30]
+STROKE_POINT_COUNT = 100
+COLOR_INPUT_PARSE_COUNT = 10000
+COMPOSITE_LAYER_COUNT = 10
+COMPOSITE_MAX_SIZE = 2048 # larger stacks of COMPOSITE_LAYER_COUNT plain layers take GiBs of memory
+EXPORT_LAYER_COUNT = 20
+INDEXED_COLOR_COUNT = 64
+
+def make_test_surface(size: int, color_count: int = None) -> Surface:
+    '''
+    Background with scattered rectangles, the same for every run, so fills have edges to follow.
+    param: color_count, rectangle colours are picked from this many, None for any colour.
+    '''
+    surface = Surface((size, size), pygame.SRCALPHA)
+    surface.fill((200, 200, 200, 255))
+    rng = random.Random(size)
+    colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256), 255) for _ in range(color_count)] if color_count != None else None
+    for _ in range(size//4):
+        rect_size = rng.randint(1, max(1, size//32))
+        rect_color = rng.choice(colors) if colors != None else (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)
+        surface.fill(rect_color, (rng.randrange(size), rng.randrange(size), rect_size, rect_size))
+    return surface
+
+def make_layer_stack(surface: Surface or TiledCanvas) -> LayerStack:
+    log = logger.LOG()
+    log.set_warnlevel(logger.LOG_level("WARNING"))
+    layers = LayerStack(log, 1024*1024*1024, 64*1024*1024, 8192*8192)
+    layers.add_layer("bench.png", surface)
+    return layers
+
+def time_best(function, repeat: int, setup = None) -> float:
+    '''
+    Least seconds of repeat calls of function, setup (not timed) is called before each.
+    '''
+    best_seconds = None
+    for _ in range(repeat):
+        setup_result = setup() if setup != None else None
+        start_time = time.perf_counter()
+        function(setup_result)
+        seconds = time.perf_counter() - start_time
+        best_seconds = seconds if best_seconds == None else min(best_seconds, seconds)
+    return best_seconds
+
+def bench_flood_fill(size: int, repeat: int) -> list[dict]:
+    results = []
+    source_surface = make_test_surface(size)
+    def setup_plain() -> LayerStack:
+        return make_layer_stack(source_surface.copy())
+    seconds = time_best(lambda layers: layers.bucket_fill(0, pygame.math.Vector2(0, 0), pygame.Color(255, 0, 0, 255)), repeat, setup_plain)
+    results.append({"name": "flood fill", "size": size, "params": "plain", "seconds": seconds})
+    def setup_tiled() -> LayerStack:
+        return make_layer_stack(TiledCanvas.from_surface(source_surface))
+    seconds = time_best(lambda layers: layers.bucket_fill_canvas(0, pygame.math.Vector2(0, 0), pygame.Color(255, 0, 0, 255)), repeat, setup_tiled)
+    results.append({"name": "flood fill", "size": size, "params": "tiled", "seconds": seconds})
+    return results
+
+def get_stroke_points(size: int) -> list[tuple[int, int]]:
+    # Zig zag across the whole layer
+    return [(point_index*(size-1)//(STROKE_POINT_COUNT-1), (size-1)*(point_index % 2)) for point_index in range(STROKE_POINT_COUNT)]
+
+def paint_test_stroke(layers: LayerStack, points: list[tuple[int, int]], brush: paint_tools.Brush) -> None:
+    for point in points:
+        layers.paint_stroke(0, [point], pygame.Color(0, 0, 255, 255), brush)
+    layers.end_stroke(0)
+
+def bench_stroke_and_undo(size: int, repeat: int) -> list[dict]:
+    results = []
+    source_surface = make_test_surface(size)
+    points = get_stroke_points(size)
+    for brush_name, brush in (("pixel", None), ("circle 8", paint_tools.make_circle_brush(8))):
+        seconds = time_best(lambda layers: paint_test_stroke(layers, points, brush), repeat, lambda: make_layer_stack(source_surface.copy()))
+        results.append({"name": "stroke", "size": size, "params": f"{STROKE_POINT_COUNT} points, {brush_name}", "seconds": seconds})
+    def setup_painted() -> LayerStack:
+        layers = make_layer_stack(source_surface.copy())
+        paint_test_stroke(layers, points, paint_tools.make_circle_brush(8))
+        return layers
+    seconds = time_best(lambda layers: (layers.undo(0), layers.redo(0)), repeat, setup_painted)
+    results.append({"name": "undo and redo stroke", "size": size, "params": "circle 8", "seconds": seconds})
+    return results
+
+def bench_render(size: int, repeat: int) -> list[dict]:
+    '''
+    Frames drawn from a cold cache, as after the camera moved or the zoom changed.
+    '''
+    results = []
+    layer_surface = make_test_surface(size)
+    mipmap = render.MipmapPyramid(layer_surface)
+    render_image = render.RenderImage(layer_surface)
+    render_image.set_mipmap(mipmap)
+    screen = Surface(SCREEN_SIZE)
+    for zoom in RENDER_ZOOMS:
+        render_image.set_scale((zoom, zoom))
+        render_image.render(screen, (0, 0), SCREEN_SIZE) # builds the mipmap levels used, they are kept between frames
+        def render_frame(_) -> None:
+            render_image.invalidate()
+            render_image.render(screen, (0, 0), SCREEN_SIZE)
+        results.append({"name": "render frame", "size": size, "params": f"zoom {zoom:g}", "seconds": time_best(render_frame, repeat)})
+    return results
+
+def make_composite_stack(size: int) -> LayerStack:
+    layers = make_layer_stack(make_test_surface(size))
+    for layer_index in range(1, COMPOSITE_LAYER_COUNT):
+        layer_surface = make_test_surface(size)
+        layer_surface.fill((255, 255, 255, 160), special_flags=pygame.BLEND_RGBA_MULT)
+        layers.add_layer(f"bench{layer_index}.png", layer_surface)
+        layers.blend_modes[layer_index] = compositor.BLEND_MODES[layer_index % len(compositor.BLEND_MODES)]
+    return layers
+
+def bench_composite(size: int, repeat: int) -> list[dict]:
+    '''
+    Blending the whole stack, then the frames after a stroke or a layer switch, which should only blend the tiles touched.
+    '''
+    if (size > COMPOSITE_MAX_SIZE):
+        return []
+    results = []
+    layers = make_composite_stack(size)
+    def setup_compositor() -> compositor.LayerCompositor:
+        layer_compositor = compositor.LayerCompositor(layers)
+        layers.modified_callback = layer_compositor.mark_dirty
+        return layer_compositor
+    seconds = time_best(lambda layer_compositor: layer_compositor.update(), repeat, setup_compositor)
+    results.append({"name": "composite", "size": size, "params": f"{COMPOSITE_LAYER_COUNT} layers, whole stack", "seconds": seconds})
+    layer_compositor = setup_compositor()
+    layer_compositor.update()
+    points = get_stroke_points(size)
+    def composite_stroke(_) -> None:
+        for point in points:
+            layers.paint_stroke(COMPOSITE_LAYER_COUNT//2, [point], pygame.Color(0, 0, 255, 255))
+            layer_compositor.update()
+        layers.end_stroke(COMPOSITE_LAYER_COUNT//2)
+    results.append({"name": "composite", "size": size, "params": f"{COMPOSITE_LAYER_COUNT} layers, {STROKE_POINT_COUNT} stroke frames", "seconds": time_best(composite_stroke, repeat)})
+    # The current layer is not part of the composite, switching it has nothing to blend
+    results.append({"name": "composite", "size": size, "params": f"{COMPOSITE_LAYER_COUNT} layers, unchanged frame", "seconds": time_best(lambda _: layer_compositor.update(), repeat)})
+    return results
+
+def bench_export(size: int, repeat: int) -> list[dict]:
+    '''
+    Flattening a stack of raw layer files into a PNG, on one worker and on a worker per CPU.
+    Only one layer is in memory at a time, so this runs at every size.
+    '''
+    results = []
+    layer_surface = make_test_surface(size)
+    layer_surface.fill((255, 255, 255, 160), special_flags=pygame.BLEND_RGBA_MULT) # so every layer shows through the ones above
+    with tempfile.TemporaryDirectory() as directory_path:
+        export_layers = []
+        for layer_index in range(EXPORT_LAYER_COUNT):
+            layer_path = os.path.join(directory_path, f"layer{layer_index}{raw_layer.RAW_LAYER_EXTENSION}")
+            raw_layer.write_raw_layer(layer_surface, layer_path)
+            export_layers.append((layer_path, True, 255, compositor.BLEND_MODES[layer_index % len(compositor.BLEND_MODES)]))
+        output_path = os.path.join(directory_path, "export.png")
+        for job_count in sorted({1, os.cpu_count()}):
+            seconds = time_best(lambda _: layer_export.export_layer_files(export_layers, output_path, job_count), repeat)
+            results.append({"name": "export", "size": size, "params": f"{EXPORT_LAYER_COUNT} layers, {job_count} jobs", "seconds": seconds})
+    return results
+
+def bench_load_save(size: int, repeat: int) -> list[dict]:
+    results = []
+    layer_surface = make_test_surface(size)
+    with tempfile.TemporaryDirectory() as directory_path:
+        for file_name in ("bench.png", "bench.bmp", "bench" + raw_layer.RAW_LAYER_EXTENSION):
+            file_path = os.path.join(directory_path, file_name)
+            file_format = os.path.splitext(file_name)[1][1:]
+            results.append({"name": "save", "size": size, "params": file_format, "seconds": time_best(lambda _: layer_io.write_layer_file(layer_surface, file_path), repeat)})
+            if (raw_layer.is_raw_layer_path(file_path)):
+                load_function = lambda _: raw_layer.RawLayerFile(file_path)
+            else:
+                load_function = lambda _: layer_io.load_image_file(file_path)
+            results.append({"name": "load", "size": size, "params": file_format, "seconds": time_best(load_function, repeat)})
+    return results
+
+def bench_indexed(size: int, repeat: int) -> list[dict]:
+    results = []
+    source_surface = make_test_surface(size, INDEXED_COLOR_COUNT)
+    indexed_params = f"indexed, {INDEXED_COLOR_COUNT} colors"
+    results.append({"name": "convert to indexed", "size": size, "params": f"{INDEXED_COLOR_COUNT} colors", "seconds": time_best(lambda layers: layers.set_indexed(0, True), repeat, lambda: make_layer_stack(source_surface.copy()))})
+    def setup_indexed() -> LayerStack:
+        layers = make_layer_stack(source_surface.copy())
+        layers.set_indexed(0, True)
+        return layers
+    seconds = time_best(lambda layers: layers.bucket_fill(0, pygame.math.Vector2(0, 0), pygame.Color(255, 0, 0, 255)), repeat, setup_indexed)
+    results.append({"name": "flood fill", "size": size, "params": indexed_params, "seconds": seconds})
+    points = get_stroke_points(size)
+    seconds = time_best(lambda layers: paint_test_stroke(layers, points, paint_tools.make_circle_brush(8)), repeat, setup_indexed)
+    results.append({"name": "stroke", "size": size, "params": f"{STROKE_POINT_COUNT} points, circle 8, indexed", "seconds": seconds})
+    seconds = time_best(lambda layers: layers.set_palette_color(0, 0, pygame.Color(0, 255, 0, 255)), repeat, setup_indexed)
+    results.append({"name": "palette edit", "size": size, "params": indexed_params, "seconds": seconds})
+    indexed_surface = setup_indexed().surfaces[0]
+    with tempfile.TemporaryDirectory() as directory_path:
+        file_path = os.path.join(directory_path, "bench.png")
+        results.append({"name": "save", "size": size, "params": f"png, {indexed_params}", "seconds": time_best(lambda _: layer_io.write_layer_file(indexed_surface, file_path), repeat)})
+        results.append({"name": "load", "size": size, "params": f"png, {indexed_params}", "seconds": time_best(lambda _: layer_io.load_image_file(file_path), repeat)})
+    return results
+
+def bench_color_input(repeat: int) -> list[dict]:
+    def parse_colors(_) -> None:
+        color = pygame.Color(0, 0, 0, 0)
+        for _ in range(COLOR_INPUT_PARSE_COUNT):
+            input_parsing.parse_color_input("255r128g64b32a", color)
+    return [{"name": "parse color input", "size": 0, "params": f"{COLOR_INPUT_PARSE_COUNT} times", "seconds": time_best(parse_colors, repeat)}]
+
+def get_result_key(result: dict) -> tuple:
+    return (result["name"], result["size"], result["params"])
+
+def compare_results(results: list[dict], baseline_results: list[dict]) -> int:
+    '''
+    Prints the change of each result from the baseline. Returns the number of regressions.
+    '''
+    baseline_seconds = {get_result_key(result): result["seconds"] for result in baseline_results}
+    regression_count = 0
+    for result in results:
+        old_seconds = baseline_seconds.get(get_result_key(result))
+        if (old_seconds == None or old_seconds == 0):
+            continue
+        ratio = result["seconds"]/old_seconds
+        regressed = ratio > REGRESSION_RATIO
+        regression_count += regressed
+        print(f"{result['name']:<22} {result['size']:>6} {result['params']:<22} {old_seconds*1000:10.3f}ms -> {result['seconds']*1000:10.3f}ms x{ratio:5.2f}{'  SLOWER' if regressed else ''}", file=sys.stderr)
+    return regression_count
+
+def main(argv: list[str]) -> int:
+    sizes = DEFAULT_SIZES
+    repeat = DEFAULT_REPEAT
+    output_path = None
+    baseline_path = None
+    arg_skip_count = 0
+    for arg_index in range(1, len(argv)):
+        if (arg_skip_count > 0):
+            arg_skip_count -= 1
+            continue
+        arg = argv[arg_index]
+        value = argv[arg_index+1] if arg_index+1 < len(argv) else ""
+        if (arg == "--sizes" and all(size.isdigit() and int(size) > 0 for size in value.split(","))):
+            sizes = [int(size) for size in value.split(",")]
+        elif (arg == "--repeat" and value.isdigit() and int(value) > 0):
+            repeat = int(value)
+        elif (arg == "--output" and value != ""):
+            output_path = value
+        elif (arg == "--compare" and value != ""):
+            baseline_path = value
+        else:
+            print(f"Usage: python {argv[0]} [--sizes 256,1024,4096] [--repeat N] [--output FILE] [--compare BASELINE]", file=sys.stderr)
+            return 2
+        arg_skip_count = 1
+
+    results = bench_color_input(repeat)
+    for size in sizes:
+        print(f"Benchmarking {size}x{size} layers", file=sys.stderr)
+        results += bench_flood_fill(size, repeat)
+        results += bench_stroke_and_undo(size, repeat)
+        results += bench_render(size, repeat)
+        results += bench_composite(size, repeat)
+        results += bench_export(size, repeat)
+        results += bench_load_save(size, repeat)
+        results += bench_indexed(size, repeat)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "sdl": ".".join(str(part) for part in pygame.get_sdl_version()),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=1)
+    if (output_path != None):
+        with open(output_path, "w") as fileh:
+            fileh.write(report_json + "\n")
+    else:
+        print(report_json)
+    if (baseline_path != None):
+        with open(baseline_path) as fileh:
+            if (compare_results(results, json.load(fileh)["results"]) > 0):
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,50 @@
+import sys, os
+import inspect
+import timeit
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import logger
+
+# Per call cost of log lines, run with: python benchmarks/bench_logger.py
+# Enabled lines print, so stdout is sent to os.devnull while they are timed.
+
+CALL_COUNT = 20000
+
+def old_get_last_callback():
+    # What get_last_callback used to do, for comparison
+    frameinfo = inspect.stack()[1]
+    return (os.path.basename(frameinfo.filename), frameinfo.filename, frameinfo.lineno, frameinfo.code_context[0])
+
+def call_old_get_last_callback():
+    return old_get_last_callback()
+
+def time_per_call(statement) -> float:
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return min(timeit.repeat(statement, number=CALL_COUNT, repeat=3)) / CALL_COUNT
+
+def main():
+    log = logger.LOG()
+    info = logger.LOG_level("INFO")
+    position = (12, 34)
+    color = (255, 0, 0, 255)
+    undo_objects = [f"UndoSinglePixel(pixel_position=({i}, {i}), color={color})" for i in range(100)]
+
+    results = {}
+    results["call site, inspect.stack (old)"] = time_per_call(call_old_get_last_callback)
+    results["call site, single frame"] = time_per_call(lambda: logger.get_last_callback(1, log.output_code))
+
+    log.set_warnlevel(logger.LOG_level("WARNING"))
+    results["disabled output f-string"] = time_per_call(lambda: log.output(info, f"setting color: {color}, at {position}, undo: {undo_objects}"))
+    results["disabled output_format"] = time_per_call(lambda: log.output_format(info, "setting color: {}, at {}, undo: {}", color, position, undo_objects))
+    results["disabled is_enabled_for guard"] = time_per_call(lambda: log.is_enabled_for(info) and log.output(info, f"setting color: {color}, at {position}, undo: {undo_objects}"))
+
+    log.set_warnlevel(info)
+    results["enabled output"] = time_per_call(lambda: log.output(info, f"setting color: {color}, at {position}"))
+    results["enabled output_format"] = time_per_call(lambda: log.output_format(info, "setting color: {}, at {}", color, position))
+
+    for name, seconds in results.items():
+        print(f"{name:<36} {seconds*1e6:10.3f} us/call")
+
+if __name__ == "__main__":
+    main()
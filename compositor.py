@@ -0,0 +1,242 @@
+import pygame
+from pygame import (Surface, Rect)
+
+import render
+import history
+import indexed_layer
+from tiled_canvas import TiledCanvas
+
+# Draws the whole layer stack as one image. Layers are aligned at their top left corners,
+# and blended from the first layer up with their visibility, opacity and blend mode.
+# The composite is kept as a sparse TiledCanvas and only the tiles under an edit, or under
+# a layer whose properties changed, are blended again. While a single layer is shown at
+# full opacity nothing is blended at all, that layer is drawn as it is.
+#
+# Blend modes follow the usual separable formulas, on colour channels from 0 to 1:
+#   normal   source
+#   multiply backdrop*source
+#   add      backdrop+source, clamped to 1
+#   screen   1-(1-backdrop)*(1-source)
+# weighted by the source alpha. Where the backdrop is not opaque the result moves towards
+# the plain source colour, so a blend mode over a transparent area shows the layer unchanged.
+
+BLEND_MODE_NORMAL = "normal"
+BLEND_MODE_MULTIPLY = "multiply"
+BLEND_MODE_ADD = "add"
+BLEND_MODE_SCREEN = "screen"
+BLEND_MODES = (BLEND_MODE_NORMAL, BLEND_MODE_MULTIPLY, BLEND_MODE_ADD, BLEND_MODE_SCREEN)
+COMPOSITE_TILE_SIZE = 256
+_MAX_CHANGED_RECTS = 256
+_CLEAR_COLOR = (0, 0, 0, 0)
+_WHITE = (255, 255, 255, 255)
+
+def _make_filled_surface(size: tuple[int, int], color: tuple) -> Surface:
+    surface = Surface(size, pygame.SRCALPHA, 32)
+    surface.fill(color)
+    return surface
+
+def _inverted(surface: Surface) -> Surface:
+    '''
+    Copy with the colour channels (not alpha) of surface inverted, and opaque.
+    '''
+    inverted_surface = _make_filled_surface(surface.get_size(), _WHITE)
+    inverted_surface.blit(surface, (0, 0), special_flags=pygame.BLEND_RGB_SUB)
+    return inverted_surface
+
+def _set_alpha_channel(surface: Surface, alpha_source: Surface) -> None:
+    '''
+    Replace the alpha of every pixel of surface with the alpha of alpha_source, same size.
+    '''
+    surface.fill((255, 255, 255, 0), special_flags=pygame.BLEND_RGBA_MULT)
+    alpha_only = alpha_source.copy()
+    alpha_only.fill((0, 0, 0, 255), special_flags=pygame.BLEND_RGBA_MULT)
+    surface.blit(alpha_only, (0, 0), special_flags=pygame.BLEND_RGBA_ADD)
+
+def blend_pixels(destination: Surface, source: Surface, position: tuple[int, int], blend_mode: str = BLEND_MODE_NORMAL, opacity: int = 255) -> None:
+    '''
+    Blend source onto destination at position. destination is a 32 bit surface with per pixel alpha, source can be any layer surface.
+    source is not changed, it can be a subsurface of a layer.
+    param: opacity, from 0 to 255, scales the alpha of every source pixel.
+    '''
+    if (opacity <= 0):
+        return
+    # Indexed and RGB sources have no alpha channel for opacity to scale or premul_alpha to use
+    if (source.get_bitsize() != 32 or not (source.get_flags() & pygame.SRCALPHA)):
+        source = indexed_layer.to_rgba(source)
+    if (opacity < 255):
+        source = source.copy()
+        source.fill((255, 255, 255, opacity), special_flags=pygame.BLEND_RGBA_MULT)
+    if (blend_mode == BLEND_MODE_NORMAL):
+        destination.blit(source, position)
+        return
+    area = Rect(position, source.get_size()).clip(destination.get_rect())
+    if (area.width == 0 or area.height == 0):
+        return
+    source = source.subsurface(area.move(-position[0], -position[1]))
+    backdrop = destination.subsurface(area)
+    # The blend as if the backdrop were opaque, weighted by the source alpha. Only the colour channels are changed, alpha stays the backdrops.
+    blended = backdrop.copy()
+    if (blend_mode == BLEND_MODE_MULTIPLY):
+        # Source over white is source*alpha + (1-alpha), 1 where the source is transparent
+        source_over_white = _make_filled_surface(area.size, _WHITE)
+        source_over_white.blit(source, (0, 0))
+        blended.blit(source_over_white, (0, 0), special_flags=pygame.BLEND_RGB_MULT)
+    elif (blend_mode == BLEND_MODE_ADD):
+        blended.blit(source.premul_alpha(), (0, 0), special_flags=pygame.BLEND_RGB_ADD)
+    elif (blend_mode == BLEND_MODE_SCREEN):
+        inverted_product = _inverted(blended)
+        inverted_product.blit(_inverted(source.premul_alpha()), (0, 0), special_flags=pygame.BLEND_RGB_MULT)
+        blended.fill((0, 0, 0, 255), special_flags=pygame.BLEND_RGBA_MULT)
+        blended.blit(_inverted(inverted_product), (0, 0), special_flags=pygame.BLEND_RGB_ADD)
+    else:
+        raise ValueError(f"unknown blend mode '{blend_mode}'")
+    # Normal blending where the backdrop is transparent, the blend where it is opaque, mixed by the backdrop alpha.
+    # Blitting blended (which has the backdrop alpha) over the normal result does that mix, the alpha is then put back.
+    result = backdrop.copy()
+    result.blit(source, (0, 0))
+    result_alpha = result.copy()
+    result.blit(blended, (0, 0))
+    _set_alpha_channel(result, result_alpha)
+    history.paste_pixels(destination, result, area.topleft)
+
+def blend_colors(layer_colors: list[tuple[tuple, str, int]]) -> tuple:
+    '''
+    Blend (colour, blend mode, opacity) of each layer, from the bottom up, onto a transparent pixel.
+    '''
+    pixel = _make_filled_surface((1, 1), _CLEAR_COLOR)
+    color_pixel = Surface((1, 1), pygame.SRCALPHA, 32)
+    for color, blend_mode, opacity in layer_colors:
+        color_pixel.fill(color)
+        blend_pixels(pixel, color_pixel, (0, 0), blend_mode, opacity)
+    return tuple(pixel.get_at((0, 0)))
+
+class LayerCompositor:
+    def __init__(self, layers, tile_size: int = COMPOSITE_TILE_SIZE):
+        '''
+        Composite of a layer_stack.LayerStack. Pixel edits must be reported with mark_dirty (such as from
+        the layer stack modified_callback), layer property, surface and size changes are found by update.
+        '''
+        self.layers = layers
+        self.tile_size = tile_size
+        self.canvas = TiledCanvas((0, 0), _CLEAR_COLOR, tile_size)
+        self.mipmap = render.MipmapPyramid(self.canvas)
+        self.revision = 0 # increased every time composite pixels change
+        self.dirty_tile_rects: dict[tuple[int, int], Rect] = {} # {tile key: part of the tile to blend again}
+        self.changed_rects: list[Rect] = [] # parts of the shown image that changed since the last update
+        self.layer_states: list[tuple] = [] # (surface, size, visible, opacity, blend mode) of each layer, as last composited
+        self.composited_tile_count = 0 # tiles blended since created, for checking only dirty tiles are blended
+        self.blended_colors: dict[tuple, tuple] = {}
+    def get_size(self) -> tuple[int, int]:
+        '''
+        Size of the composite, large enough for every layer, visible or not.
+        '''
+        return (max((surface.get_width() for surface in self.layers.surfaces), default=0), max((surface.get_height() for surface in self.layers.surfaces), default=0))
+    def get_layer_state(self, layer_index: int) -> tuple:
+        layer_surface = self.layers.surfaces[layer_index]
+        return (layer_surface, layer_surface.get_size(), self.layers.visibilities[layer_index], self.layers.opacities[layer_index], self.layers.blend_modes[layer_index])
+    def __mark_rect_dirty(self, rect: Rect) -> None:
+        rect = Rect(rect).clip(self.canvas.get_rect())
+        if (rect.width == 0 or rect.height == 0):
+            return
+        for tile_key in self.canvas.get_tile_keys(rect):
+            tile_dirty_rect = self.canvas.get_tile_rect(tile_key).clip(rect)
+            if (tile_key in self.dirty_tile_rects):
+                tile_dirty_rect.union_ip(self.dirty_tile_rects[tile_key])
+            self.dirty_tile_rects[tile_key] = tile_dirty_rect
+        if (len(self.changed_rects) >= _MAX_CHANGED_RECTS):
+            # Nobody is calling update, such as while the current layer is shown alone
+            self.changed_rects = [None]
+        self.changed_rects.append(rect)
+    def mark_dirty(self, layer_index: int, modified_rect: Rect = None) -> None:
+        '''
+        param: modified_rect, in layer pixels, None for the whole layer.
+        '''
+        if (layer_index >= len(self.layer_states) or not self.layers.visibilities[layer_index]):
+            return # a new layer is picked up by update, a hidden layer changes nothing
+        self.__mark_rect_dirty(modified_rect if modified_rect != None else self.layers.surfaces[layer_index].get_rect())
+    def get_only_shown_layer(self) -> int or None:
+        '''
+        Index of the only visible layer when it is at full opacity and the size of the composite, so it looks the same as the composite.
+        '''
+        visible_layer_indices = [layer_index for layer_index in range(len(self.layers)) if self.layers.visibilities[layer_index]]
+        if (len(visible_layer_indices) == 1 and self.layers.opacities[visible_layer_indices[0]] == 255 and self.layers.surfaces[visible_layer_indices[0]].get_size() == self.get_size()):
+            return visible_layer_indices[0]
+        return None
+    def update(self) -> list[Rect]:
+        '''
+        Blend the dirty tiles again, unless a single layer is shown. Returns the rects of the shown image that changed
+        since the last update, in composite pixels, or [None] when the whole image changed.
+        '''
+        composite_size = self.get_size()
+        if (composite_size != self.canvas.get_size()):
+            self.canvas.resize(composite_size)
+            self.mipmap.mark_dirty()
+            self.dirty_tile_rects = {tile_key: self.canvas.get_tile_rect(tile_key).clip(self.canvas.get_rect()) for tile_key in self.canvas.get_tile_keys(self.canvas.get_rect())}
+            self.changed_rects = [None]
+        for layer_index in range(len(self.layers)):
+            layer_state = self.get_layer_state(layer_index)
+            previous_layer_state = self.layer_states[layer_index] if layer_index < len(self.layer_states) else None
+            if (layer_state == previous_layer_state):
+                continue
+            if (previous_layer_state != None and previous_layer_state[2]):
+                self.__mark_rect_dirty(Rect((0, 0), previous_layer_state[1]))
+            if (layer_state[2]):
+                self.__mark_rect_dirty(Rect((0, 0), layer_state[1]))
+        self.layer_states = [self.get_layer_state(layer_index) for layer_index in range(len(self.layers))]
+        if (self.get_only_shown_layer() == None and len(self.dirty_tile_rects) > 0):
+            self.blended_colors = {} # {layer colours of a one colour tile: their blend}, most one colour tiles repeat the same few
+            for tile_key, dirty_rect in self.dirty_tile_rects.items():
+                self.__composite_tile(tile_key, dirty_rect)
+                self.mipmap.mark_dirty(dirty_rect)
+            self.dirty_tile_rects.clear()
+            self.revision += 1
+        changed_rects = self.changed_rects
+        self.changed_rects = []
+        return changed_rects if None not in changed_rects else [None]
+    def __composite_tile(self, tile_key: tuple[int, int], dirty_rect: Rect) -> None:
+        '''
+        Blend dirty_rect of the tile again. The whole tile is blended when it is held as one colour.
+        '''
+        tile_rect = self.canvas.get_tile_rect(tile_key).clip(self.canvas.get_rect())
+        tile_surface = self.canvas.get_tile(tile_key)
+        tile_is_one_color = True
+        if (isinstance(tile_surface, Surface) and dirty_rect != tile_rect):
+            # Strokes only touch a small part of each tile
+            tile_rect = dirty_rect
+            tile_is_one_color = False
+        tile_layers = [] # (layer index, part of tile_rect the layer covers)
+        for layer_index in range(len(self.layers)):
+            if (not self.layers.visibilities[layer_index] or self.layers.opacities[layer_index] == 0):
+                continue
+            layer_surface = self.layers.surfaces[layer_index]
+            layer_rect = tile_rect.clip(layer_surface.get_rect())
+            if (layer_rect.width == 0 or layer_rect.height == 0):
+                continue
+            tile_layers.append((layer_index, layer_rect))
+            if (layer_rect != tile_rect or not isinstance(layer_surface, TiledCanvas) or layer_surface.get_region_color(layer_rect) == None):
+                tile_is_one_color = False
+        self.composited_tile_count += 1
+        if (tile_is_one_color):
+            # Every layer is one colour over the whole tile, such as the untouched parts of tiled layers
+            layer_colors = tuple((self.layers.surfaces[layer_index].get_region_color(layer_rect), self.layers.blend_modes[layer_index], self.layers.opacities[layer_index]) for layer_index, layer_rect in tile_layers)
+            tile_color = self.blended_colors.get(layer_colors)
+            if (tile_color == None):
+                tile_color = blend_colors(layer_colors)
+                self.blended_colors[layer_colors] = tile_color
+            self.canvas.set_tile(tile_key, tile_color)
+            return
+        tile_origin = self.canvas.get_tile_rect(tile_key).topleft
+        if (not isinstance(tile_surface, Surface)):
+            tile_surface = Surface((self.tile_size, self.tile_size), pygame.SRCALPHA, 32)
+        tile_surface.fill(_CLEAR_COLOR, tile_rect.move(-tile_origin[0], -tile_origin[1]))
+        for layer_index, layer_rect in tile_layers:
+            blend_pixels(tile_surface, self.layers.surfaces[layer_index].subsurface(layer_rect), (layer_rect.x-tile_origin[0], layer_rect.y-tile_origin[1]), self.layers.blend_modes[layer_index], self.layers.opacities[layer_index])
+        self.canvas.set_tile(tile_key, tile_surface)
+    def get_view(self) -> tuple[Surface or TiledCanvas, int, render.MipmapPyramid]:
+        '''
+        (surface, revision, mipmap) to draw the stack with, the only shown layer itself when there is one.
+        '''
+        shown_layer_index = self.get_only_shown_layer()
+        if (shown_layer_index != None):
+            return self.layers.surfaces[shown_layer_index], self.layers.revisions[shown_layer_index], self.layers.mipmaps[shown_layer_index]
+        return self.canvas, self.revision, self.mipmap
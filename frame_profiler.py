@@ -0,0 +1,106 @@
+import time
+import json
+import atexit
+import collections
+
+# Times each phase of the main loop. Phases run one after another: mark starts the named phase
+# and ends the one before it, so instrumenting the loop is a line per phase. A phase marked more
+# than once in a frame (such as drawing for each dirty rect) adds up.
+# Keeps the last window_frame_count frames of every phase for percentiles, and can write every
+# phase span as a Chrome trace ("JSON array format", opens in chrome://tracing and Perfetto).
+
+FRAME_PHASE_NAME = "frame" # the whole frame, from begin_frame to end_frame
+
+def get_percentile(sorted_values: list[float], percent: float) -> float:
+    '''
+    Nearest rank percentile of values sorted from low to high, 0 for no values.
+    '''
+    if (len(sorted_values) == 0):
+        return 0
+    return sorted_values[min(len(sorted_values)-1, int(len(sorted_values)*percent/100))]
+
+class FrameProfiler:
+    def __init__(self, window_frame_count: int = 300):
+        self.window_frame_count = window_frame_count
+        self.phase_windows: dict[str, collections.deque] = {} # {phase name: seconds of each of the last frames}, in first seen order
+        self.frame_phase_seconds: dict[str, float] = {} # seconds of each phase so far this frame
+        self.frame_start_time = None
+        self.phase_name = None
+        self.phase_start_time = None
+        self.frame_count = 0
+        self.start_time = time.perf_counter()
+        self.trace_fileh = None
+    def set_trace_output(self, file_path: str) -> None:
+        '''
+        Write every frame and phase span to file_path, until close. Raises OSError.
+        '''
+        self.close()
+        self.trace_fileh = open(file_path, "w")
+        # The array format allows the closing bracket to be missing, so a trace cut short by a crash still opens
+        self.trace_fileh.write("[\n")
+        atexit.register(self.close)
+    def __trace_span(self, name: str, category: str, start_time: float, end_time: float) -> None:
+        trace_event = {"name": name, "cat": category, "ph": "X", "pid": 0, "tid": 0,
+            "ts": round((start_time-self.start_time)*1e6, 1), "dur": round((end_time-start_time)*1e6, 1)}
+        self.trace_fileh.write(json.dumps(trace_event) + ",\n")
+    def begin_frame(self) -> None:
+        self.frame_start_time = time.perf_counter()
+        self.frame_phase_seconds = {}
+        self.phase_name = None
+    def mark(self, phase_name: str) -> None:
+        '''
+        End the current phase, if any, and start phase_name.
+        '''
+        mark_time = time.perf_counter()
+        self.__end_phase(mark_time)
+        self.phase_name = phase_name
+        self.phase_start_time = mark_time
+    def __end_phase(self, end_time: float) -> None:
+        if (self.phase_name == None):
+            return
+        self.frame_phase_seconds[self.phase_name] = self.frame_phase_seconds.get(self.phase_name, 0) + end_time - self.phase_start_time
+        if (self.trace_fileh != None):
+            self.__trace_span(self.phase_name, "phase", self.phase_start_time, end_time)
+        self.phase_name = None
+    def end_frame(self) -> None:
+        if (self.frame_start_time == None):
+            return
+        end_time = time.perf_counter()
+        self.__end_phase(end_time)
+        self.frame_phase_seconds[FRAME_PHASE_NAME] = end_time - self.frame_start_time
+        if (self.trace_fileh != None):
+            self.__trace_span(f"{FRAME_PHASE_NAME} {self.frame_count}", FRAME_PHASE_NAME, self.frame_start_time, end_time)
+        # Phases not run this frame took 0, so every window covers the same frames
+        for phase_name in self.frame_phase_seconds:
+            if (phase_name not in self.phase_windows):
+                self.phase_windows[phase_name] = collections.deque([0]*min(self.frame_count, self.window_frame_count), maxlen=self.window_frame_count)
+        for phase_name, phase_window in self.phase_windows.items():
+            phase_window.append(self.frame_phase_seconds.get(phase_name, 0))
+        self.frame_count += 1
+        self.frame_start_time = None
+    def get_last_frame_seconds(self) -> float:
+        return self.frame_phase_seconds.get(FRAME_PHASE_NAME, 0)
+    def get_phase_percentiles(self, phase_name: str) -> tuple[float, float, float]:
+        '''
+        (p50, p95, p99) seconds of the phase over the last window_frame_count frames.
+        '''
+        sorted_seconds = sorted(self.phase_windows.get(phase_name, ()))
+        return (get_percentile(sorted_seconds, 50), get_percentile(sorted_seconds, 95), get_percentile(sorted_seconds, 99))
+    def get_report_lines(self) -> list[str]:
+        '''
+        A line per phase, the whole frame first, with its p50, p95 and p99 in milliseconds.
+        '''
+        report_lines = [f"{'phase':<16}{'p50':>8}{'p95':>8}{'p99':>8} ms"]
+        for phase_name in sorted(self.phase_windows, key=lambda name: name != FRAME_PHASE_NAME):
+            p50, p95, p99 = self.get_phase_percentiles(phase_name)
+            report_lines.append(f"{phase_name:<16}{p50*1000:8.2f}{p95*1000:8.2f}{p99*1000:8.2f}")
+        return report_lines
+    def close(self) -> None:
+        '''
+        Finish and close the trace file, if one is being written.
+        '''
+        if (self.trace_fileh == None):
+            return
+        self.trace_fileh.write(json.dumps({"name": "end", "ph": "i", "s": "g", "pid": 0, "tid": 0, "ts": round((time.perf_counter()-self.start_time)*1e6, 1)}) + "\n]\n")
+        self.trace_fileh.close()
+        self.trace_fileh = None
@@ -0,0 +1,444 @@
+import os
+import sys
+import collections
+import itertools
+import tempfile
+import typing
+import zlib
+
+import pygame
+from pygame import (Surface, Rect)
+
+import indexed_layer
+
+# Each undo object is one whole user action (a stroke, a fill, a resize), so one undo
+# reverts one action. Applying an undo object gives back the object that reverses it,
+# which is how the same objects are used for both undo and redo.
+#
+# Large changes are recorded as before-images of only the tiles they touched, each
+# zlib compressed on its own, and put back with a direct blit. Once a layers history
+# holds more than its RAM threshold, the tiles of the oldest actions are moved to
+# files in a temporary directory (see SpillStore) and read back when needed.
+
+UNDO_TILE_SIZE = 64
+_TILE_COMPRESSION_LEVEL = 1 # fast, flat pixel art areas compress well even at the lowest level
+
+def get_surface_byte_size(surface: Surface) -> int:
+    return surface.get_width()*surface.get_height()*surface.get_bytesize()
+
+def paste_pixels(destination: Surface, pixels: Surface, position: tuple[int, int]) -> None:
+    '''
+    Copy pixels onto destination exactly, alpha included, rather than alpha blending them.
+    Onto an indexed layer pixels must be indexed too, their palette indices are copied as they are.
+    '''
+    if (indexed_layer.is_indexed(destination)):
+        # Blitting between the same palettes, without a colorkey, copies the indices
+        index_pixels = pygame.image.frombuffer(pygame.image.tobytes(pixels, "P"), pixels.get_size(), "P")
+        index_pixels.set_palette(destination.get_palette())
+        destination.blit(index_pixels, position)
+        return
+    destination.fill((0, 0, 0, 0), Rect(position, pixels.get_size()))
+    destination.blit(pixels, position, special_flags=pygame.BLEND_RGBA_ADD)
+
+def get_tile_rects(rect: Rect, bounds_rect: Rect, tile_size: int = UNDO_TILE_SIZE) -> list[Rect]:
+    '''
+    Get the rects of the tile grid (aligned to multiples of tile_size) that overlap rect, clipped to bounds_rect.
+    '''
+    rect = Rect(rect).clip(bounds_rect)
+    tile_rects = []
+    for tile_y in range(rect.top//tile_size*tile_size, rect.bottom, tile_size):
+        for tile_x in range(rect.left//tile_size*tile_size, rect.right, tile_size):
+            tile_rect = Rect(tile_x, tile_y, tile_size, tile_size).clip(bounds_rect)
+            if (tile_rect.width > 0 and tile_rect.height > 0):
+                tile_rects.append(tile_rect)
+    return tile_rects
+
+def get_pixel_format(surface: Surface) -> str:
+    '''
+    Get the byte order, as a pygame.image.tobytes format, matching the pixels of surface in memory.
+    Tiles kept in the same order as the layer are pasted back several times faster than ones that need converting.
+    Indexed layers keep their palette indices, "P".
+    '''
+    if (indexed_layer.is_indexed(surface)):
+        return "P"
+    if (surface.get_bitsize() == 32 and surface.get_masks()[:3] == (0xFF0000, 0xFF00, 0xFF) and sys.byteorder == "little"):
+        return "BGRA"
+    return "RGBA"
+
+def compress_pixels(pixels: Surface, pixel_format: str = "RGBA") -> bytes:
+    return zlib.compress(pygame.image.tobytes(pixels, pixel_format), _TILE_COMPRESSION_LEVEL)
+
+def decompress_pixels(compressed_pixels: bytes, size: tuple[int, int], pixel_format: str = "RGBA") -> Surface:
+    return pygame.image.frombuffer(zlib.decompress(compressed_pixels), size, pixel_format)
+
+class SpillStore:
+    def __init__(self):
+        '''
+        Files, in a temporary directory made on first use, holding undo tiles moved out of RAM.
+        The directory, and any files left in it, are removed at exit.
+        '''
+        self.directory: tempfile.TemporaryDirectory = None
+        self.file_count = 0
+    def write(self, blobs: list[bytes]) -> tuple[str, list[tuple[int, int]]]:
+        '''
+        Returns (file path, [(offset, length)] of each blob).
+        '''
+        if (self.directory == None):
+            self.directory = tempfile.TemporaryDirectory(prefix="iedit-history-")
+        self.file_count += 1
+        file_path = os.path.join(self.directory.name, f"{self.file_count}.tiles")
+        blob_ranges = []
+        offset = 0
+        with open(file_path, "wb") as fileh:
+            for blob in blobs:
+                fileh.write(blob)
+                blob_ranges.append((offset, len(blob)))
+                offset += len(blob)
+        return file_path, blob_ranges
+    def read(self, file_path: str, blob_ranges: list[tuple[int, int]]) -> typing.Iterator[bytes]:
+        '''
+        Yields each blob of blob_ranges in turn, the file is kept open until the last one is read.
+        '''
+        with open(file_path, "rb") as fileh:
+            for offset, length in blob_ranges:
+                fileh.seek(offset)
+                yield fileh.read(length)
+    def remove(self, file_path: str) -> None:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+class UndoObject:
+    def __init__(self):
+        pass
+    def get_byte_size(self) -> int:
+        '''
+        Size in RAM and on disk.
+        '''
+        return 0
+    def get_ram_byte_size(self) -> int:
+        return self.get_byte_size()
+    def spill(self, spill_store: SpillStore) -> None:
+        '''
+        Move what can be moved out of RAM into spill_store.
+        '''
+        pass
+    def release(self) -> None:
+        '''
+        Called once the undo object is dropped from the history, to remove anything it spilled.
+        '''
+        pass
+class UndoPixelRegions(UndoObject):
+    def __init__(self, regions: list[tuple[Rect, Surface]]):
+        '''
+        Used while a stroke is being drawn, then turned into UndoTiles with UndoTiles.from_regions.
+        param: regions, (rect, copy of the layer pixels in rect before the change), in the order the changes were made.
+        '''
+        self.regions: list[tuple[Rect, Surface]] = regions
+        self.byte_size = sum(get_surface_byte_size(pixels) for _, pixels in regions)
+    def extend(self, regions: list[tuple[Rect, Surface]]) -> None:
+        '''
+        Add regions changed after the ones already held, such as the next frame of a stroke.
+        '''
+        self.regions.extend(regions)
+        self.byte_size += sum(get_surface_byte_size(pixels) for _, pixels in regions)
+    def get_byte_size(self) -> int:
+        return self.byte_size
+    def __str__(self):
+        return f"UndoPixelRegions(regions={len(self.regions)}, bytes={self.byte_size})"
+class UndoTiles(UndoObject):
+    def __init__(self, tiles: list[tuple[Rect, bytes]], pixel_format: str = "RGBA"):
+        '''
+        param: tiles, (rect, compressed pixels of the layer in rect before the change).
+        param: pixel_format, byte order of the compressed pixels, see get_pixel_format.
+        '''
+        self.pixel_format = pixel_format
+        self.tile_rects: list[Rect] = [tile_rect for tile_rect, _ in tiles]
+        self.compressed_tiles: list[bytes] = [compressed_pixels for _, compressed_pixels in tiles] # None once spilled
+        self.byte_size = sum(len(compressed_pixels) for compressed_pixels in self.compressed_tiles)
+        self.spill_store: SpillStore = None
+        self.spill_file_path: str = None
+        self.spill_ranges: list[tuple[int, int]] = None
+    @classmethod
+    def from_surface(cls, surface: Surface, rects: list[Rect], mask: pygame.Mask = None) -> "UndoTiles":
+        '''
+        Record the tiles of surface overlapping any of rects, before they are changed.
+        param: mask, same size as the surface, when given tiles with no pixels set in the mask are left out.
+        '''
+        pixel_format = get_pixel_format(surface)
+        tiles = {}
+        for rect in rects:
+            for tile_rect in get_tile_rects(rect, surface.get_rect()):
+                if (tile_rect.topleft in tiles):
+                    continue
+                if (mask != None and mask.overlap(pygame.Mask(tile_rect.size, fill=True), tile_rect.topleft) == None):
+                    continue
+                tiles[tile_rect.topleft] = (tile_rect, compress_pixels(surface.subsurface(tile_rect), pixel_format))
+        return cls(list(tiles.values()), pixel_format)
+    @classmethod
+    def from_regions(cls, regions: list[tuple[Rect, Surface]], surface: Surface) -> "UndoTiles":
+        '''
+        Turn the regions of an UndoPixelRegions into tiles, for when a stroke ends.
+        surface must be the layer as it is after the last region was changed.
+        '''
+        pixel_format = get_pixel_format(surface)
+        tiles = {}
+        for rect, _ in regions:
+            for tile_rect in get_tile_rects(rect, surface.get_rect()):
+                if (tile_rect.topleft in tiles):
+                    continue
+                tile_pixels = surface.subsurface(tile_rect).copy()
+                # Newest first, so where regions overlap the oldest pixels are the ones kept
+                for region_rect, region_pixels in reversed(regions):
+                    overlap_rect = region_rect.clip(tile_rect)
+                    if (overlap_rect.width == 0 or overlap_rect.height == 0):
+                        continue
+                    paste_pixels(tile_pixels, region_pixels.subsurface(overlap_rect.move(-region_rect.x, -region_rect.y)), (overlap_rect.x-tile_rect.x, overlap_rect.y-tile_rect.y))
+                tiles[tile_rect.topleft] = (tile_rect, compress_pixels(tile_pixels, pixel_format))
+        return cls(list(tiles.values()), pixel_format)
+    def get_tiles(self) -> typing.Iterator[tuple[Rect, Surface]]:
+        '''
+        Yields (rect, pixels) of each tile, read back from the spill store when spilled.
+        '''
+        compressed_tiles = self.compressed_tiles
+        if (self.spill_file_path != None):
+            compressed_tiles = self.spill_store.read(self.spill_file_path, self.spill_ranges)
+        for tile_rect, compressed_pixels in zip(self.tile_rects, compressed_tiles):
+            yield tile_rect, decompress_pixels(compressed_pixels, tile_rect.size, self.pixel_format)
+    def get_bounding_rect(self) -> Rect or None:
+        if (len(self.tile_rects) == 0):
+            return None
+        return self.tile_rects[0].unionall(self.tile_rects[1:])
+    def get_byte_size(self) -> int:
+        return self.byte_size
+    def get_ram_byte_size(self) -> int:
+        return 0 if self.spill_file_path != None else self.byte_size
+    def spill(self, spill_store: SpillStore) -> None:
+        if (self.spill_file_path != None or len(self.tile_rects) == 0):
+            return
+        self.spill_store = spill_store
+        self.spill_file_path, self.spill_ranges = spill_store.write(self.compressed_tiles)
+        self.compressed_tiles = [None]*len(self.tile_rects)
+    def release(self) -> None:
+        if (self.spill_file_path != None):
+            self.spill_store.remove(self.spill_file_path)
+            self.spill_file_path = None
+    def __str__(self):
+        return f"{type(self).__name__}(tiles={len(self.tile_rects)}, bytes={self.byte_size}, spilled={self.spill_file_path != None})"
+class UndoResize(UndoTiles):
+    def __init__(self, tiles: list[tuple[Rect, bytes]], pixel_format: str, old_size: tuple[int, int], old_has_alpha: bool, old_palette: list[pygame.Color] = None):
+        '''
+        Tiles cover the whole of the layer from before the resize, or before it was changed between RGBA and indexed.
+        param: old_palette, of an indexed layer (see indexed_layer.get_palette_colors), None for RGBA.
+        '''
+        super().__init__(tiles, pixel_format)
+        self.old_size = old_size
+        self.old_has_alpha = old_has_alpha
+        self.old_palette = old_palette
+    @classmethod
+    def from_whole_surface(cls, surface: Surface) -> "UndoResize":
+        tiles = UndoTiles.from_surface(surface, [surface.get_rect()])
+        old_palette = indexed_layer.get_palette_colors(surface) if indexed_layer.is_indexed(surface) else None
+        return cls(list(zip(tiles.tile_rects, tiles.compressed_tiles)), tiles.pixel_format, surface.get_size(), bool(surface.get_flags() & pygame.SRCALPHA), old_palette)
+    def rebuild_surface(self) -> Surface:
+        '''
+        Get a new surface of the layer as it was before the resize.
+        '''
+        if (self.old_palette != None):
+            surface = Surface(self.old_size, 0, 8)
+            UndoPalette(self.old_palette).restore_palette(surface)
+        else:
+            surface = Surface(self.old_size, pygame.SRCALPHA if self.old_has_alpha else 0, 32)
+        for tile_rect, tile_pixels in self.get_tiles():
+            paste_pixels(surface, tile_pixels, tile_rect.topleft)
+        return surface
+
+class UndoPalette(UndoObject):
+    def __init__(self, palette: list[pygame.Color]):
+        '''
+        The palette of an indexed layer before it was changed, the pixels are left as they are.
+        param: palette, see indexed_layer.get_palette_colors, the entry with alpha 0 is the transparent one.
+        '''
+        self.palette: list[pygame.Color] = palette
+    @classmethod
+    def from_surface(cls, surface: Surface) -> "UndoPalette":
+        return cls(indexed_layer.get_palette_colors(surface))
+    def restore_palette(self, surface: Surface) -> None:
+        surface.set_palette([palette_color[:3] for palette_color in self.palette])
+        transparent_indices = [palette_index for palette_index, palette_color in enumerate(self.palette) if palette_color.a == 0]
+        surface.set_colorkey(transparent_indices[0] if len(transparent_indices) > 0 else None)
+    def get_byte_size(self) -> int:
+        return 4*len(self.palette)
+    def __str__(self):
+        return f"UndoPalette(colors={len(self.palette)})"
+
+class UndoCanvasTiles(UndoTiles):
+    def __init__(self, tiles: list[tuple[Rect, bytes]], pixel_format: str, tile_colors: list[tuple[Rect, tuple or None]]):
+        '''
+        Before-images of whole tiles of a tiled_canvas.TiledCanvas, tiles that were one colour are kept as just that colour.
+        param: tile_colors, (tile rect, colour of the whole tile, None for the canvas default colour).
+        '''
+        super().__init__(tiles, pixel_format)
+        self.tile_colors: list[tuple[Rect, tuple or None]] = tile_colors
+        self.byte_size += 16*len(tile_colors)
+    @classmethod
+    def from_canvas(cls, canvas, tile_keys: list[tuple[int, int]]) -> "UndoCanvasTiles":
+        '''
+        Record the tiles of canvas with tile_keys, before they are changed.
+        '''
+        return cls(*cls._record_canvas_tiles(canvas, tile_keys))
+    @staticmethod
+    def _record_canvas_tiles(canvas, tile_keys: list[tuple[int, int]]) -> tuple[list, str, list]:
+        pixel_format = get_pixel_format(canvas)
+        tiles = []
+        tile_colors = []
+        for tile_key in dict.fromkeys(tile_keys):
+            tile = canvas.get_tile(tile_key)
+            if (isinstance(tile, Surface)):
+                tiles.append((canvas.get_tile_rect(tile_key), compress_pixels(tile, pixel_format)))
+            else:
+                tile_colors.append((canvas.get_tile_rect(tile_key), tile))
+        return tiles, pixel_format, tile_colors
+    def get_tile_keys(self, tile_size: int) -> list[tuple[int, int]]:
+        return [(tile_rect.x//tile_size, tile_rect.y//tile_size) for tile_rect in self.tile_rects + [tile_rect for tile_rect, _ in self.tile_colors]]
+    def restore_canvas(self, canvas) -> None:
+        '''
+        Put the recorded tiles back into canvas.
+        '''
+        for tile_rect, tile_color in self.tile_colors:
+            canvas.set_tile(canvas.get_tile_key(tile_rect.topleft), tile_color)
+        for tile_rect, tile_pixels in self.get_tiles():
+            # get_tiles gives surfaces over the decompressed bytes, the canvas needs a surface of its own
+            canvas.set_tile(canvas.get_tile_key(tile_rect.topleft), tile_pixels.copy())
+    def get_bounding_rect(self) -> Rect or None:
+        tile_rects = self.tile_rects + [tile_rect for tile_rect, _ in self.tile_colors]
+        if (len(tile_rects) == 0):
+            return None
+        return tile_rects[0].unionall(tile_rects[1:])
+    def __str__(self):
+        return f"{type(self).__name__}(tiles={len(self.tile_rects)}, colour tiles={len(self.tile_colors)}, bytes={self.byte_size}, spilled={self.spill_file_path != None})"
+class UndoCanvasResize(UndoCanvasTiles):
+    def __init__(self, tiles: list[tuple[Rect, bytes]], pixel_format: str, tile_colors: list[tuple[Rect, tuple or None]], old_size: tuple[int, int]):
+        '''
+        Tiles are the ones the resize cut into, the rest of the canvas is left as it is by a resize.
+        '''
+        super().__init__(tiles, pixel_format, tile_colors)
+        self.old_size = old_size
+    @classmethod
+    def from_canvas_resize(cls, canvas, new_size: tuple[int, int]) -> "UndoCanvasResize":
+        '''
+        Record what resizing canvas to new_size would lose, before it is resized.
+        '''
+        kept_rect = Rect((0, 0), new_size)
+        tile_keys = [tile_key for tile_key in canvas.tiles if not kept_rect.contains(canvas.get_tile_rect(tile_key).clip(canvas.get_rect()))]
+        return cls(*cls._record_canvas_tiles(canvas, tile_keys), canvas.get_size())
+    def restore_canvas(self, canvas) -> None:
+        canvas.resize(self.old_size)
+        super().restore_canvas(canvas)
+
+class LayerHistory:
+    def __init__(self, max_bytes: int, max_ram_bytes: int = None, spill_store: SpillStore = None):
+        '''
+        Undo and redo stacks of one layer. When the undo objects held take more than max_bytes,
+        the oldest are dropped, from the redo stack first. The newest undo object, and the next one to redo, are always kept.
+        param: max_ram_bytes, when the undo objects in RAM take more than this, the oldest are spilled to spill_store.
+        '''
+        self.max_bytes = max_bytes
+        self.max_ram_bytes = max_ram_bytes
+        self.spill_store = spill_store
+        # [undo object, byte size, RAM byte size], the sizes as last counted
+        self.undo_objects: collections.deque = collections.deque() # newest last
+        self.redo_objects: collections.deque = collections.deque() # next to redo last
+        self.byte_size = 0
+        self.ram_byte_size = 0
+    def add(self, undo_object: UndoObject) -> None:
+        '''
+        Record a new action. Anything that could be redone is dropped, it no longer follows on from the layer.
+        '''
+        while len(self.redo_objects) > 0:
+            self.__drop_oldest(self.redo_objects)
+        self.__push(self.undo_objects, undo_object)
+        self.__trim()
+    def update_last(self) -> None:
+        '''
+        Call after the newest undo object has grown, such as a stroke still being drawn, to recount its size.
+        '''
+        if (len(self.undo_objects) == 0):
+            return
+        self.__push(self.undo_objects, self.__pop(self.undo_objects))
+        self.__trim()
+    def replace_last(self, undo_object: UndoObject) -> None:
+        '''
+        Swap the newest undo object for an equivalent one, such as a finished stroke turned into tiles.
+        '''
+        if (len(self.undo_objects) == 0):
+            return
+        self.__pop(self.undo_objects).release()
+        self.__push(self.undo_objects, undo_object)
+        self.__trim()
+    def get_last(self) -> UndoObject or None:
+        if (len(self.undo_objects) == 0):
+            return None
+        return self.undo_objects[-1][0]
+    def undo(self, apply_function: typing.Callable) -> bool:
+        '''
+        param: apply_function, reverts the change of the undo object it is given, and returns the undo object that reverses that (or None).
+        Returns False when there is nothing to undo.
+        '''
+        return self.__move(self.undo_objects, self.redo_objects, apply_function)
+    def redo(self, apply_function: typing.Callable) -> bool:
+        return self.__move(self.redo_objects, self.undo_objects, apply_function)
+    def get_undo_count(self) -> int:
+        return len(self.undo_objects)
+    def get_redo_count(self) -> int:
+        return len(self.redo_objects)
+    def clear(self) -> None:
+        while len(self.undo_objects) > 0:
+            self.__drop_oldest(self.undo_objects)
+        while len(self.redo_objects) > 0:
+            self.__drop_oldest(self.redo_objects)
+    def __push(self, stack: collections.deque, undo_object: UndoObject) -> None:
+        entry = [undo_object, undo_object.get_byte_size(), undo_object.get_ram_byte_size()]
+        stack.append(entry)
+        self.byte_size += entry[1]
+        self.ram_byte_size += entry[2]
+    def __pop(self, stack: collections.deque) -> UndoObject:
+        undo_object, byte_size, ram_byte_size = stack.pop()
+        self.byte_size -= byte_size
+        self.ram_byte_size -= ram_byte_size
+        return undo_object
+    def __drop_oldest(self, stack: collections.deque) -> None:
+        undo_object, byte_size, ram_byte_size = stack.popleft()
+        self.byte_size -= byte_size
+        self.ram_byte_size -= ram_byte_size
+        undo_object.release()
+    def __move(self, from_stack: collections.deque, to_stack: collections.deque, apply_function: typing.Callable) -> bool:
+        if (len(from_stack) == 0):
+            return False
+        undo_object = self.__pop(from_stack)
+        reverse_undo_object = apply_function(undo_object)
+        undo_object.release()
+        if (reverse_undo_object != None):
+            self.__push(to_stack, reverse_undo_object)
+            self.__trim()
+        return True
+    def __trim(self) -> None:
+        # Keeping the next redo lets an undo of an object over max_bytes be redone
+        while self.byte_size > self.max_bytes and len(self.redo_objects) > 1:
+            self.__drop_oldest(self.redo_objects)
+        while self.byte_size > self.max_bytes and len(self.undo_objects) > 1:
+            self.__drop_oldest(self.undo_objects)
+        if (self.max_ram_bytes == None or self.spill_store == None):
+            return
+        # Oldest first, the furthest from the present in either direction. The newest undo object stays in RAM.
+        for stack, keep_count in ((self.redo_objects, 0), (self.undo_objects, 1)):
+            for entry in itertools.islice(stack, 0, max(0, len(stack)-keep_count)):
+                if (self.ram_byte_size <= self.max_ram_bytes):
+                    return
+                if (entry[2] == 0):
+                    continue
+                entry[0].spill(self.spill_store)
+                new_ram_byte_size = entry[0].get_ram_byte_size()
+                self.ram_byte_size += new_ram_byte_size - entry[2]
+                entry[2] = new_ram_byte_size
@@ -5,10 +5,28 @@ from pygame.math import Vector2 as Vec2
 from pygame import (Surface, Rect)
 import sys, os
 import time
+import tempfile
 
 import typing
 
 import logger
+import paint_tools
+import render
+import text_cache
+import raw_layer
+import layer_io
+import input_parsing
+import background_tasks
+import frame_profiler
+import input_recording
+import compositor
+import indexed_layer
+import layer_export
+from history import (UndoTiles, UndoCanvasTiles)
+from render import RenderImage
+from tiled_canvas import TiledCanvas
+from layer_stack import LayerStack
+from layer_io import ImageLoadStates
 
 if (__name__ != "__main__"):
     print("Need to run directly")
@@ -18,103 +36,60 @@ VERSION_MAJOR = 0
 VERSION_MINOR = 14
 VERSION_PATCH = 0
 
+LOG_FILE_MAX_BYTES = 4*1024*1024
+CRASH_LOG_DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "iedit-crash.log")
+
 log = logger.LOG()
 log.set_warnlevel(logger.LOG_level("INFO"))
 
 pygame.init()
 
-class RenderImage:
-    def __init__(self, surface_ptr: Surface, position: Vec2):
-        '''
-        param: position is the center of the surface, and will always stay the same.
-        '''
-        self.surface_ptr = surface_ptr
-        self.trans_rect = None
-        self.trans_surface = None
-        self.scale_mul = 1.0
-        self.max_scale = 5.0
-        self.min_scale = 1.0
-        self.calc_transform()
-    def set_max_scale(new_scale: float) -> None:
-        self.max_scale = max_scale
-        if (max_scale < self.max_scale):
-            self.scale_mul = min(max_scale, self.scale_mul)
-            self.calc_transform()
-    def offset_scale(scale_offset: float) -> None:
-        if scale_offset + self.scale_mul <= self.max_scale:
-            self.scale_mul += scale_offset
-    def calc_transform(self) -> None:
-        self.trans_surface = pygame.transform.scale(self.surface_ptr, (self.surface_ptr.get_width()*self.scale_mul, self.surface_ptr.get_height()*self.scale_mul))
-        self.trans_rect = self.trans_surface.get_rect(center=self.trans_rect.center)
-    def get_twidth(self) -> int:
-        '''
-        Get transformed surface pixel width
-        '''
-        return self.trans_surface.get_width()
-    def get_theight(self) -> int:
-        '''
-        Get transformed surface pixel height
-        '''
-        return self.trans_surface.get_height()
-    def get_tsize(self) -> Vec2:
-        '''
-        Get transformed surface pixel size
-        '''
-        return Vec2(self.trans_surface.get_size())
-    def get_owidth(self) -> int:
-        '''
-        Get original surface pixel width
-        '''
-        return self.surface_ptr.get_width()
-    def get_owidth(self) -> int:
-        '''
-        Get original surface pixel height
-        '''
-        return self.surface_ptr.get_height()
-    def get_osize(self) -> Vec2:
-        '''
-        Get original surface pixel size
-        '''
-        return Vec2(self.surface_ptr.get_size())
-    def get_cpos(self) -> Vec2:
-        '''
-        Get image center pixel position
-        '''
-        return self.trans_rect.center
-    def get_tpos(self) -> Vec2:
-        '''
-        Get transformed surface top left pixel position
-        '''
-        return self.trans_rect.topleft
-
 class Key:
     return_normal_mode = pygame.K_ESCAPE
     select_mode_select_color = pygame.K_s
     select_mode_set_color = pygame.K_c
+    select_mode_brush = pygame.K_b
     layer_mode_toggle = pygame.K_l
     resize_editing_surface = pygame.K_r
     undo_editing_surface_modification = pygame.K_u
+    redo_editing_surface_modification = pygame.K_y
     save_current_layer_surface = pygame.K_w
     pick_color = pygame.K_p
     confirm = pygame.K_RETURN
     move_camera = pygame.K_m
     fill_bucket = pygame.K_f
     toggle_grid_lines = pygame.K_g
+    toggle_profiler_overlay = pygame.K_F3
+    toggle_layer_composite = pygame.K_v
     quit = pygame.K_q
             
 class State:
-    unsaved_changes: bool = False
+    quit_warning_given: bool = False # set once quitting was warned about unsaved layers, cleared by the next edit
     main_mouse_button_clicked_this_frame = False
     main_mouse_button_held = False
     move_camera = False
     camera_position = [0, 0]
     last_mouse_position = (0, 0)
-    max_undo_objects = 512
+    max_undo_bytes = 1024*1024*1024 # per layer, memory and temporary disk space the undo and redo history of a layer may use
+    max_undo_ram_bytes = 64*1024*1024 # per layer, past this the oldest undo history is moved to temporary files
+    max_surface_layer_pixels = 8192*8192 # resizing a plain layer past this is refused, tiled layers only hold the tiles drawn on
+    load_layers_tiled = False # load image files as tiled layers
+    image_load_queued_count = 0 # image files queued for decoding since the loading queue was last empty
+    image_load_failed_count = 0
+    layer_save_queued_count = 0 # layers queued for saving since the saving queue was last empty
+    layer_save_failed_count = 0
     current_selected_surface_layer_index = 0
     editing_surface_zoom = 30
     max_editing_surface_zoom = 100
-    min_editing_surface_zoom = 0
+    min_editing_surface_zoom = 1/64 # below a zoom of 1, zooming halves or doubles the zoom
     display_grid_lines = True
+    display_layer_composite = True # draw every visible layer blended together, otherwise only the current layer
+    display_profiler_overlay = False # per phase frame timings, drawn over the top left of the screen
+    fill_connectivity = paint_tools.FILL_CONNECTIVITY_4
+    fill_tolerance = 0 # max per channel difference, from the start pixel, to still be filled
+    editing_surface_modified_rects = [] # pixel rects modified since the last frame, None for the whole surface
+    stroke_pending_screen_positions = [] # mouse positions of the current stroke not painted yet, from every event this frame
+    brush: paint_tools.Brush = None # None for single pixel strokes
     text_io_buffer = ""
     max_text_buffer_char_count = 64
     clear_text_buffer_on_write = False # clear text buffer on next write
@@ -143,6 +118,7 @@ class Mode:
     SAVE_FILE = 3
     RESIZE_SURFACE = 4
     LAYERS = 5
+    BRUSH = 6
     current = NORMAL
 
 class ImageLayerBuffer:
@@ -167,7 +143,8 @@ class ImageLayerBuffer:
         return (False, "")
 
 app_font_size = 20
-app_font_object = pygame.font.Font(None, app_font_size)
+app_font_cache = text_cache.FontCache()
+app_text_cache = text_cache.TextCache(app_font_cache)
 
 class UITextElement:
     def __init__(self, position: Vec2, text: str, frame_x_px_margin: int, frame_y_px_margin: int):
@@ -176,6 +153,7 @@ class UITextElement:
             position = Vec2(position)
         self.position = position
         self.margin: Vec2 = Vec2(frame_x_px_margin, frame_y_px_margin)
+        self.generated_from = None # (text, font size) the current surfaces were generated from
         self.regenerate_surfaces()
     def set_top_left_pos(self, position: Vec2) -> None:
         if not isinstance(position, Vec2): # Try help if position is of incorrect type
@@ -208,10 +186,14 @@ class UITextElement:
         render_surface.blit(self.bg_surface, self.position)
         render_surface.blit(self.text_surface, self.position+self.margin)
     def regenerate_surfaces(self) -> None:
-        self.text_surface: pygame.Surface = app_font_object.render(self.text, True, app_text_color)
-        self.bg_surface: pygame.Surface = pygame.Surface((self.text_surface.get_width()+self.margin.x*2, self.text_surface.get_height()+self.margin.y*2))
-        self.bg_surface.fill(app_text_background_color)
-        self.bg_surface.set_alpha(app_text_background_alpha)
+        '''
+        Only regenerates when the text or font size has changed since the last call.
+        '''
+        if (self.generated_from == (self.text, app_font_size)):
+            return
+        self.generated_from = (self.text, app_font_size)
+        self.text_surface: pygame.Surface = app_text_cache.render(self.text, app_font_size, app_text_color)
+        self.bg_surface: pygame.Surface = app_text_cache.get_background((self.text_surface.get_width()+self.margin.x*2, self.text_surface.get_height()+self.margin.y*2), app_text_background_color, app_text_background_alpha)
     def update_text(self, new_text: str) -> None:
         self.text = new_text
         self.regenerate_surfaces()
@@ -238,14 +220,18 @@ def print_keybindings():
     print(" Can escape back to normal mode with key", pygame.key.name(Key.return_normal_mode))
     print(" - select color (In normal mode): ", pygame.key.name(Key.select_mode_select_color))
     print(" - set color (In normal mode): ", pygame.key.name(Key.select_mode_set_color))
+    print(" - set brush, '<square|circle> <size>' or 'stamp <image path>' (In normal mode): ", pygame.key.name(Key.select_mode_brush))
     print(" - resize editing surface (In normal mode): ", pygame.key.name(Key.resize_editing_surface))
     print(" - layers management (In normal mode): ", pygame.key.name(Key.layer_mode_toggle))
     print(" - undo editing surface modification (In normal mode): ", pygame.key.name(Key.undo_editing_surface_modification))
+    print(" - redo editing surface modification (In normal mode): ", pygame.key.name(Key.redo_editing_surface_modification))
     print(" - save current layer (In normal mode): ", pygame.key.name(Key.save_current_layer_surface))
     print(" - pick current hovered color (In normal mode): ", pygame.key.name(Key.pick_color))
     print(" - confirm (In any mode, used for prompts): ", pygame.key.name(Key.confirm))
     print(" - fill bucket paint brush (In normal mode): " , pygame.key.name(Key.fill_bucket))
     print(" - toggle grid lines (In normal mode): ", pygame.key.name(Key.toggle_grid_lines))
+    print(" - toggle frame profiler overlay (In normal mode): ", pygame.key.name(Key.toggle_profiler_overlay))
+    print(" - toggle between all visible layers and the current layer alone (In normal mode): ", pygame.key.name(Key.toggle_layer_composite))
     print(" - quit program without saving (or save warning) (In normal mode): ", pygame.key.name(Key.quit))
 
 input_layer_filepaths = []
@@ -261,30 +247,57 @@ def callback_image_layer_command_new(args: list[str]) -> None:
         write_str_to_text_buffer("Missing argument(s): <PATH> ...", True)
         return
     for arg in args:
+        if (raw_layer.is_raw_layer_path(arg) and os.path.exists(arg)):
+            write_str_to_text_buffer(f"Error: '{arg}' exists, load it with l", True)
+            continue
         log.output(logger.LOG_level("INFO"), f"Adding a new layer through the layer manger with the path of '{arg}'")
-        add_layer(arg, State.default_surface.copy())
+        layers.add_layer(arg, make_default_layer_surface(arg))
+def callback_image_layer_command_new_tiled(args: list[str]) -> None:
+    if len(args) < 2:
+        write_str_to_text_buffer("Missing argument(s): <WIDTH>x<HEIGHT> <PATH> ...", True)
+        return
+    size_args = args[0].lower().split("x")
+    if (len(size_args) != 2 or not size_args[0].isdigit() or not size_args[1].isdigit() or int(size_args[0]) < 1 or int(size_args[1]) < 1):
+        write_str_to_text_buffer("Error: size should be <WIDTH>x<HEIGHT>", True)
+        return
+    for arg in args[1:]:
+        log.output(logger.LOG_level("INFO"), f"Adding a new {args[0]} tiled layer through the layer manger with the path of '{arg}'")
+        layers.add_layer(arg, TiledCanvas((int(size_args[0]), int(size_args[1])), State.default_surface_color))
 def callback_image_layer_command_load(args: list[str]) -> None:
     global log
     if len(args) == 0:
         write_str_to_text_buffer("Missing argument(s): <PATH> ...", True)
         return
+    layer_paths = set(input_layer_filepaths)
     for arg in args:
-        log.output(logger.LOG_level("INFO"), f"Attempting to load in image '{arg}'")
-        loaded_surface, status, message = load_image(arg)
-        log.output(logger.LOG_level("INFO"), f"Load states: status: {status}, message: {message}")
-        if status != ImageLoadStates.NO_ERROR:
-            write_str_to_text_buffer(f"Failed image load: {message}", True)
+        if (arg in layer_paths):
+            write_str_to_text_buffer(f"Error: '{arg}' is already a layer", True)
+            continue
+        layer_paths.add(arg)
+        if (raw_layer.is_raw_layer_path(arg) or not os.path.isfile(arg)):
+            # Mapping a raw layer file costs nothing, only image files are decoded in the background
+            log.output(logger.LOG_level("INFO"), f"Attempting to load in image '{arg}'")
+            loaded_surface, status, message = load_image(arg)
+            log.output(logger.LOG_level("INFO"), f"Load states: status: {status}, message: {message}")
+            if status != ImageLoadStates.NO_ERROR:
+                write_str_to_text_buffer(f"Failed image load: {message}", True)
+                continue
+            layers.add_layer(arg, loaded_surface)
             continue
-        add_layer(arg, loaded_surface)
+        log.output(logger.LOG_level("INFO"), f"Queued image '{arg}' to be loaded in the background")
+        layers.add_layer(arg, State.default_surface.copy())
+        queue_layer_load(len(surface_layers)-1)
 def callback_image_layer_command_duplicate(args: list[str]) -> None:
     global log, surface_layers, input_layer_filepaths
     if len(args) == 0:
         write_str_to_text_buffer("Missing argument: <PATH> ...", True)
         return
+    if (is_cur_layer_loading()):
+        return
     current_image_surface = surface_layers[State.current_selected_surface_layer_index]
     for arg in args:
         log.output(logger.LOG_level("INFO"), f"Duplicating current image {input_layer_filepaths[State.current_selected_surface_layer_index]} to {arg}")
-        add_layer(arg, current_image_surface.copy())
+        layers.add_layer(arg, current_image_surface.copy(), per_layer_statistics[State.current_selected_surface_layer_index].copy())
 def callback_image_layer_command_rename(args: list[str]) -> None:
     global log, input_layer_filepaths
     if len(args) == 0:
@@ -293,6 +306,116 @@ def callback_image_layer_command_rename(args: list[str]) -> None:
     new_path = args[0]
     log.output(logger.LOG_level("INFO"), f"Renaming current image {input_layer_filepaths[State.current_selected_surface_layer_index]} to {new_path}")
     input_layer_filepaths[State.current_selected_surface_layer_index] = new_path
+    if (per_layer_load_states[State.current_selected_surface_layer_index] != ImageLoadStates.LOADING):
+        # Saving is no longer refused, the file that failed to load is not the one that would be overwritten
+        per_layer_load_states[State.current_selected_surface_layer_index] = ImageLoadStates.NO_ERROR
+
+def callback_image_layer_command_save_all(args: list[str]) -> None:
+    started_save_count = 0
+    for layer_index in range(len(surface_layers)):
+        if not is_layer_unsaved(layer_index):
+            continue
+        save_refused_reason = start_layer_save(layer_index)
+        if (save_refused_reason != None):
+            log.output(logger.LOG_level("WARNING"), f"Not saving layer {layer_index}, {save_refused_reason}")
+            continue
+        started_save_count += 1
+    write_str_to_text_buffer(f"Saving {started_save_count} layers" if started_save_count > 0 else "No unsaved layers", True)
+
+def get_layer_index_arg(args: list[str], arg_index: int) -> int or None:
+    '''
+    The layer index in args[arg_index], or the current layer when args is shorter. None (after writing an error) when it is not a layer.
+    '''
+    if (len(args) <= arg_index):
+        return State.current_selected_surface_layer_index
+    if not args[arg_index].isdigit() or int(args[arg_index]) >= len(surface_layers):
+        write_str_to_text_buffer("Error: layer index out of bound", True)
+        return None
+    return int(args[arg_index])
+
+def callback_image_layer_command_statistics(args: list[str]) -> None:
+    layer_index = get_layer_index_arg(args, 0)
+    if (layer_index == None):
+        return
+    layer_statistics = layers.get_statistics(layer_index)
+    average_color = layer_statistics.get_average_color()
+    write_str_to_text_buffer(
+        f"{surface_layers[layer_index].get_width()}x{surface_layers[layer_index].get_height()} " +
+        f"{layer_statistics.get_unique_color_count()} colors " +
+        f"avg {average_color[0]}r{average_color[1]}g{average_color[2]}b{average_color[3]}a",
+        True
+    )
+
+def callback_image_layer_command_visibility(args: list[str]) -> None:
+    layer_index = get_layer_index_arg(args, 0)
+    if (layer_index == None):
+        return
+    per_layer_visibilities[layer_index] = not per_layer_visibilities[layer_index]
+    write_str_to_text_buffer(f"Layer {layer_index} {'shown' if per_layer_visibilities[layer_index] else 'hidden'}", True)
+
+def callback_image_layer_command_opacity(args: list[str]) -> None:
+    if (len(args) == 0 or not args[0].isdigit() or int(args[0]) > 255):
+        write_str_to_text_buffer("Error: opacity should be 0 to 255", True)
+        return
+    layer_index = get_layer_index_arg(args, 1)
+    if (layer_index == None):
+        return
+    per_layer_opacities[layer_index] = int(args[0])
+    write_str_to_text_buffer(f"Layer {layer_index} opacity {per_layer_opacities[layer_index]}", True)
+
+def callback_image_layer_command_storage(args: list[str]) -> None:
+    if (len(args) == 0 or args[0] not in ("indexed", "rgba")):
+        write_str_to_text_buffer("Error: storage should be indexed or rgba", True)
+        return
+    layer_index = get_layer_index_arg(args, 1)
+    if (layer_index == None):
+        return
+    if (per_layer_load_states[layer_index] == ImageLoadStates.LOADING):
+        write_str_to_text_buffer("Layer is still loading", True)
+        return
+    storage_error_string = layers.set_indexed(layer_index, args[0] == "indexed")
+    if (storage_error_string != ""):
+        write_str_to_text_buffer(f"Error: {storage_error_string}", True)
+        return
+    write_str_to_text_buffer(f"Layer {layer_index} stored as {args[0]}", True)
+
+def callback_image_layer_command_palette(args: list[str]) -> None:
+    if (len(args) == 0 or not args[0].isdigit()):
+        write_str_to_text_buffer("Missing argument: <ENTRY>", True)
+        return
+    if (is_cur_layer_loading()):
+        return
+    layer_surface = surface_layers[State.current_selected_surface_layer_index]
+    palette_index = int(args[0])
+    entry_color = buffer_colors[current_buffer_colors_index]
+    if (len(args) > 1 and indexed_layer.is_indexed(layer_surface) and palette_index < len(layer_surface.get_palette())):
+        # Channels not typed keep the colour the entry has
+        entry_color = input_parsing.parse_color_input(args[1], indexed_layer.get_palette_colors(layer_surface)[palette_index])
+    palette_error_string = layers.set_palette_color(State.current_selected_surface_layer_index, palette_index, entry_color)
+    if (palette_error_string != ""):
+        write_str_to_text_buffer(f"Error: {palette_error_string}", True)
+        return
+    write_str_to_text_buffer(f"Palette entry {palette_index} set to {entry_color[0]}r{entry_color[1]}g{entry_color[2]}b{entry_color[3]}a", True)
+
+def callback_image_layer_command_export(args: list[str]) -> None:
+    if len(args) == 0:
+        write_str_to_text_buffer("Missing argument: <PATH>", True)
+        return
+    loading_layer_count = sum(1 for layer_index in range(len(surface_layers)) if per_layer_visibilities[layer_index] and per_layer_load_states[layer_index] == ImageLoadStates.LOADING)
+    if (loading_layer_count > 0):
+        write_str_to_text_buffer(f"{loading_layer_count} visible layers still loading", True)
+        return
+    start_image_export(args[0])
+
+def callback_image_layer_command_blend_mode(args: list[str]) -> None:
+    if (len(args) == 0 or args[0] not in compositor.BLEND_MODES):
+        write_str_to_text_buffer(f"Error: blend mode should be one of {', '.join(compositor.BLEND_MODES)}", True)
+        return
+    layer_index = get_layer_index_arg(args, 1)
+    if (layer_index == None):
+        return
+    per_layer_blend_modes[layer_index] = args[0]
+    write_str_to_text_buffer(f"Layer {layer_index} blend mode {args[0]}", True)
 
 image_layer_commands: list[ImageLayerCommand] = []
 image_layer_commands.append(ImageLayerCommand("h", "List all commands", None))
@@ -310,7 +433,11 @@ image_layer_commands.append(
         callback_image_layer_command_new)
 )
 image_layer_commands.append(
-    ImageLayerCommand("l", "Load image",
+    ImageLayerCommand("t", "New tiled image, for very large images <WIDTH>x<HEIGHT>",
+        callback_image_layer_command_new_tiled)
+)
+image_layer_commands.append(
+    ImageLayerCommand("l", "Load image, decoded in the background",
         callback_image_layer_command_load)
 )
 image_layer_commands.append(
@@ -321,6 +448,38 @@ image_layer_commands.append(
     ImageLayerCommand("r", "Change layer path",
         callback_image_layer_command_rename)
 )
+image_layer_commands.append(
+    ImageLayerCommand("w", "Save every layer with unsaved changes",
+        callback_image_layer_command_save_all)
+)
+image_layer_commands.append(
+    ImageLayerCommand("s", "Layer statistics (unique colors, average color) [INDEX]",
+        callback_image_layer_command_statistics)
+)
+image_layer_commands.append(
+    ImageLayerCommand("v", "Show or hide a layer [INDEX]",
+        callback_image_layer_command_visibility)
+)
+image_layer_commands.append(
+    ImageLayerCommand("o", "Set layer opacity <0-255> [INDEX]",
+        callback_image_layer_command_opacity)
+)
+image_layer_commands.append(
+    ImageLayerCommand("b", f"Set layer blend mode <{'|'.join(compositor.BLEND_MODES)}> [INDEX]",
+        callback_image_layer_command_blend_mode)
+)
+image_layer_commands.append(
+    ImageLayerCommand("m", "Store a layer as palette indices, up to 256 colors, or as RGBA <indexed|rgba> [INDEX]",
+        callback_image_layer_command_storage)
+)
+image_layer_commands.append(
+    ImageLayerCommand("p", "Set a palette entry of an indexed layer, to the current color when no color is given <ENTRY> [COLOR]",
+        callback_image_layer_command_palette)
+)
+image_layer_commands.append(
+    ImageLayerCommand("e", "Export the visible layers, blended, as one image <PATH>",
+        callback_image_layer_command_export)
+)
 
 def get_help_page_image_layer_commands() -> list[str]:
     return [f"{cmd.get_name()} - {cmd.get_description()}" for cmd in image_layer_commands]
@@ -350,39 +509,92 @@ if (argc > 1):
         print(f"Options:")
         print(f"  --key-bindings      - output key bindings and exit")
         print(f"  --image-layer-cmds  - output image layer commands")
+        print(f"  --log-file <FILE>   - also write log lines to FILE, rotated at {LOG_FILE_MAX_BYTES//(1024*1024)}MiB")
+        print(f"  --no-log-stdout     - do not print log lines to the terminal")
+        print(f"  --undo-memory <MiB> - memory each layers undo history may use before moving to temporary files (default {State.max_undo_ram_bytes//(1024*1024)})")
+        print(f"  --tiled             - load images as tiled layers, only the parts drawn on are kept in memory")
+        print(f"  --crash-log <FILE>  - where the recent log lines are written if the program exits on an error (default {CRASH_LOG_DEFAULT_PATH})")
+        print(f"  --profile-trace <FILE> - write the time of every main loop phase to FILE, in the Chrome trace format (chrome://tracing, Perfetto)")
+        print(f"  --record <FILE>     - record the input of each frame to FILE, to replay later")
+        print(f"  --replay <FILE>     - run the input recorded in FILE as fast as possible, then print timings and exit")
+        print(f"  --replay-realtime   - replay at the speed the input was recorded at")
+        print(f"  --headless          - replay without opening a window")
+        print(f"  --hide              - hide the layer of the next FILE")
+        print(f"  --opacity <0-255>   - opacity of the layer of the next FILE")
+        print(f"  --blend <MODE>      - blend mode of the layer of the next FILE, {'|'.join(compositor.BLEND_MODES)}")
+        print(f"  --export <FILE>     - flatten the visible layers of the files given into FILE and exit, without opening a window")
         print(f"Note:")
         print(f"  - Any arguments past a '--' argument would only be considered as a file")
+        print(f"  - Replay with the same files, in the same state, as when recording, to get the same edits")
+        print(f"  - '--export out.png base.png --blend multiply --opacity 128 shade.png' flattens without loading the layers into the editor")
+        print(f"  - To run edits over many files without a window, see 'python3 batch.py --help'")
         sys.exit()
     if (argv[1] == "--version"):
         print(f"VERSION: {VERSION_MAJOR}.{VERSION_MINOR}.{VERSION_PATCH}")
         sys.exit()
 
-class ImageLoadStates:
-    NO_ERROR = 0
-    NOT_FOUND = 1
-    PYGAME_ERROR = 2
-def load_image(path: str) -> (Surface or None, ImageLoadStates, str):
-    try:
-        surface = pygame.image.load(path)
-    except FileNotFoundError:
-        return None, ImageLoadStates.NOT_FOUND, f"Could not load file '{path}'"
-    except pygame.error:
-        return None, ImageLoadStates.PYGAME_ERROR, f"Pygame could not load in the image file '{path}', {sys.exc_info()[1]}"
-    return surface, ImageLoadStates.NO_ERROR, ""
+open_raw_layer_files: dict[str, raw_layer.RawLayerFile] = {} # by path, raw layer files mapped as layer surfaces
+def load_image(path: str) -> (Surface or TiledCanvas or None, ImageLoadStates, str):
+    '''
+    Loads a TiledCanvas instead of a Surface when State.load_layers_tiled is set.
+    Raw layer files (raw_layer.RAW_LAYER_EXTENSION) are mapped, not read, and are never tiled.
+    '''
+    if (raw_layer.is_raw_layer_path(path)):
+        try:
+            raw_layer_file = raw_layer.RawLayerFile(path)
+        except FileNotFoundError:
+            return None, ImageLoadStates.NOT_FOUND, f"Could not load file '{path}'"
+        except (OSError, raw_layer.RawLayerFormatError):
+            return None, ImageLoadStates.FORMAT_ERROR, f"Could not open the raw layer file '{path}', {sys.exc_info()[1]}"
+        open_raw_layer_files[path] = raw_layer_file
+        return raw_layer_file.surface, ImageLoadStates.NO_ERROR, ""
+    return layer_io.load_image_file(path, State.load_layers_tiled)
+
+def make_default_layer_surface(path: str) -> Surface or TiledCanvas:
+    '''
+    New layer for path. For a raw layer path the file is made straight away, it is what holds the pixels.
+    '''
+    if (raw_layer.is_raw_layer_path(path)):
+        raw_layer_file = raw_layer.create_raw_layer(path, State.default_surface.get_size(), State.default_surface_color)
+        open_raw_layer_files[path] = raw_layer_file
+        return raw_layer_file.surface
+    if (State.load_layers_tiled):
+        return TiledCanvas(State.default_surface.get_size(), State.default_surface_color)
+    return State.default_surface.copy()
 
 def assume_or_exception(condition: bool) -> None:
     if (not condition):
         Exception(f"Assumption not met")
 
+def is_layer_unsaved(layer_index: int) -> bool:
+    '''
+    A layer is unsaved when it changed since the revision last saved, or being saved now.
+    '''
+    layer_revision = per_layer_revisions[layer_index]
+    return layer_revision != per_layer_saved_revisions[layer_index] and layer_revision != saving_layer_revisions.get(layer_index)
+
 def get_unsaved_images_count() -> int:
     unsaved_images_count = 0
-    for image in image_objs:
-        if image.has_unsaved_changes:
+    for layer_index in range(len(surface_layers)):
+        if is_layer_unsaved(layer_index):
             unsaved_images_count += 1
     return unsaved_images_count
 
+main_loop_profiler = frame_profiler.FrameProfiler()
+input_recording_path = None
+input_player: input_recording.InputPlayer = None
+replay_realtime = False
+headless = False
+export_path = None
+input_layer_settings = [] # (visible, opacity, blend mode) of each file given, set by the options before the file
+next_layer_visible = True
+next_layer_opacity = 255
+next_layer_blend_mode = compositor.BLEND_MODE_NORMAL
+next_layer_settings_given = False
+
 arg_skip_count = 0
 cli_error_count = 0
+crash_log_path = CRASH_LOG_DEFAULT_PATH
 cli_only_files_remain = False
 for arg_index in range(1, argc):
     if (arg_skip_count > 0):
@@ -399,36 +611,156 @@ for arg_index in range(1, argc):
     elif (arg == "--image-layer-cmds" and not cli_only_files_remain):
         print_image_layer_commands()
         sys.exit()
+    elif (arg == "--log-file" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            log.set_file_output(argv[arg_index+1], max_bytes=LOG_FILE_MAX_BYTES)
+            arg_skip_count = 1
+    elif (arg == "--no-log-stdout" and not cli_only_files_remain):
+        log.set_stdout_output(False)
+    elif (arg == "--undo-memory" and not cli_only_files_remain):
+        if (arg_index+1 >= argc or not argv[arg_index+1].isdigit()):
+            print(f"[{arg_index}] argument {arg} expects a whole number of MiB after it")
+            cli_error_count += 1
+        else:
+            State.max_undo_ram_bytes = int(argv[arg_index+1])*1024*1024
+            arg_skip_count = 1
+    elif (arg == "--tiled" and not cli_only_files_remain):
+        State.load_layers_tiled = True
+    elif (arg == "--crash-log" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            crash_log_path = argv[arg_index+1]
+            arg_skip_count = 1
+    elif (arg == "--profile-trace" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            try:
+                main_loop_profiler.set_trace_output(argv[arg_index+1])
+            except OSError:
+                print(f"[{arg_index}] could not open the trace file '{argv[arg_index+1]}', {sys.exc_info()[1]}")
+                cli_error_count += 1
+            arg_skip_count = 1
+    elif (arg == "--record" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            input_recording_path = argv[arg_index+1]
+            arg_skip_count = 1
+    elif (arg == "--replay" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            try:
+                input_player = input_recording.InputPlayer(argv[arg_index+1])
+            except (OSError, input_recording.InputRecordingFormatError):
+                print(f"[{arg_index}] could not read the input recording '{argv[arg_index+1]}', {sys.exc_info()[1]}")
+                cli_error_count += 1
+            arg_skip_count = 1
+    elif (arg == "--replay-realtime" and not cli_only_files_remain):
+        replay_realtime = True
+    elif (arg == "--headless" and not cli_only_files_remain):
+        headless = True
+    elif (arg == "--export" and not cli_only_files_remain):
+        if (arg_index+1 >= argc):
+            print(f"[{arg_index}] argument {arg} expects a file path after it")
+            cli_error_count += 1
+        else:
+            export_path = argv[arg_index+1]
+            arg_skip_count = 1
+    elif (arg == "--hide" and not cli_only_files_remain):
+        next_layer_visible = False
+        next_layer_settings_given = True
+    elif (arg == "--opacity" and not cli_only_files_remain):
+        if (arg_index+1 >= argc or not argv[arg_index+1].isdigit() or int(argv[arg_index+1]) > 255):
+            print(f"[{arg_index}] argument {arg} expects an opacity from 0 to 255 after it")
+            cli_error_count += 1
+        else:
+            next_layer_opacity = int(argv[arg_index+1])
+            next_layer_settings_given = True
+            arg_skip_count = 1
+    elif (arg == "--blend" and not cli_only_files_remain):
+        if (arg_index+1 >= argc or argv[arg_index+1] not in compositor.BLEND_MODES):
+            print(f"[{arg_index}] argument {arg} expects one of {', '.join(compositor.BLEND_MODES)} after it")
+            cli_error_count += 1
+        else:
+            next_layer_blend_mode = argv[arg_index+1]
+            next_layer_settings_given = True
+            arg_skip_count = 1
     elif (arg[:2] == "--" and not cli_only_files_remain):
         print(f"[{arg_index}] argument {arg} is not recognised")
         cli_error_count += 1
     else:
         # is a file path
         input_layer_filepaths.append(arg)
+        input_layer_settings.append((next_layer_visible, next_layer_opacity, next_layer_blend_mode))
+        next_layer_visible, next_layer_opacity, next_layer_blend_mode = True, 255, compositor.BLEND_MODE_NORMAL
+        next_layer_settings_given = False
+
+log.enable_crash_dump(crash_log_path)
+
+if (input_recording_path != None and input_player != None):
+    print("Cannot record and replay at the same time")
+    cli_error_count += 1
+if ((replay_realtime or headless) and input_player == None):
+    print("--replay-realtime and --headless only apply with --replay")
+    cli_error_count += 1
+if (next_layer_settings_given):
+    print("--hide, --opacity and --blend apply to the file after them, but no file follows")
+    cli_error_count += 1
+if (export_path != None and (input_recording_path != None or input_player != None)):
+    print("Cannot export and record or replay at the same time")
+    cli_error_count += 1
+if (export_path != None and len(input_layer_filepaths) == 0):
+    print("--export needs the files of the layers to flatten")
+    cli_error_count += 1
 
 if (cli_error_count > 0):
     sys.exit(f"Exiting. {cli_error_count} error(s) occured")
 del cli_error_count
 
+if (export_path != None):
+    # The layers are flattened straight from their files, the editor is never started
+    export_start_time = time.perf_counter()
+    export_size, error_string = layer_export.export_layer_files([(input_filepath, *layer_settings) for input_filepath, layer_settings in zip(input_layer_filepaths, input_layer_settings)], export_path)
+    if (export_size == None):
+        sys.exit(f"Exiting. {error_string}")
+    print(f"Exported {len(input_layer_filepaths)} layers, {export_size[0]}x{export_size[1]}, to '{export_path}' in {time.perf_counter()-export_start_time:.3f}s")
+    log.mark_clean_exit()
+    sys.exit()
+
 load_file_error_count = 0
-handled_filepaths = []
+handled_filepaths = set()
+queued_layer_load_indices = [] # layers given a placeholder surface, decoded once the window is up
 for input_filepath in input_layer_filepaths:
+    if (input_filepath in handled_filepaths):
+        print(f"Layers cannot have the same file paths, path '{input_filepath}'")
+        load_file_error_count += 1
+        continue
+    handled_filepaths.add(input_filepath)
+    if (not raw_layer.is_raw_layer_path(input_filepath) and os.path.isfile(input_filepath)):
+        queued_layer_load_indices.append(len(surface_layers))
+        surface_layers.append(State.default_surface.copy())
+        continue
     input_surface, status, message = load_image(input_filepath)
     if status == ImageLoadStates.NOT_FOUND:
         print(message)
         input_surface = None
-    elif status == ImageLoadStates.PYGAME_ERROR:
+    elif status == ImageLoadStates.PYGAME_ERROR or status == ImageLoadStates.FORMAT_ERROR:
         print(message)
         load_file_error_count += 1
         continue
-    if (input_filepath in handled_filepaths):
-        print(f"Layers cannot have the same file paths, path '{input_filepath}'")
-        load_file_error_count += 1
-        continue
-    handled_filepaths.append(input_filepath)
     if (input_surface == None):
         print(f"Making a new image surface for layer '{input_filepath}'")
-        input_surface = State.default_surface.copy()
+        input_surface = make_default_layer_surface(input_filepath)
     surface_layers.append(input_surface)
 if (load_file_error_count > 0):
     sys.exit(f"Exiting. {load_file_error_count} error(s) occured when loading image files from disk")
@@ -439,7 +771,7 @@ assume_or_exception(len(input_layer_filepaths) == len(surface_layers))
 if (len(input_layer_filepaths) == 0):
     default_image_path: str = "a.png"
     print(f"No input image files given. Loading a default surface. Setting output file to '{default_image_path}'.")
-    image_surface = State.default_surface.copy()
+    image_surface = make_default_layer_surface(default_image_path)
     if os.path.isfile(default_image_path):
         loaded_surface, error_type, error_string = load_image(default_image_path)
         if loaded_surface != None:
@@ -447,16 +779,197 @@ if (len(input_layer_filepaths) == 0):
     surface_layers.append(image_surface)
     input_layer_filepaths.append(default_image_path)
 
-per_layer_undo_objects = [[]] * len(input_layer_filepaths)
-log.output(logger.LOG_level("INFO"), f"per_layer_undo_objects: {per_layer_undo_objects}")
-
-def add_layer(path: str, surface: Surface) -> None:
-    global surface_layers, input_layer_filepaths, per_layer_undo_objects
-    log.output(logger.LOG_level("INFO"), f"Attempting to add new layer path:'{path}' surface:{surface}")
-    input_layer_filepaths.append(path)
-    surface_layers.append(surface)
-    per_layer_undo_objects.append([])
-    log.output(logger.LOG_level("INFO"), f"Successfully added new layer")
+layers = LayerStack(log, State.max_undo_bytes, State.max_undo_ram_bytes, State.max_surface_layer_pixels)
+for input_filepath, input_surface in zip(input_layer_filepaths, surface_layers):
+    layers.add_layer(input_filepath, input_surface)
+# The per layer lists of the layer stack, under the names the rest of the editor uses
+input_layer_filepaths = layers.file_paths
+surface_layers = layers.surfaces
+per_layer_history = layers.histories
+per_layer_revisions = layers.revisions
+per_layer_mipmaps = layers.mipmaps
+per_layer_statistics = layers.statistics
+per_layer_load_states = layers.load_states
+per_layer_saved_revisions = layers.saved_revisions
+per_layer_visibilities = layers.visibilities
+per_layer_opacities = layers.opacities
+per_layer_blend_modes = layers.blend_modes
+for layer_index, (layer_visible, layer_opacity, layer_blend_mode) in enumerate(input_layer_settings):
+    per_layer_visibilities[layer_index] = layer_visible
+    per_layer_opacities[layer_index] = layer_opacity
+    per_layer_blend_modes[layer_index] = layer_blend_mode
+layer_compositor = compositor.LayerCompositor(layers)
+saving_layer_revisions: dict[int, int] = {} # {layer index: revision being saved}, for the layers with a save running
+image_load_tasks = background_tasks.BackgroundTasks()
+layer_save_tasks = background_tasks.BackgroundTasks()
+image_export_tasks = background_tasks.BackgroundTasks(max_workers=1) # each export spreads its own encoding over every CPU
+
+def queue_layer_load(layer_index: int) -> None:
+    '''
+    Decode the image file of a layer in the background, its surface is a placeholder until finish_layer_loads swaps the pixels in.
+    The placeholder surface is the task key, so the layer is still found if its path is changed while loading.
+    '''
+    per_layer_load_states[layer_index] = ImageLoadStates.LOADING
+    State.image_load_queued_count += 1
+    image_load_tasks.submit(surface_layers[layer_index], layer_io.load_image_file, input_layer_filepaths[layer_index], State.load_layers_tiled)
+
+def finish_layer_loads() -> None:
+    '''
+    Swap in the pixels of every image decoded since the last call, and show the loading progress. Called once a frame.
+    '''
+    finished_loads = image_load_tasks.poll()
+    if (len(finished_loads) == 0):
+        return
+    for placeholder_surface, load_result, exception in finished_loads:
+        layer_index = next(index for index, surface in enumerate(surface_layers) if surface is placeholder_surface)
+        if (exception != None):
+            load_result = (None, ImageLoadStates.PYGAME_ERROR, f"Could not load file '{input_layer_filepaths[layer_index]}', {exception}")
+        loaded_surface, status, message = load_result
+        per_layer_load_states[layer_index] = status
+        if (status != ImageLoadStates.NO_ERROR):
+            State.image_load_failed_count += 1
+            log.output(logger.LOG_level("WARNING"), f"Failed image load: {message}")
+            continue
+        log.output(logger.LOG_level("INFO"), f"Loaded image '{input_layer_filepaths[layer_index]}' into layer {layer_index}")
+        surface_layers[layer_index] = loaded_surface
+        per_layer_revisions[layer_index] += 1
+        per_layer_saved_revisions[layer_index] = per_layer_revisions[layer_index]
+        per_layer_mipmaps[layer_index].set_surface(loaded_surface)
+        per_layer_statistics[layer_index].invalidate()
+        if (layer_index == State.current_selected_surface_layer_index):
+            State.editing_surface_modified_rects.append(None)
+    pending_count = image_load_tasks.get_pending_count()
+    failed_text = f", {State.image_load_failed_count} failed (see log)" if State.image_load_failed_count > 0 else ""
+    if (pending_count > 0):
+        progress_text = f"Loading images {State.image_load_queued_count-pending_count}/{State.image_load_queued_count}{failed_text}"
+    else:
+        progress_text = f"Loaded {State.image_load_queued_count} images{failed_text}"
+        State.image_load_queued_count = 0
+        State.image_load_failed_count = 0
+    if (Mode.current == Mode.NORMAL): # the other modes use the text buffer for input
+        write_str_to_text_buffer(progress_text, True)
+
+def is_cur_layer_loading() -> bool:
+    '''
+    Edits to a layer that is still loading would be lost when its pixels are swapped in, so they are refused.
+    '''
+    if (per_layer_load_states[State.current_selected_surface_layer_index] != ImageLoadStates.LOADING):
+        return False
+    write_str_to_text_buffer("Layer is still loading", True)
+    return True
+
+for queued_layer_index in queued_layer_load_indices:
+    queue_layer_load(queued_layer_index)
+del queued_layer_load_indices
+
+def start_layer_save(layer_index: int) -> str or None:
+    '''
+    Take a snapshot of the layer, and write it on a save worker. Returns why the save was refused, None when it was started.
+    A layer still mapped from its raw layer file is not copied, the file is the layer, only the pages it changed are flushed.
+    '''
+    layer_path = input_layer_filepaths[layer_index]
+    if (per_layer_load_states[layer_index] == ImageLoadStates.LOADING):
+        return f"'{layer_path}' is still loading"
+    if (per_layer_load_states[layer_index] != ImageLoadStates.NO_ERROR):
+        # Would overwrite the file that failed to load with the placeholder
+        return f"'{layer_path}' failed to load, change its path to save"
+    if (layer_index in saving_layer_revisions):
+        return f"'{layer_path}' is still being saved"
+    layer_surface = surface_layers[layer_index]
+    raw_layer_file = open_raw_layer_files.get(layer_path)
+    if (raw_layer.is_raw_layer_path(layer_path) and raw_layer_file != None and raw_layer_file.surface is layer_surface):
+        save_function, save_args = raw_layer_file.flush, ()
+    else:
+        save_function, save_args = layer_io.write_layer_file, (layer_surface.copy(), layer_path)
+    log.output(logger.LOG_level("INFO"), f"Saving layer {layer_index} to '{layer_path}' in the background")
+    saving_layer_revisions[layer_index] = per_layer_revisions[layer_index]
+    State.layer_save_queued_count += 1
+    layer_save_tasks.submit((layer_index, layer_path), save_function, *save_args)
+    return None
+
+def finish_layer_saves() -> None:
+    '''
+    Mark the layers saved since the last call as saved, and show the saving progress. Called once a frame.
+    '''
+    finished_saves = layer_save_tasks.poll()
+    if (len(finished_saves) == 0):
+        return
+    for (layer_index, layer_path), _, exception in finished_saves:
+        saved_revision = saving_layer_revisions.pop(layer_index)
+        if (exception != None):
+            State.layer_save_failed_count += 1
+            log.output(logger.LOG_level("WARNING"), f"Failed to save layer {layer_index} to '{layer_path}', {exception}")
+            continue
+        per_layer_saved_revisions[layer_index] = saved_revision
+        log.output(logger.LOG_level("INFO"), f"Saved layer {layer_index} to '{layer_path}'")
+    pending_count = layer_save_tasks.get_pending_count()
+    failed_text = f", {State.layer_save_failed_count} failed (see log)" if State.layer_save_failed_count > 0 else ""
+    if (pending_count > 0):
+        progress_text = f"Saving layers {State.layer_save_queued_count-pending_count}/{State.layer_save_queued_count}{failed_text}"
+    elif (State.layer_save_queued_count == 1):
+        progress_text = f"Saved '{layer_path}'" if State.layer_save_failed_count == 0 else f"Failed to save '{layer_path}' (see log)"
+    else:
+        progress_text = f"Saved {State.layer_save_queued_count-State.layer_save_failed_count} layers{failed_text}"
+    if (pending_count == 0):
+        State.layer_save_queued_count = 0
+        State.layer_save_failed_count = 0
+    if (Mode.current == Mode.NORMAL): # the other modes use the text buffer for input
+        write_str_to_text_buffer(progress_text, True)
+
+def start_image_export(export_path: str) -> None:
+    '''
+    Blend what changed of the composite of the visible layers, and write a snapshot of it on the export worker.
+    The snapshot is the size of one layer however many layers there are. PNG files are deflated on every CPU (see png_writer).
+    '''
+    composite_changed_rects = layer_compositor.update()
+    if (State.display_layer_composite):
+        State.editing_surface_modified_rects += composite_changed_rects
+    view_surface, _, _ = layer_compositor.get_view()
+    export_snapshot = view_surface.copy() if isinstance(view_surface, TiledCanvas) else TiledCanvas.from_surface(view_surface)
+    log.output(logger.LOG_level("INFO"), f"Exporting the visible layers to '{export_path}' in the background")
+    image_export_tasks.submit(export_path, layer_io.write_layer_file, export_snapshot, export_path)
+    write_str_to_text_buffer(f"Exporting '{export_path}'", True)
+
+def finish_image_exports() -> None:
+    '''
+    Show the exports finished since the last call. Called once a frame.
+    '''
+    for export_path, _, exception in image_export_tasks.poll():
+        if (exception != None):
+            log.output(logger.LOG_level("WARNING"), f"Failed to export '{export_path}', {exception}")
+            progress_text = f"Failed to export '{export_path}' (see log)"
+        else:
+            log.output(logger.LOG_level("INFO"), f"Exported '{export_path}'")
+            progress_text = f"Exported '{export_path}'"
+        if (Mode.current == Mode.NORMAL): # the other modes use the text buffer for input
+            write_str_to_text_buffer(progress_text, True)
+
+def on_layer_modified(layer_index: int, modified_rect: Rect = None) -> None:
+    State.quit_warning_given = False
+    layer_compositor.mark_dirty(layer_index, modified_rect)
+    if (not State.display_layer_composite and layer_index == State.current_selected_surface_layer_index):
+        State.editing_surface_modified_rects.append(modified_rect)
+layers.modified_callback = on_layer_modified
+
+def paint_stroke_cur_layer(screen_positions: list, color: pygame.Color) -> None:
+    '''
+    Continue the current stroke through every screen position, joining them with lines so the stroke has no gaps.
+    '''
+    layer_points = [mouse_pos_on_cur_image_layer(screen_position) for screen_position in screen_positions]
+    layers.paint_stroke(State.current_selected_surface_layer_index, layer_points, color, State.brush)
+
+def zoom_editing_surface(steps: int) -> None:
+    '''
+    Zoom in whole steps above a zoom of 1, and by powers of 2 below it. Used to zoom out on large layers.
+    '''
+    for _ in range(abs(steps)):
+        if (steps > 0):
+            new_zoom = State.editing_surface_zoom + 1 if State.editing_surface_zoom >= 1 else State.editing_surface_zoom*2
+        else:
+            new_zoom = State.editing_surface_zoom - 1 if State.editing_surface_zoom > 1 else State.editing_surface_zoom/2
+        if not (State.min_editing_surface_zoom <= new_zoom <= State.max_editing_surface_zoom):
+            return
+        State.editing_surface_zoom = new_zoom
 
 def get_mode_type_code_to_str(mode_type_code):
     if (mode_type_code == Mode.NORMAL):
@@ -471,133 +984,37 @@ def get_mode_type_code_to_str(mode_type_code):
         return "resize surface"
     elif (mode_type_code == Mode.LAYERS):
         return "layers management"
+    elif (mode_type_code == Mode.BRUSH):
+        return "brush"
     else:
         return "unknown"
 
-def paint_tool_bucket(surface: pygame.Surface, start_point: pygame.math.Vector2, new_color: pygame.Color, mask: pygame.Mask=None) -> pygame.Mask:
-    if (mask != None):
-        assume_or_exception(surface.get_size() != mask.get_size())
-    log.output(logger.LOG_level("INFO"), f"Paint bucket started to draw, mask={mask}")
-    fill_mask = pygame.Mask(surface.get_size())
-    fill_mask.clear()
-    have_been_stack = [(start_point.x, start_point.y)]
-    try:
-        search_color = surface.get_at((start_point.x, start_point.y))
-    except IndexError:
-        log.output(logger.LOG_level("WARNING"), "Position given is invalid")
-        return None
-    if (search_color == new_color):
-        log.output(logger.LOG_level("WARNING"), "Search color and new color are the same")
-        return None
-    surface.set_at(start_point, new_color)
-    # debug
-    visited = [(start_point.x, start_point.y)]
-    # /debug
-    while len(have_been_stack) != 0:
-        log.output(logger.LOG_level("INFO"), f"\n{len(have_been_stack)} elements in the have_been_visited_stack")
-        current_pixel_pos = have_been_stack[-1]
-        # debug
-        #log.output(logger.LOG_level("INFO"), f"stack={have_been_stack}")
-        visited.append(current_pixel_pos)
-        if (visited.count(current_pixel_pos) > 50): # worringly large number of occurances
-            # potentially stuck in a loop
-            log.output(logger.LOG_level("ERROR"), f"pixel {current_pixel_pos} has been visited more than 50 times")
-            log.output(logger.LOG_level("INFO"), f"output current image state to ./a-debug.png")
-            pygame.image.save(surface, "./a-debug.png")
-            sys.exit(1)
-        # /debug
-        if (current_pixel_pos[0]-1 >= 0):
-            search_pixel_pos = (current_pixel_pos[0]-1, current_pixel_pos[1])
-            log.output(logger.LOG_level("INFO"), f"left pixel color = {surface.get_at(search_pixel_pos)}")
-            if (surface.get_at(search_pixel_pos) == search_color and not(search_pixel_pos in have_been_stack)):
-                if (mask == None or mask.get_at(search_pixel_pos)):
-                    surface.set_at(search_pixel_pos, new_color)
-                    fill_mask.set_at(search_pixel_pos, 1)
-                    have_been_stack.append(search_pixel_pos)
-                    log.output(logger.LOG_level("INFO"), f"Moved left")
-                    continue
-        if (current_pixel_pos[1]-1 >= 0):
-            search_pixel_pos = (current_pixel_pos[0], current_pixel_pos[1]-1)
-            log.output(logger.LOG_level("INFO"), f"up pixel color = {surface.get_at(search_pixel_pos)}")
-            if (surface.get_at(search_pixel_pos) == search_color and not(search_pixel_pos in have_been_stack)):
-                if (mask == None or mask.get_at(search_pixel_pos)):
-                    surface.set_at(search_pixel_pos, new_color)
-                    fill_mask.set_at(search_pixel_pos, 1)
-                    have_been_stack.append(search_pixel_pos)
-                    log.output(logger.LOG_level("INFO"), f"Moved up")
-                    continue
-        if (current_pixel_pos[0]+1 < surface.get_width()):
-            search_pixel_pos = (current_pixel_pos[0]+1, current_pixel_pos[1])
-            log.output(logger.LOG_level("INFO"), f"right pixel color = {surface.get_at(search_pixel_pos)}")
-            if (surface.get_at(search_pixel_pos) == search_color and not(search_pixel_pos in have_been_stack)):
-                if (mask == None or mask.get_at(search_pixel_pos)):
-                    surface.set_at(search_pixel_pos, new_color)
-                    fill_mask.set_at(search_pixel_pos, 1)
-                    have_been_stack.append(search_pixel_pos)
-                    log.output(logger.LOG_level("INFO"), f"Moved right")
-                    continue
-        if (current_pixel_pos[1]+1 < surface.get_height()):
-            search_pixel_pos = (current_pixel_pos[0], current_pixel_pos[1]+1)
-            log.output(logger.LOG_level("INFO"), f"down pixel color = {surface.get_at(search_pixel_pos)}")
-            if (surface.get_at(search_pixel_pos) == search_color and not(search_pixel_pos in have_been_stack)):
-                if (mask == None or mask.get_at(search_pixel_pos)):
-                    surface.set_at(search_pixel_pos, new_color)
-                    fill_mask.set_at(search_pixel_pos, 1)
-                    have_been_stack.append(search_pixel_pos)
-                    log.output(logger.LOG_level("INFO"), f"Moved down")
-                    continue
-        log.output(logger.LOG_level("INFO"), f"poped, moved back by one")
-        have_been_stack.pop()
-    log.output(logger.LOG_level("INFO"), "paint bucket has finished drawing")
-    return fill_mask
-
 buffer_colors = []
 current_buffer_colors_index = 0
 
 for _ in range(10):
     buffer_colors.append(pygame.Color(255, 255, 255, 255))
 
-class UndoObject:
-    def __init__(self):
-        pass
-class UndoSinglePixel(UndoObject):
-    def __init__(self, pixel_pos: pygame.math.Vector2, color: pygame.Color):
-        self.pixel_position = pixel_pos
-        self.color = color
-    def __str__(self):
-        return f"UndoSinglePixel(pixel_pos={self.pixel_position}, color={self.color})"
-class UndoBucketFill(UndoObject):
-    def __init__(self, pixel_pos: pygame.math.Vector2, old_color: pygame.Color, mask: pygame.Mask):
-        self.pixel_position: pygame.math.Vector2 = pygame.math.Vector2(pixel_pos)
-        self.old_color: pygame.Color = old_color
-        self.mask: pygame.Mask = mask
-    def __str__(self):
-        return f"UndoBucketFill(pixel_pos={self.pixel_position}, old_color={self.old_color}, mask:{self.mask})"
-class UndoResize(UndoObject):
-    def __init__(self, old_surface: pygame.Surface):
-        self.old_surface: pygame.Surface = old_surface
-    def __str__(self):
-        return f"UndoResize(old_surface={self.old_surface})"
-
-def add_undo_to_cur_layer(undo_object: UndoObject):
-    global per_layer_undo_objects
-    log.output(logger.LOG_level("INFO"), f"per_layer_undo_objects: {per_layer_undo_objects}, cur_sel_surf_layer_ind: {State.current_selected_surface_layer_index}")
-    per_layer_undo_objects[State.current_selected_surface_layer_index].append(undo_object)
-    if (len(per_layer_undo_objects[State.current_selected_surface_layer_index]) > State.max_undo_objects):
-        per_layer_undo_objects[State.current_selected_surface_layer_index].pop(0)
-def pop_undo_from_cur_layer() -> UndoObject: # Or return None when empty
-    global per_layer_undo_objects
-    if len(per_layer_undo_objects[State.current_selected_surface_layer_index]) == 0:
-        return None
-    return per_layer_undo_objects[State.current_selected_surface_layer_index].pop()
-
 display_color_rect_horizontal_gap = 5 # pixels
 display_color_rect_screen_verticle_gap = 10 # pixels
 
 app_text_background_alpha = 150
 
 screen_size = Vec2(640, 480)
+if (input_player != None):
+    screen_size = Vec2(input_player.window_size)
+if (headless):
+    # The video driver is picked when the display starts
+    pygame.display.quit()
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pygame.display.init()
 screen = pygame.display.set_mode(screen_size, pygame.RESIZABLE)
+input_recorder: input_recording.InputRecorder = None
+if (input_recording_path != None):
+    try:
+        input_recorder = input_recording.InputRecorder(input_recording_path, (int(screen_size[0]), int(screen_size[1])))
+    except OSError:
+        sys.exit(f"Exiting. Could not start the input recording '{input_recording_path}', {sys.exc_info()[1]}")
 editing_surface_screen_proportionality_xy = Vec2((screen_size[0]/640, screen_size[1]/480))
 
 bg_color = (100, 100, 100)
@@ -606,16 +1023,28 @@ app_text_background_color = (255 - app_text_color[0], 255 - app_text_color[1], 2
 max_fps = 60
 
 def camera_transform(vec2f_position):
-    return (vec2f_position[0] - State.camera_position[0] + screen_size[0]/2, vec2f_position[1] - State.camera_position[1] + screen_size[1]/2)
+    return render.world_to_screen(vec2f_position, State.camera_position, screen_size)
 
 def camera_reverse_transform(vec2f_position):
-    return (vec2f_position[0] + State.camera_position[0] - screen_size[0]/2, vec2f_position[1] + State.camera_position[1] - screen_size[1]/2)
+    return render.screen_to_world(vec2f_position, State.camera_position, screen_size)
 error_string = ""
 
 def position_rel_to_surface(surface: pygame.Surface) -> Vec2:
     pass
-def mouse_pos_on_cur_image_layer() -> Vec2:
-    reverse_camera_mouse_position = camera_reverse_transform(State.last_mouse_position)
+def get_view_size() -> tuple[int, int]:
+    '''
+    Size of what is drawn, layers are aligned to its top left so its pixels are the pixels of the current layer.
+    '''
+    if (State.display_layer_composite):
+        return layer_compositor.get_size()
+    return surface_layers[State.current_selected_surface_layer_index].get_size()
+def mouse_pos_on_cur_image_layer(screen_position = None) -> Vec2:
+    '''
+    param: screen_position defaults to the mouse position at the start of the frame.
+    '''
+    if (screen_position == None):
+        screen_position = State.last_mouse_position
+    reverse_camera_mouse_position = camera_reverse_transform(screen_position)
     assume_or_exception(not (editing_surface_screen_proportionality_xy[0] == 0 and editing_surface_screen_proportionality_xy[1] == 0))
     assume_or_exception(State.editing_surface_zoom != 0)
     take_away_x, take_away_y = 0, 0
@@ -623,17 +1052,73 @@ def mouse_pos_on_cur_image_layer() -> Vec2:
         take_away_x = +1
     if (reverse_camera_mouse_position[1] < 0):
         take_away_y = +1
-    mouse_position_on_editing_surface_position = (int(reverse_camera_mouse_position[0]/(editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom))+surface_layers[State.current_selected_surface_layer_index].get_width()//2-take_away_x, int(reverse_camera_mouse_position[1]/(editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom))+surface_layers[State.current_selected_surface_layer_index].get_height()//2-take_away_y)
+    view_size = get_view_size()
+    mouse_position_on_editing_surface_position = (int(reverse_camera_mouse_position[0]/(editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom))+view_size[0]//2-take_away_x, int(reverse_camera_mouse_position[1]/(editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom))+view_size[1]//2-take_away_y)
     return mouse_position_on_editing_surface_position
 
 ui_display_layer_index = UITextElement(Vec2(0, 0), f"{State.current_selected_surface_layer_index}/{len(surface_layers)}", 1, 1)
 ui_display_layer_index.set_top_right_pos(Vec2(10, 0))
 ui_display_surface_size = UITextElement(Vec2(5, 5), f"{surface_layers[State.current_selected_surface_layer_index].get_width()}w {surface_layers[State.current_selected_surface_layer_index].get_height()}h", 5, 5)
-
+def update_ui_surface_size() -> None:
+    ui_display_surface_size.update_text(f"{surface_layers[State.current_selected_surface_layer_index].get_width()}w {surface_layers[State.current_selected_surface_layer_index].get_height()}h")
+
+editing_surface_render_image = RenderImage(surface_layers[State.current_selected_surface_layer_index], Vec2(0, 0))
+editing_surface_grid_overlay = render.GridOverlay()
+screen_dirty_regions = render.DirtyRegionTracker()
+PROFILER_OVERLAY_UPDATE_SECONDS = 0.5 # the overlay text is only rendered again this often, so it stays readable and cheap
+profiler_overlay_surface = None
+profiler_overlay_update_time = 0
+def update_profiler_overlay() -> None:
+    '''
+    Renders the percentiles of every phase, each line in its own row, onto one surface.
+    Not through app_text_cache, the changing numbers would push out the text that is reused.
+    '''
+    global profiler_overlay_surface
+    overlay_font = app_font_cache.get_font(max(8, app_font_size*3//4))
+    line_surfaces = [overlay_font.render(line, True, app_text_color) for line in main_loop_profiler.get_report_lines()]
+    profiler_overlay_surface = Surface((max(line_surface.get_width() for line_surface in line_surfaces) + 10, sum(line_surface.get_height() for line_surface in line_surfaces) + 10), pygame.SRCALPHA)
+    profiler_overlay_surface.fill((*app_text_background_color[:3], app_text_background_alpha))
+    line_y = 5
+    for line_surface in line_surfaces:
+        profiler_overlay_surface.blit(line_surface, (5, line_y))
+        line_y += line_surface.get_height()
+
+def exit_editor() -> None:
+    '''
+    Waits for the layer saves and exports still running, then exits. When replaying, prints the replay timings first.
+    '''
+    if (layer_save_tasks.get_pending_count() > 0):
+        log.output(logger.LOG_level("INFO"), f"Waiting for {layer_save_tasks.get_pending_count()} layer save(s) to finish before quitting")
+    layer_save_tasks.shutdown(cancel_pending=False)
+    if (image_export_tasks.get_pending_count() > 0):
+        log.output(logger.LOG_level("INFO"), f"Waiting for {image_export_tasks.get_pending_count()} export(s) to finish before quitting")
+    image_export_tasks.shutdown(cancel_pending=False)
+    image_load_tasks.shutdown()
+    if (input_recorder != None):
+        input_recorder.close()
+        log.output(logger.LOG_level("INFO"), f"Recorded {input_recorder.frame_count} frames of input to '{input_recorder.file_path}'")
+    if (input_player != None):
+        print("\n".join(input_player.get_report_lines(time.perf_counter() - replay_start_time)))
+        print("\n".join(main_loop_profiler.get_report_lines()))
+    main_loop_profiler.close()
+    pygame.quit()
+    log.mark_clean_exit()
+    sys.exit()
+
+if (input_player != None):
+    # The recording starts from loaded layers, replayed edits to a layer still loading would be refused
+    image_load_tasks.wait()
+    finish_layer_loads()
 previous_frame_time = time.time()
+replay_start_time = time.perf_counter()
 clock = pygame.time.Clock()
 while True:
-    clock.tick(max_fps)
+    if (input_player != None and not replay_realtime):
+        clock.tick() # as fast as possible
+    else:
+        clock.tick(max_fps)
+    main_loop_profiler.begin_frame()
+    main_loop_profiler.mark("background tasks")
     fps = clock.get_fps()
     pygame.display.set_caption(f"edit - {input_layer_filepaths[State.current_selected_surface_layer_index]} - {fps : 0.1f}")
     delta_time_seconds = time.time() - previous_frame_time
@@ -641,35 +1126,67 @@ while True:
 
     State.main_mouse_button_clicked_this_frame = False
 
-    State.last_mouse_position = pygame.mouse.get_pos()
-    for event in pygame.event.get():
+    finish_layer_loads()
+    finish_layer_saves()
+    finish_image_exports()
+    main_loop_profiler.mark("events")
+    if (input_player != None):
+        # Only closing the window is taken from the live input, to stop the replay early
+        if (any(event.type == pygame.QUIT for event in pygame.event.get())):
+            exit_editor()
+        replay_frame = input_player.next_frame()
+        if (replay_frame == None):
+            exit_editor()
+        if (replay_realtime):
+            main_loop_profiler.mark("replay wait")
+            time.sleep(max(0, replay_start_time + replay_frame.time_seconds - time.perf_counter()))
+            main_loop_profiler.mark("events")
+        delta_time_seconds = replay_frame.delta_seconds # camera movement is scaled by the frame time
+        State.last_mouse_position = replay_frame.mouse_position
+        frame_events = replay_frame.events
+    else:
+        State.last_mouse_position = pygame.mouse.get_pos()
+        frame_events = pygame.event.get()
+        if (input_recorder != None):
+            input_recorder.record_frame(delta_time_seconds, State.last_mouse_position, frame_events)
+    for event in frame_events:
         if (event.type == pygame.QUIT or Mode.current == Mode.NORMAL and event.type == pygame.KEYDOWN and event.key == Key.quit):
-            if (State.unsaved_changes):
-                write_str_to_text_buffer("Warning: Unsaved changes, quit to ignore", True)
-                State.unsaved_changes = False # TODO: Make a more permenant solution, with a timer
+            unsaved_images_count = get_unsaved_images_count()
+            if (unsaved_images_count > 0 and not State.quit_warning_given):
+                write_str_to_text_buffer(f"Warning: {unsaved_images_count} unsaved layer(s), quit to ignore", True)
+                State.quit_warning_given = True
                 continue
-            pygame.quit()
-            sys.exit()
+            exit_editor()
+
+        if (event.type == pygame.WINDOWEXPOSED):
+            screen_dirty_regions.mark_all_dirty()
 
         if (event.type == pygame.WINDOWRESIZED):
+            screen_dirty_regions.mark_all_dirty()
             screen_size = (event.x, event.y)
+            if (input_player != None):
+                screen = pygame.display.set_mode(screen_size, pygame.RESIZABLE)
             width, height = screen_size[0]/640, screen_size[1]/480
             average = (width+height)/2
             app_font_size = int(20 * average)
-            app_font_object = pygame.font.Font(None, app_font_size)
             # update ui elements on window resize.
             ui_display_surface_size.regenerate_surfaces()
             ui_display_layer_index.regenerate_surfaces()
 
         if (event.type == pygame.MOUSEWHEEL):
-            if (State.min_editing_surface_zoom < State.editing_surface_zoom + event.y < State.max_editing_surface_zoom):
-                State.editing_surface_zoom += event.y
+            zoom_editing_surface(event.y)
 
         if (event.type == pygame.MOUSEBUTTONDOWN):
             if (event.button == 1):
                 log.output(logger.LOG_level("INFO"), f"Clicked main mouse button")
                 State.main_mouse_button_clicked_this_frame = True
                 State.main_mouse_button_held = True
+                if (Mode.current == Mode.NORMAL):
+                    State.stroke_pending_screen_positions.append(event.pos)
+
+        if (event.type == pygame.MOUSEMOTION):
+            if (Mode.current == Mode.NORMAL and State.main_mouse_button_held):
+                State.stroke_pending_screen_positions.append(event.pos)
 
         if (event.type == pygame.MOUSEBUTTONUP):
             if (event.button == 1):
@@ -679,6 +1196,11 @@ while True:
 
             if (Mode.current == Mode.NORMAL and event.key == Key.toggle_grid_lines):
                 State.display_grid_lines = not State.display_grid_lines
+            if (Mode.current == Mode.NORMAL and event.key == Key.toggle_profiler_overlay):
+                State.display_profiler_overlay = not State.display_profiler_overlay
+            if (Mode.current == Mode.NORMAL and event.key == Key.toggle_layer_composite):
+                State.display_layer_composite = not State.display_layer_composite
+                write_str_to_text_buffer("Showing all visible layers" if State.display_layer_composite else "Showing the current layer alone", True)
             if (Mode.current != Mode.NORMAL and event.key == Key.return_normal_mode):
                 log.output(logger.LOG_level("INFO"), f"Escaped to normal mode from {get_mode_type_code_to_str(Mode.current)}")
                 Mode.current = Mode.NORMAL
@@ -691,6 +1213,11 @@ while True:
                 Mode.current = Mode.SET_COLOR
                 log.output(logger.LOG_level("INFO"), f"Entered mode {get_mode_type_code_to_str(Mode.current)}")
                 clear_text_buffer()
+            if (Mode.current == Mode.NORMAL and event.key == Key.select_mode_brush):
+                Mode.current = Mode.BRUSH
+                log.output(logger.LOG_level("INFO"), f"Entered mode {get_mode_type_code_to_str(Mode.current)}")
+                clear_text_buffer()
+                continue
             if (Mode.current == Mode.NORMAL and event.key == Key.resize_editing_surface):
                 Mode.current = Mode.RESIZE_SURFACE
                 log.output(logger.LOG_level("INFO"), f"Entered mode {get_mode_type_code_to_str(Mode.current)}")
@@ -702,43 +1229,46 @@ while True:
                 continue
             if (Mode.current == Mode.NORMAL and event.key == Key.move_camera):
                 State.move_camera = True
-            if (Mode.current == Mode.NORMAL and event.key == Key.undo_editing_surface_modification):
-                undo_package = pop_undo_from_cur_layer()
-                if (undo_package != None):
-                    log.output(logger.LOG_level("INFO"), f"undoing package {undo_package}")
-                    if isinstance(undo_package, UndoSinglePixel):
-                        surface_layers[State.current_selected_surface_layer_index].set_at(undo_package.pixel_position, undo_package.color)
-                        State.unsaved_changes = True
-                    elif isinstance(undo_package, UndoBucketFill):
-                        paint_tool_bucket(surface_layers[State.current_selected_surface_layer_index], undo_package.pixel_position, undo_package.old_color, undo_package.mask)
-                        State.unsaved_changes = True
-                    elif isinstance(undo_package, UndoResize):
-                        surface_layers[State.current_selected_surface_layer_index] = undo_package.old_surface
-                        State.unsaved_changes = True
-                    else:
-                        log.output(logger.LOG_level("WARNING"), f"undo package {undo_package} is not handles when undo button pressed")
+            if (Mode.current == Mode.NORMAL and event.key == Key.undo_editing_surface_modification and not is_cur_layer_loading()):
+                if (layers.undo(State.current_selected_surface_layer_index)):
+                    update_ui_surface_size()
                     log.output(logger.LOG_level("INFO"), f"Applied undo")
+                else:
+                    write_str_to_text_buffer("Nothing to undo", True)
+            if (Mode.current == Mode.NORMAL and event.key == Key.redo_editing_surface_modification and not is_cur_layer_loading()):
+                if (layers.redo(State.current_selected_surface_layer_index)):
+                    update_ui_surface_size()
+                    log.output(logger.LOG_level("INFO"), f"Applied redo")
+                else:
+                    write_str_to_text_buffer("Nothing to redo", True)
             if (Mode.current == Mode.NORMAL and event.key == Key.save_current_layer_surface):
-                State.unsaved_changes = False
-                pygame.image.save(surface_layers[State.current_selected_surface_layer_index], input_layer_filepaths[State.current_selected_surface_layer_index])
-                log.output(logger.LOG_level("INFO"), f"Saved current editing surface to {input_layer_filepaths[State.current_selected_surface_layer_index]}")
-            if (Mode.current == Mode.NORMAL and event.key == Key.fill_bucket):
+                save_refused_reason = start_layer_save(State.current_selected_surface_layer_index)
+                if (save_refused_reason != None):
+                    write_str_to_text_buffer(f"Error: {save_refused_reason}", True)
+                    continue
+                write_str_to_text_buffer(f"Saving '{input_layer_filepaths[State.current_selected_surface_layer_index]}'", True)
+            if (Mode.current == Mode.NORMAL and event.key == Key.fill_bucket and not is_cur_layer_loading()):
                 mouse_position_on_editing_surface_position = mouse_pos_on_cur_image_layer()
 
-                previous_color = surface_layers[State.current_selected_surface_layer_index].get_at(mouse_position_on_editing_surface_position)
                 fill_color = buffer_colors[current_buffer_colors_index]
-                fill_mask = paint_tool_bucket(surface_layers[State.current_selected_surface_layer_index], pygame.math.Vector2(mouse_position_on_editing_surface_position), fill_color)
-                State.unsaved_changes = True
+                fill_undo_objects = []
+                def capture_fill_undo(fill_mask: pygame.Mask, fill_rect: Rect) -> None:
+                    fill_undo_objects.append(UndoTiles.from_surface(surface_layers[State.current_selected_surface_layer_index], [fill_rect], fill_mask))
+                def capture_canvas_fill_undo(tile_masks: dict[tuple[int, int], pygame.Mask]) -> None:
+                    fill_undo_objects.append(UndoCanvasTiles.from_canvas(surface_layers[State.current_selected_surface_layer_index], list(tile_masks)))
+                if (isinstance(surface_layers[State.current_selected_surface_layer_index], TiledCanvas)):
+                    fill_mask = layers.bucket_fill_canvas(State.current_selected_surface_layer_index, pygame.math.Vector2(mouse_position_on_editing_surface_position), fill_color, State.fill_connectivity, State.fill_tolerance, before_apply_callback=capture_canvas_fill_undo)
+                else:
+                    fill_mask = layers.bucket_fill(State.current_selected_surface_layer_index, pygame.math.Vector2(mouse_position_on_editing_surface_position), fill_color, None, State.fill_connectivity, State.fill_tolerance, before_apply_callback=capture_fill_undo)
 
                 if (fill_mask != None):
-                    undo_object = UndoBucketFill(pygame.math.Vector2(mouse_position_on_editing_surface_position), previous_color, fill_mask)
-                    add_undo_to_cur_layer(undo_object)
+                    per_layer_history[State.current_selected_surface_layer_index].add(fill_undo_objects[0])
                 else:
                     log.output(logger.LOG_level("WARNING"), f"fill_mask is None, failed to bucket fill")
             if (Mode.current == Mode.NORMAL and event.key == Key.pick_color):
                 current_hovered_pixel_pos = mouse_pos_on_cur_image_layer()
                 try:
-                    hover_color = surface_layers[State.current_selected_surface_layer_index].get_at((current_hovered_pixel_pos[0], current_hovered_pixel_pos[1]))
+                    hover_color = indexed_layer.get_color_at(surface_layers[State.current_selected_surface_layer_index], (current_hovered_pixel_pos[0], current_hovered_pixel_pos[1]))
                 except IndexError:
                     log.output(logger.LOG_level("WARNING"), "Position given is invalid")
                     continue
@@ -752,98 +1282,12 @@ while True:
                 if (Mode.current == Mode.SET_COLOR):
                     Mode.current = Mode.NORMAL
                     log.output(logger.LOG_level("INFO"), f"Entered mode {get_mode_type_code_to_str(Mode.current)}")
-                    current_color_channel = None
-                    final_color = buffer_colors[current_buffer_colors_index]
-                    current_number_str = ""
-                    for char in State.text_io_buffer:
-                        if (char == "r"):
-                            if (len(current_number_str) > 0):
-                                if (char == "r"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.r = int(current_number_str)
-                                if (char == "g"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.g = int(current_number_str)
-                                if (char == "b"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.b = int(current_number_str)
-                                if (char == "a"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.a = int(current_number_str)
-                            current_color_channel = "r"
-                            current_number_str = ""
-                        elif (char == "g"):
-                            if (len(current_number_str) > 0):
-                                if (char == "r"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.r = int(current_number_str)
-                                if (char == "g"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.g = int(current_number_str)
-                                if (char == "b"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.b = int(current_number_str)
-                                if (char == "a"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.a = int(current_number_str)
-                            current_color_channel = "g"
-                            current_number_str = ""
-                        elif (char == "b"):
-                            if (len(current_number_str) > 0):
-                                if (char == "r"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.r = int(current_number_str)
-                                if (char == "g"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.g = int(current_number_str)
-                                if (char == "b"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.b = int(current_number_str)
-                                if (char == "a"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.a = int(current_number_str)
-                            current_color_channel = "b"
-                            current_number_str = ""
-                        elif (char == "a"):
-                            if (len(current_number_str) > 0):
-                                if (char == "r"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.r = int(current_number_str)
-                                if (char == "g"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.g = int(current_number_str)
-                                if (char == "b"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.b = int(current_number_str)
-                                if (char == "a"):
-                                    if (int(current_number_str) < 256):
-                                        final_color.a = int(current_number_str)
-                            current_color_channel = "a"
-                            current_number_str = ""
-                        elif (char.isdigit()):
-                            current_number_str += char
-                        else:
-                            log.output(logger.LOG_level("ERROR"), f"char \'{char}\' should not be in the buffer")
-
-                    if (len(current_number_str) != 0):
-                        if (current_color_channel == "r"):
-                            if (int(current_number_str) < 256):
-                                final_color.r = int(current_number_str)
-                        if (current_color_channel == "g"):
-                            if (int(current_number_str) < 256):
-                                final_color.g = int(current_number_str)
-                        if (current_color_channel == "b"):
-                            if (int(current_number_str) < 256):
-                                final_color.b = int(current_number_str)
-                        if (current_color_channel == "a"):
-                            if (int(current_number_str) < 256):
-                                final_color.a = int(current_number_str)
+                    input_parsing.parse_color_input(State.text_io_buffer, buffer_colors[current_buffer_colors_index])
 
                 if (Mode.current == Mode.RESIZE_SURFACE):
                     Mode.current = Mode.NORMAL
-
-                    undo_object = UndoResize(surface_layers[State.current_selected_surface_layer_index])
-                    add_undo_to_cur_layer(undo_object)
+                    if (is_cur_layer_loading()):
+                        continue
 
                     width = surface_layers[State.current_selected_surface_layer_index].get_width()
                     height = surface_layers[State.current_selected_surface_layer_index].get_height()
@@ -862,10 +1306,22 @@ while True:
                                     number_str = ""
                         if (char.isdigit()):
                             number_str += char
-                    surface_layers[State.current_selected_surface_layer_index] = pygame.transform.scale(surface_layers[State.current_selected_surface_layer_index], (width, height))
-                    ui_display_surface_size.update_text(f"{surface_layers[State.current_selected_surface_layer_index].get_width()}w {surface_layers[State.current_selected_surface_layer_index].get_height()}h")
-                    State.unsaved_changes = True
+                    resize_error_string = layers.resize(State.current_selected_surface_layer_index, (width, height))
+                    if (resize_error_string != ""):
+                        write_str_to_text_buffer(f"Error: {resize_error_string}", True)
+                        log.output(logger.LOG_level("WARNING"), f"Refused to resize the editing surface to ({width}, {height}), {resize_error_string}")
+                        continue
+                    update_ui_surface_size()
                     log.output(logger.LOG_level("INFO"), f"Changed editing surface size to ({surface_layers[State.current_selected_surface_layer_index].get_width()}, {surface_layers[State.current_selected_surface_layer_index].get_height()})")
+                if (Mode.current == Mode.BRUSH):
+                    Mode.current = Mode.NORMAL
+                    brush, error_string = input_parsing.parse_brush_input(State.text_io_buffer, State.brush)
+                    if (brush == None):
+                        write_str_to_text_buffer(error_string, True)
+                        continue
+                    State.brush = brush if not (brush.shape == paint_tools.BRUSH_SHAPE_SQUARE and brush.size == 1) else None
+                    write_str_to_text_buffer(f"Brush: {brush}", True)
+                    log.output(logger.LOG_level("INFO"), f"Changed brush to {brush}")
                 if (Mode.current == Mode.LAYERS):
                     Mode.current = Mode.NORMAL
                     if len(State.text_io_buffer) < 1:
@@ -900,7 +1356,7 @@ while True:
                     clear_text_buffer()
                     Mode.current = Mode.NORMAL
                     log.output(logger.LOG_level("INFO"), f"Changed mode to normal from resize surface")
-                if (Mode.current == Mode.LAYERS):
+                if (Mode.current == Mode.LAYERS or Mode.current == Mode.BRUSH):
                     clear_text_buffer()
                     Mode.current = Mode.NORMAL
 
@@ -933,16 +1389,19 @@ while True:
             if (Mode.current == Mode.RESIZE_SURFACE and (event.unicode.isdigit() or event.unicode in ["w", "h"])):
                 append_str_to_text_buffer(event.unicode)
 
+            if (Mode.current == Mode.BRUSH and event.unicode.isprintable()):
+                append_str_to_text_buffer(event.unicode)
+
             if (Mode.current == Mode.LAYERS and event.unicode.isprintable()):
-                # TODO, support more than just layer selection, allow for letter to be begain with, for specific commands. Such as bl (blend layers) <blend-mode> <base-layer-index> <blend-layer-index>. Have these as non-destructive (do not apply them to the layers, only visually present them as such, only on writes would you apply them to the saved image (compile the final image), but not the layers themselves)
                 append_str_to_text_buffer(event.unicode)
 
         if (event.type == pygame.KEYUP):
             if (event.key == Key.move_camera):
                 State.move_camera = False
 
+    main_loop_profiler.mark("painting")
     if (Mode.current == Mode.NORMAL and State.move_camera):
-        mouse_pos = list(pygame.mouse.get_pos())
+        mouse_pos = list(State.last_mouse_position)
         mouse_pos[0] -= screen_size[0]/2
         mouse_pos[1] -= screen_size[1]/2
         if (abs(mouse_pos[0]) < 5):
@@ -956,86 +1415,134 @@ while True:
         State.camera_position[0] += int(mouse_pos[0])
         State.camera_position[1] += int(mouse_pos[1])
 
-    if (Mode.current == Mode.NORMAL and State.main_mouse_button_held):
-        mouse_position_on_editing_surface_position = mouse_pos_on_cur_image_layer()
-        if (mouse_position_on_editing_surface_position[0] < 0 or mouse_position_on_editing_surface_position[1] < 0):
-            pass
-        elif (mouse_position_on_editing_surface_position[0] >= surface_layers[State.current_selected_surface_layer_index].get_width()):
-            pass
-        elif (mouse_position_on_editing_surface_position[1] >= surface_layers[State.current_selected_surface_layer_index].get_height()):
-            pass
-        elif (buffer_colors[current_buffer_colors_index] != surface_layers[State.current_selected_surface_layer_index].get_at(mouse_position_on_editing_surface_position)):
-            color_copy = pygame.Color(surface_layers[State.current_selected_surface_layer_index].get_at(mouse_position_on_editing_surface_position))
-            undo_object = UndoSinglePixel(mouse_position_on_editing_surface_position, color_copy)
-            add_undo_to_cur_layer(undo_object)
-            log.output(logger.LOG_level("INFO"), f"mouse_position_on_surface: {mouse_position_on_editing_surface_position}")
-            log.output(logger.LOG_level("INFO"), f"setting color: {buffer_colors[current_buffer_colors_index]}, at {mouse_position_on_editing_surface_position}")
-
-            surface_layers[State.current_selected_surface_layer_index].set_at(mouse_position_on_editing_surface_position, buffer_colors[current_buffer_colors_index])
-            State.unsaved_changes = True
+    if (Mode.current == Mode.NORMAL and len(State.stroke_pending_screen_positions) > 0 and not is_cur_layer_loading()):
+        paint_stroke_cur_layer(State.stroke_pending_screen_positions, buffer_colors[current_buffer_colors_index])
+    State.stroke_pending_screen_positions.clear()
+    if (not State.main_mouse_button_held and layers.stroke_last_point != None):
+        layers.end_stroke(State.current_selected_surface_layer_index)
 
-            log.output(logger.LOG_level("INFO"), f"Set color: {surface_layers[State.current_selected_surface_layer_index].get_at(mouse_position_on_editing_surface_position)} at {mouse_position_on_editing_surface_position}")
-
-    screen.fill(bg_color)
+    main_loop_profiler.mark("compositing")
+    if (State.display_layer_composite):
+        State.editing_surface_modified_rects += layer_compositor.update()
+        view_surface, view_revision, view_mipmap = layer_compositor.get_view()
+    else:
+        view_surface = surface_layers[State.current_selected_surface_layer_index]
+        view_revision = per_layer_revisions[State.current_selected_surface_layer_index]
+        view_mipmap = per_layer_mipmaps[State.current_selected_surface_layer_index]
 
+    main_loop_profiler.mark("layout")
     editing_surface_screen_proportionality_xy = (screen_size[0]/640, screen_size[1]/480)
     # Scale from the center of the screen. Not the top left of the surface.
-    transformed_editing_surface = pygame.transform.scale(surface_layers[State.current_selected_surface_layer_index], (surface_layers[State.current_selected_surface_layer_index].get_width()*editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom, surface_layers[State.current_selected_surface_layer_index].get_height()*editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom))
-    transformed_editing_surface_rect = transformed_editing_surface.get_rect(center=(0, 0))
-    transformed_editing_surface_pos = transformed_editing_surface_rect.topleft
-
-    editing_surface_average_color = pygame.transform.average_color(surface_layers[State.current_selected_surface_layer_index])
+    editing_surface_render_image.set_surface(view_surface, view_revision)
+    view_mipmap.set_surface(view_surface)
+    editing_surface_render_image.set_mipmap(view_mipmap)
+    editing_surface_render_image.set_scale((editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom, editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom))
+    transformed_editing_surface_size = editing_surface_render_image.get_tsize()
+    transformed_editing_surface_pos = editing_surface_render_image.get_tpos()
+
+    main_loop_profiler.mark("statistics")
+    editing_surface_average_color = layers.get_statistics(State.current_selected_surface_layer_index).get_average_color()
+    main_loop_profiler.mark("layout")
     editing_surface_negated_color = pygame.Color(255 - editing_surface_average_color[0], 255 - editing_surface_average_color[1], 255 - editing_surface_average_color[2])
     if (123 < editing_surface_negated_color[0] < 134 and 123 < editing_surface_negated_color[1] < 134 and 123 < editing_surface_negated_color[2] < 134):
         editing_surface_negated_color[0] += 32
         editing_surface_negated_color[1] += 32
         editing_surface_negated_color[2] += 32
-    screen.blit(transformed_editing_surface, camera_transform(transformed_editing_surface_pos))
-    if State.display_grid_lines:
-        for x in range(-surface_layers[State.current_selected_surface_layer_index].get_width()//2, surface_layers[State.current_selected_surface_layer_index].get_width()//2+1):
-            pygame.draw.line(screen, editing_surface_negated_color, camera_transform((x*editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom, transformed_editing_surface_pos[0])), camera_transform((x*editing_surface_screen_proportionality_xy[0]*State.editing_surface_zoom, transformed_editing_surface.get_height()//2)))
-        for y in range(-surface_layers[State.current_selected_surface_layer_index].get_height()//2, surface_layers[State.current_selected_surface_layer_index].get_height()//2+1):
-            pygame.draw.line(screen, editing_surface_negated_color, camera_transform((transformed_editing_surface_pos[0], y*editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom)), camera_transform((transformed_editing_surface.get_width()//2, y*editing_surface_screen_proportionality_xy[1]*State.editing_surface_zoom)))
-    
+
+    editing_surface_screen_pos = camera_transform(transformed_editing_surface_pos)
+    editing_surface_screen_rect = Rect(editing_surface_screen_pos, transformed_editing_surface_size).inflate(2, 2) # grid lines can land on the edges
+    screen_dirty_regions.update_element("editing surface", editing_surface_screen_rect,
+        (view_surface, editing_surface_render_image.scale_xy, tuple(State.camera_position), tuple(screen_size), State.display_grid_lines, tuple(editing_surface_negated_color)))
+    for modified_rect in State.editing_surface_modified_rects:
+        if (modified_rect == None):
+            screen_dirty_regions.add_dirty_rect(editing_surface_screen_rect)
+            continue
+        modified_screen_rect = editing_surface_render_image.source_to_transformed_rect(modified_rect).move(editing_surface_screen_pos)
+        screen_dirty_regions.add_dirty_rect(modified_screen_rect.inflate(2, 2))
+    State.editing_surface_modified_rects.clear()
+
     display_color_rect_size = (screen_size[0]//25, screen_size[1]//25)
     display_color_rect_start_x_position = screen_size[0] - (display_color_rect_size[0]+display_color_rect_horizontal_gap)*10 - display_color_rect_horizontal_gap
-
-    for display_color_index in range(10):
-        
-        pygame.draw.rect(screen, buffer_colors[display_color_index], ((display_color_rect_start_x_position +  display_color_index*(display_color_rect_size[0]+display_color_rect_horizontal_gap), display_color_rect_screen_verticle_gap), display_color_rect_size))
-        if (display_color_index == current_buffer_colors_index):
-            pygame.draw.rect(screen, (0, 0, 0), ((display_color_rect_start_x_position + display_color_index*(display_color_rect_size[0]+display_color_rect_horizontal_gap) - 5, display_color_rect_screen_verticle_gap -5), (display_color_rect_size[0]+5, display_color_rect_size[1]+5)), width = 5)
+    screen_dirty_regions.update_element("color pallet",
+        Rect(display_color_rect_start_x_position -5, display_color_rect_screen_verticle_gap -5, screen_size[0] - display_color_rect_start_x_position +5, display_color_rect_size[1] +10),
+        (tuple(tuple(color) for color in buffer_colors), current_buffer_colors_index, display_color_rect_size))
 
     current_selected_color = buffer_colors[current_buffer_colors_index]
-    display_color_rect_text_surface = app_font_object.render(f"{current_selected_color[0]}r{current_selected_color[1]}g{current_selected_color[2]}b{current_selected_color[3]}a", True, (app_text_color))
-    display_color_rect_text_background_surface = pygame.Surface((display_color_rect_text_surface.get_width(), display_color_rect_text_surface.get_height()))
-    display_color_rect_text_background_surface.fill(app_text_background_color)
-    display_color_rect_text_background_surface.set_alpha(app_text_background_alpha)
-    screen.blit(display_color_rect_text_background_surface, (screen_size[0] - display_color_rect_text_background_surface.get_width() - 5, display_color_rect_screen_verticle_gap + display_color_rect_size[1] + 5))
-    screen.blit(display_color_rect_text_surface, (screen_size[0] - display_color_rect_text_background_surface.get_width() - 5, display_color_rect_screen_verticle_gap + display_color_rect_size[1] + 5))
-
-    display_mode_text_surface = app_font_object.render(f"--{get_mode_type_code_to_str(Mode.current)}--", True, (app_text_color))
-    display_mode_text_background_surface = pygame.Surface((display_mode_text_surface.get_width(), display_mode_text_surface.get_height()))
-    display_mode_text_background_surface.fill(app_text_background_color)
-    display_mode_text_background_surface.set_alpha(app_text_background_alpha)
-    screen.blit(display_mode_text_background_surface, (screen_size[0]//8, screen_size[1] - display_mode_text_surface.get_height() -5))
-    screen.blit(display_mode_text_surface, (screen_size[0]//8, screen_size[1] - display_mode_text_surface.get_height() -5))
-
-    display_io_buffer_surface = app_font_object.render(f"{State.text_io_buffer}", True, (app_text_color))
-
-    display_input_buffer_background_surface = pygame.Surface((display_io_buffer_surface.get_width(), display_io_buffer_surface.get_height()))
-    display_input_buffer_background_surface.fill(app_text_background_color)
-    display_input_buffer_background_surface.set_alpha(app_text_background_alpha)
-    screen.blit(display_input_buffer_background_surface, (screen_size[0] - display_io_buffer_surface.get_width() - 5, screen_size[1] - display_io_buffer_surface.get_height() -5))
-    screen.blit(display_io_buffer_surface, (screen_size[0] - display_io_buffer_surface.get_width() - 5, screen_size[1] - display_io_buffer_surface.get_height() -5))
-
-    ui_display_layer_index.update_text(f"{State.current_selected_surface_layer_index}/{len(surface_layers)}") # TODO: update when the current layer get switched.
+    display_color_rect_text_surface = app_text_cache.render(f"{current_selected_color[0]}r{current_selected_color[1]}g{current_selected_color[2]}b{current_selected_color[3]}a", app_font_size, app_text_color)
+    display_color_rect_text_background_surface = app_text_cache.get_background(display_color_rect_text_surface.get_size(), app_text_background_color, app_text_background_alpha)
+    display_color_rect_text_pos = (screen_size[0] - display_color_rect_text_background_surface.get_width() - 5, display_color_rect_screen_verticle_gap + display_color_rect_size[1] + 5)
+    screen_dirty_regions.update_element("color text", Rect(display_color_rect_text_pos, display_color_rect_text_surface.get_size()), tuple(current_selected_color))
+
+    display_mode_text = f"--{get_mode_type_code_to_str(Mode.current)}--"
+    display_mode_text_surface = app_text_cache.render(display_mode_text, app_font_size, app_text_color)
+    display_mode_text_background_surface = app_text_cache.get_background(display_mode_text_surface.get_size(), app_text_background_color, app_text_background_alpha)
+    display_mode_text_pos = (screen_size[0]//8, screen_size[1] - display_mode_text_surface.get_height() -5)
+    screen_dirty_regions.update_element("mode text", Rect(display_mode_text_pos, display_mode_text_surface.get_size()), display_mode_text)
+
+    display_io_buffer_surface = app_text_cache.render(f"{State.text_io_buffer}", app_font_size, app_text_color)
+    display_input_buffer_background_surface = app_text_cache.get_background(display_io_buffer_surface.get_size(), app_text_background_color, app_text_background_alpha)
+    display_io_buffer_pos = (screen_size[0] - display_io_buffer_surface.get_width() - 5, screen_size[1] - display_io_buffer_surface.get_height() -5)
+    screen_dirty_regions.update_element("io buffer", Rect(display_io_buffer_pos, display_io_buffer_surface.get_size()), State.text_io_buffer)
+
+    ui_display_layer_index.update_text(f"{State.current_selected_surface_layer_index}/{len(surface_layers)}") # Only regenerates when the text changes
     ui_display_layer_index.set_top_right_pos((screen_size[0]-5, display_color_rect_screen_verticle_gap +display_color_rect_size[1] +10 + display_color_rect_text_background_surface.get_height())) # TODO: update only when the window is resized.
-    ui_display_layer_index.render(screen)
+    screen_dirty_regions.update_element("layer index", Rect(ui_display_layer_index.get_pos(), ui_display_layer_index.get_size()), ui_display_layer_index.text)
 
     if (Mode.current == Mode.RESIZE_SURFACE):
-        ui_display_surface_size.render(screen)
+        screen_dirty_regions.update_element("surface size", Rect(ui_display_surface_size.get_pos(), ui_display_surface_size.get_size()), ui_display_surface_size.text)
+    else:
+        screen_dirty_regions.remove_element("surface size")
+
+    if (State.display_profiler_overlay):
+        if (profiler_overlay_surface == None or time.time() - profiler_overlay_update_time > PROFILER_OVERLAY_UPDATE_SECONDS):
+            update_profiler_overlay()
+            profiler_overlay_update_time = time.time()
+        profiler_overlay_pos = (5, ui_display_surface_size.get_pos()[1] + ui_display_surface_size.get_height() + 5)
+        screen_dirty_regions.update_element("profiler overlay", Rect(profiler_overlay_pos, profiler_overlay_surface.get_size()), profiler_overlay_update_time)
+    else:
+        profiler_overlay_surface = None
+        screen_dirty_regions.remove_element("profiler overlay")
+
+    # Only recomposite, and present, the parts of the screen that changed since the last frame.
+    dirty_screen_rects = screen_dirty_regions.pop_dirty_rects(screen.get_rect())
+    for dirty_screen_rect in dirty_screen_rects:
+        main_loop_profiler.mark("render layer")
+        screen.set_clip(dirty_screen_rect)
+        screen.fill(bg_color)
+
+        editing_surface_render_image.render(screen, State.camera_position, screen_size)
+        main_loop_profiler.mark("grid")
+        if State.display_grid_lines:
+            editing_surface_grid_overlay.render(screen, editing_surface_render_image, editing_surface_negated_color, State.camera_position, screen_size)
+
+        main_loop_profiler.mark("hud")
+        for display_color_index in range(10):
+            pygame.draw.rect(screen, buffer_colors[display_color_index], ((display_color_rect_start_x_position +  display_color_index*(display_color_rect_size[0]+display_color_rect_horizontal_gap), display_color_rect_screen_verticle_gap), display_color_rect_size))
+            if (display_color_index == current_buffer_colors_index):
+                pygame.draw.rect(screen, (0, 0, 0), ((display_color_rect_start_x_position + display_color_index*(display_color_rect_size[0]+display_color_rect_horizontal_gap) - 5, display_color_rect_screen_verticle_gap -5), (display_color_rect_size[0]+5, display_color_rect_size[1]+5)), width = 5)
+
+        screen.blit(display_color_rect_text_background_surface, display_color_rect_text_pos)
+        screen.blit(display_color_rect_text_surface, display_color_rect_text_pos)
+
+        screen.blit(display_mode_text_background_surface, display_mode_text_pos)
+        screen.blit(display_mode_text_surface, display_mode_text_pos)
+
+        screen.blit(display_input_buffer_background_surface, display_io_buffer_pos)
+        screen.blit(display_io_buffer_surface, display_io_buffer_pos)
+
+        ui_display_layer_index.render(screen)
+
+        if (Mode.current == Mode.RESIZE_SURFACE):
+            ui_display_surface_size.render(screen)
+
+        if (State.display_profiler_overlay):
+            screen.blit(profiler_overlay_surface, profiler_overlay_pos)
 
-    # display errors above input buffer
+        # display errors above input buffer
+    screen.set_clip(None)
 
-    pygame.display.update()
+    main_loop_profiler.mark("present")
+    pygame.display.update(dirty_screen_rects)
+    main_loop_profiler.end_frame()
+    if (input_player != None):
+        input_player.add_frame_seconds(main_loop_profiler.get_last_frame_seconds())
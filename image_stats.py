@@ -0,0 +1,141 @@
+import sys
+import collections
+import itertools
+
+import pygame
+from pygame import (Surface, Rect)
+
+import paint_tools
+from tiled_canvas import TiledCanvas
+
+# Colours are stored as the native uint32 of their RGBA bytes, which is what
+# a memoryview cast of pygame.image.tobytes(surface, "RGBA") gives, so whole
+# regions can be counted by collections.Counter without a python loop.
+
+def pack_color(color: pygame.Color) -> int:
+    color = pygame.Color(color)
+    return int.from_bytes(bytes((color.r, color.g, color.b, color.a)), sys.byteorder)
+
+def unpack_color(packed_color: int) -> pygame.Color:
+    return pygame.Color(*packed_color.to_bytes(4, sys.byteorder))
+
+def count_colors(surface: Surface, rect: Rect = None, mask: pygame.Mask = None) -> collections.Counter:
+    '''
+    Count every colour in the surface, or in rect of the surface.
+    param: mask, same size as the surface, when given only pixels set in it are counted.
+    '''
+    if (rect == None):
+        rect = surface.get_rect()
+    rect = Rect(rect).clip(surface.get_rect())
+    if (rect.width == 0 or rect.height == 0):
+        return collections.Counter()
+    packed_pixels = memoryview(pygame.image.tobytes(surface.subsurface(rect), "RGBA")).cast("I")
+    if (mask == None):
+        return collections.Counter(packed_pixels)
+    rect_mask = pygame.Mask(rect.size)
+    rect_mask.draw(mask, (-rect.x, -rect.y))
+    return collections.Counter(itertools.compress(packed_pixels, paint_tools.mask_to_bytes(rect_mask)))
+
+def count_canvas_colors(canvas: TiledCanvas, tile_masks: dict[tuple[int, int], pygame.Mask] = None) -> collections.Counter:
+    '''
+    Count every colour of a tiled canvas. Tiles of one colour are counted without reading their pixels.
+    param: tile_masks, {tile key: mask covering the tile rect clipped to the canvas}, when given only those pixels are counted.
+    '''
+    color_counts = collections.Counter()
+    if (tile_masks == None):
+        tile_keys = list(canvas.tiles)
+        # Every pixel outside of the tiles held is the default colour
+        held_pixel_count = 0
+        for tile_key in tile_keys:
+            tile_rect = canvas.get_tile_rect(tile_key).clip(canvas.get_rect())
+            held_pixel_count += tile_rect.width*tile_rect.height
+        color_counts[pack_color(canvas.default_color)] += canvas.get_width()*canvas.get_height() - held_pixel_count
+    else:
+        tile_keys = list(tile_masks)
+    for tile_key in tile_keys:
+        tile_rect = canvas.get_tile_rect(tile_key).clip(canvas.get_rect())
+        tile_mask = tile_masks[tile_key] if tile_masks != None else None
+        tile_color = canvas.get_tile_color(tile_key)
+        if (tile_color != None):
+            color_counts[pack_color(tile_color)] += tile_mask.count() if tile_mask != None else tile_rect.width*tile_rect.height
+        else:
+            color_counts.update(count_colors(canvas.get_tile(tile_key), Rect((0, 0), tile_rect.size), tile_mask))
+    if (color_counts[pack_color(canvas.default_color)] == 0):
+        del color_counts[pack_color(canvas.default_color)]
+    return color_counts
+
+class ImageStatistics:
+    def __init__(self, surface: Surface = None):
+        '''
+        Running channel sums, colour histogram and unique colour count for a surface.
+        Built once from the whole surface, after that kept up to date from each edit.
+        Edits made while it is not built are ignored, they are counted by the next rebuild.
+        '''
+        self.histogram: collections.Counter = collections.Counter()
+        self.channel_sums = [0, 0, 0, 0]
+        self.pixel_count = 0
+        self.is_built = False
+        if (surface != None):
+            self.rebuild(surface)
+    def rebuild(self, surface: Surface or TiledCanvas) -> None:
+        self.histogram = count_canvas_colors(surface) if isinstance(surface, TiledCanvas) else count_colors(surface)
+        self.channel_sums = [0, 0, 0, 0]
+        self.pixel_count = 0
+        for packed_color, count in self.histogram.items():
+            self.__add_to_sums(packed_color, count)
+        self.is_built = True
+    def invalidate(self) -> None:
+        '''
+        For when the whole surface was replaced, such as a resize. Needs a rebuild before being used again.
+        '''
+        self.histogram = collections.Counter()
+        self.channel_sums = [0, 0, 0, 0]
+        self.pixel_count = 0
+        self.is_built = False
+    def copy(self) -> "ImageStatistics":
+        statistics_copy = ImageStatistics()
+        statistics_copy.histogram = self.histogram.copy()
+        statistics_copy.channel_sums = self.channel_sums.copy()
+        statistics_copy.pixel_count = self.pixel_count
+        statistics_copy.is_built = self.is_built
+        return statistics_copy
+    def __add_to_sums(self, packed_color: int, count: int) -> None:
+        for channel_index, channel in enumerate(packed_color.to_bytes(4, sys.byteorder)):
+            self.channel_sums[channel_index] += channel*count
+        self.pixel_count += count
+    def add_colors(self, color_counts: collections.Counter) -> None:
+        if not self.is_built:
+            return
+        for packed_color, count in color_counts.items():
+            self.histogram[packed_color] += count
+            self.__add_to_sums(packed_color, count)
+    def remove_colors(self, color_counts: collections.Counter) -> None:
+        if not self.is_built:
+            return
+        for packed_color, count in color_counts.items():
+            self.histogram[packed_color] -= count
+            if (self.histogram[packed_color] <= 0):
+                del self.histogram[packed_color]
+            self.__add_to_sums(packed_color, -count)
+    def replace_pixel(self, old_color: pygame.Color, new_color: pygame.Color) -> None:
+        self.remove_colors(collections.Counter({pack_color(old_color): 1}))
+        self.add_colors(collections.Counter({pack_color(new_color): 1}))
+    def remove_region(self, surface: Surface, rect: Rect = None, mask: pygame.Mask = None) -> None:
+        '''
+        Call before a region of the surface is overwritten, with add_region after it has been.
+        '''
+        if not self.is_built:
+            return
+        self.remove_colors(count_colors(surface, rect, mask))
+    def add_region(self, surface: Surface, rect: Rect = None, mask: pygame.Mask = None) -> None:
+        if not self.is_built:
+            return
+        self.add_colors(count_colors(surface, rect, mask))
+    def get_unique_color_count(self) -> int:
+        return len(self.histogram)
+    def get_average_color(self) -> pygame.Color:
+        if (self.pixel_count == 0):
+            return pygame.Color(0, 0, 0, 0)
+        return pygame.Color(*[channel_sum//self.pixel_count for channel_sum in self.channel_sums])
+    def get_most_common_colors(self, count: int) -> list[tuple[pygame.Color, int]]:
+        return [(unpack_color(packed_color), color_count) for packed_color, color_count in self.histogram.most_common(count)]
@@ -0,0 +1,157 @@
+import sys
+
+import pygame
+from pygame import Surface
+
+# Indexed colour layers, one byte per pixel indexing a palette of up to 256 colours, held as
+# plain pygame 8 bit surfaces. They use a quarter of the memory of an RGBA layer, and a palette
+# change recolours every pixel of that index without touching the pixels themselves.
+#
+# Transparency is the surface colorkey, one palette entry that is fully transparent. pygame
+# palettes have no alpha, so palettes with partly transparent colours stay RGBA layers (that is
+# also what pygame loads a PNG with such a palette, or with several transparent entries, as).
+#
+# The pixels are only turned into RGBA where something needs RGBA (blending, colour matching),
+# by blitting them onto a 32 bit surface. SDL maps each index through a 256 entry lookup table
+# built from the palette, kept with the surface and only rebuilt after the palette changes.
+
+PALETTE_SIZE = 256
+_UNUSED_ENTRY_COLOR = (0, 0, 0) # palette entries no pixel uses, left out of saved files at the end of the palette
+_TRANSPARENT_ALPHA_BELOW = 128 # colours painted with less alpha than this use the transparent entry
+
+def is_indexed(surface: Surface) -> bool:
+    return isinstance(surface, Surface) and surface.get_bitsize() == 8
+
+def get_colorkey_index(surface: Surface) -> int or None:
+    '''
+    Index of the transparent palette entry, None when the layer has none.
+    pygame only gives the colorkey as a colour, which other entries can share, so the index is read back from pixels.
+    '''
+    if (surface.get_colorkey() == None):
+        return None
+    # Scaling a pixel keeps the colorkey, each of the 256 pixels is then set to its own index
+    index_probe = pygame.transform.scale(surface.subsurface((0, 0, min(1, surface.get_width()), min(1, surface.get_height()))), (PALETTE_SIZE, 1))
+    index_probe.get_buffer().write(bytes(range(PALETTE_SIZE)))
+    return pygame.image.tobytes(index_probe, "RGBA")[3::4].index(0)
+
+def get_palette_colors(surface: Surface) -> list[pygame.Color]:
+    '''
+    Every palette entry as an RGBA colour, the transparent entry with alpha 0.
+    '''
+    palette_colors = [pygame.Color(palette_color) for palette_color in surface.get_palette()]
+    colorkey_index = get_colorkey_index(surface)
+    if (colorkey_index != None):
+        palette_colors[colorkey_index].a = 0
+    return palette_colors
+
+def get_color_index(surface: Surface, color: pygame.Color) -> int:
+    '''
+    The palette entry painting color gives, the transparent entry when color is mostly transparent, otherwise the nearest opaque entry.
+    '''
+    color = pygame.Color(color)
+    colorkey_index = get_colorkey_index(surface)
+    if (colorkey_index != None and color.a < _TRANSPARENT_ALPHA_BELOW):
+        return colorkey_index
+    # SDL maps to the first nearest entry, which is right unless that is the transparent one
+    mapped_index = surface.map_rgb(color)
+    if (mapped_index != colorkey_index):
+        return mapped_index
+    nearest_index, nearest_distance = 0, None
+    for palette_index, palette_color in enumerate(surface.get_palette()):
+        if (palette_index == colorkey_index):
+            continue
+        distance = (palette_color.r-color.r)**2 + (palette_color.g-color.g)**2 + (palette_color.b-color.b)**2
+        if (nearest_distance == None or distance < nearest_distance):
+            nearest_index, nearest_distance = palette_index, distance
+    return nearest_index
+
+def get_nearest_color(surface: Surface, color: pygame.Color) -> pygame.Color:
+    '''
+    The colour of the palette entry painting color gives, see get_color_index.
+    '''
+    palette_index = get_color_index(surface, color)
+    nearest_color = pygame.Color(surface.get_palette_at(palette_index))
+    if (palette_index == get_colorkey_index(surface)):
+        nearest_color.a = 0
+    return nearest_color
+
+def get_color_at(surface: Surface, position: tuple[int, int]) -> pygame.Color:
+    '''
+    surface.get_at, with alpha 0 on the transparent entry of an indexed layer. Raises IndexError.
+    '''
+    color = surface.get_at(position)
+    if (is_indexed(surface) and surface.get_at_mapped(position) == get_colorkey_index(surface)):
+        color.a = 0
+    return color
+
+def to_rgba(surface: Surface) -> Surface:
+    '''
+    A 32 bit per pixel alpha copy of an indexed layer (or part of one), the transparent entry fully transparent.
+    Any other surface is copied the same way, opaque where it has no alpha.
+    '''
+    rgba_surface = Surface(surface.get_size(), pygame.SRCALPHA, 32)
+    rgba_surface.fill((0, 0, 0, 0))
+    rgba_surface.blit(surface, (0, 0))
+    return rgba_surface
+
+def with_full_palette(surface: Surface) -> Surface:
+    '''
+    Indexed surfaces loaded from a file only have as many palette entries as the file.
+    Returns surface, or a copy of it with all 256 entries so any entry can be set, the added ones unused.
+    '''
+    palette = surface.get_palette()
+    if (len(palette) >= PALETTE_SIZE):
+        return surface
+    # Blitting between palettes of different lengths would map the pixels by colour, the indices are copied instead
+    return _from_index_bytes(pygame.image.tobytes(surface, "P"), surface.get_size(), list(palette), get_colorkey_index(surface))
+
+def _from_index_bytes(index_bytes: bytes, size: tuple[int, int], palette: list, colorkey_index: int or None) -> Surface:
+    '''
+    A new indexed surface of one palette index byte per pixel, row major, with palette filled out to 256 entries.
+    '''
+    full_palette = list(palette) + [_UNUSED_ENTRY_COLOR]*(PALETTE_SIZE-len(palette))
+    indexed_surface = Surface(size, 0, 8)
+    indexed_surface.set_palette(full_palette)
+    # Blitting between the same palettes copies the indices
+    index_pixels = pygame.image.frombuffer(index_bytes, size, "P")
+    index_pixels.set_palette(full_palette)
+    indexed_surface.blit(index_pixels, (0, 0))
+    if (colorkey_index != None):
+        indexed_surface.set_colorkey(colorkey_index)
+    return indexed_surface
+
+def to_indexed(surface: Surface, colors: list[pygame.Color]) -> (Surface or None, str):
+    '''
+    An indexed copy of the RGBA layer surface.
+    param: colors, every colour of surface, such as from image_stats.ImageStatistics, palette entries are given in this order.
+    Returns (indexed surface, "") or (None, error string) when the colours do not fit in a palette.
+    '''
+    colors = [pygame.Color(color) for color in colors]
+    if any(0 < color.a < 255 for color in colors):
+        return None, "partly transparent colors need an RGBA layer"
+    opaque_colors = [color for color in colors if color.a == 255]
+    has_transparent_color = len(opaque_colors) < len(colors)
+    if (len(opaque_colors) + has_transparent_color > PALETTE_SIZE):
+        return None, f"{len(opaque_colors) + has_transparent_color} colors, at most {PALETTE_SIZE} fit in a palette"
+    palette = [color[:3] for color in opaque_colors]
+    colorkey_index = None
+    if (has_transparent_color):
+        colorkey_index = len(palette)
+        palette.append(_UNUSED_ENTRY_COLOR)
+    # Blitting RGBA onto a palette surface goes through a reduced colour table, so instead each pixel,
+    # as the native uint32 of its RGBA bytes (see image_stats), is looked up in a dict by map in C
+    color_indices = {int.from_bytes(bytes(color), sys.byteorder): palette_index for palette_index, color in enumerate(opaque_colors)}
+    color_indices.update((int.from_bytes(bytes(color), sys.byteorder), colorkey_index) for color in colors if color.a == 0)
+    index_bytes = bytes(map(color_indices.__getitem__, memoryview(pygame.image.tobytes(surface, "RGBA")).cast("I")))
+    return _from_index_bytes(index_bytes, surface.get_size(), palette, colorkey_index), ""
+
+def get_file_palette(surface: Surface) -> list[pygame.Color]:
+    '''
+    The palette to save surface with, every entry up to the last one that is used by a pixel, transparent, or set to a colour.
+    '''
+    palette_colors = get_palette_colors(surface)
+    index_bytes = pygame.image.tobytes(surface, "P")
+    used_entry_count = max(index_bytes)+1 if len(index_bytes) > 0 else 1
+    while (len(palette_colors) > used_entry_count and palette_colors[-1] == pygame.Color(_UNUSED_ENTRY_COLOR)):
+        palette_colors.pop()
+    return palette_colors
@@ -0,0 +1,55 @@
+import sys
+
+import pygame
+
+import paint_tools
+
+# Parsing of the text typed into the prompts.
+
+COLOR_CHANNEL_LETTERS = "rgba"
+
+def parse_color_input(text: str, color: pygame.Color) -> pygame.Color:
+    '''
+    text is channel values each followed by the letter of its channel, '255r128g0b255a', the format colours are shown in.
+    Digits after the last letter go to the channel of that letter, values above 255 are ignored.
+    Channels not in text are kept. Changes color, and returns it.
+    '''
+    current_color_channel = None
+    current_number_str = ""
+    for char in text:
+        if (char in COLOR_CHANNEL_LETTERS):
+            if (len(current_number_str) > 0 and int(current_number_str) < 256):
+                color[COLOR_CHANNEL_LETTERS.index(char)] = int(current_number_str)
+            current_color_channel = char
+            current_number_str = ""
+        elif (char.isdigit()):
+            current_number_str += char
+    if (len(current_number_str) > 0 and current_color_channel != None and int(current_number_str) < 256):
+        color[COLOR_CHANNEL_LETTERS.index(current_color_channel)] = int(current_number_str)
+    return color
+
+def parse_brush_input(text: str, current_brush: paint_tools.Brush = None) -> (paint_tools.Brush or None, str):
+    '''
+    text is '<shape> <size>', 'stamp <image path>', or just '<size>' to keep the shape of current_brush.
+    Returns (brush, "") or (None, error string).
+    '''
+    text_args = text.split()
+    if (len(text_args) == 0):
+        return None, "Error: no brush given"
+    if (text_args[0] == paint_tools.BRUSH_SHAPE_STAMP):
+        stamp_path = text.strip()[len(paint_tools.BRUSH_SHAPE_STAMP):].strip()
+        try:
+            return paint_tools.load_stamp_brush(stamp_path), ""
+        except FileNotFoundError:
+            return None, f"Error: could not find '{stamp_path}'"
+        except (pygame.error, ValueError):
+            return None, f"Error: {sys.exc_info()[1]}"
+    shape = current_brush.shape if current_brush != None else paint_tools.BRUSH_SHAPE_SQUARE
+    if (text_args[0] in (paint_tools.BRUSH_SHAPE_SQUARE, paint_tools.BRUSH_SHAPE_CIRCLE)):
+        shape = text_args.pop(0)
+    if (len(text_args) != 1 or not text_args[0].isdigit() or int(text_args[0]) < 1):
+        return None, "Error: brush size should be a number above 0"
+    size = int(text_args[0])
+    if (shape == paint_tools.BRUSH_SHAPE_CIRCLE):
+        return paint_tools.make_circle_brush(size), ""
+    return paint_tools.make_square_brush(size), ""
@@ -0,0 +1,172 @@
+import struct
+
+import pygame
+
+import frame_profiler
+
+# Recording of the input the main loop reads each frame, to replay a session through the same
+# event handlers, such as for timing the same strokes and fills against each release.
+# A frame is the time since the frame before it, the mouse position and the events of that frame,
+# so a replay runs the same number of frames with the same events in each.
+#
+# File layout, little endian:
+#   8 bytes   magic, INPUT_RECORDING_MAGIC
+#   uint32    format version
+#   uint16    window width
+#   uint16    window height, when recording started
+# then per frame:
+#   uint32    microseconds since the frame before
+#   int32     mouse x
+#   int32     mouse y
+#   uint16    event count
+#   per event, a uint8 event code and the fields of that event, see _EVENT_STRUCTS
+
+INPUT_RECORDING_MAGIC = b"IEDITREC"
+INPUT_RECORDING_VERSION = 1
+_HEADER_STRUCT = struct.Struct("<8sIHH")
+_FRAME_STRUCT = struct.Struct("<IiiH")
+_EVENT_CODE_STRUCT = struct.Struct("<B")
+_UNICODE_LENGTH_STRUCT = struct.Struct("<B")
+
+# {event code: (pygame event type, fields struct, field names)}. The unicode of key presses follows their struct, as a byte length and utf-8.
+_EVENT_STRUCTS = {
+    1: (pygame.KEYDOWN, struct.Struct("<iH"), ("key", "mod")),
+    2: (pygame.KEYUP, struct.Struct("<iH"), ("key", "mod")),
+    3: (pygame.MOUSEMOTION, struct.Struct("<iiiiB"), ("pos", "rel", "buttons")),
+    4: (pygame.MOUSEBUTTONDOWN, struct.Struct("<Bii"), ("button", "pos")),
+    5: (pygame.MOUSEBUTTONUP, struct.Struct("<Bii"), ("button", "pos")),
+    6: (pygame.MOUSEWHEEL, struct.Struct("<ii"), ("x", "y")),
+    7: (pygame.WINDOWRESIZED, struct.Struct("<ii"), ("x", "y")),
+}
+_EVENT_CODES = {event_type: event_code for event_code, (event_type, _, _) in _EVENT_STRUCTS.items()}
+
+class InputRecordingFormatError(Exception):
+    pass
+
+def is_recorded_event(event: pygame.event.Event) -> bool:
+    return event.type in _EVENT_CODES
+
+def _pack_event(event: pygame.event.Event) -> bytes:
+    event_code = _EVENT_CODES[event.type]
+    _, fields_struct, _ = _EVENT_STRUCTS[event_code]
+    if (event.type in (pygame.KEYDOWN, pygame.KEYUP)):
+        packed_event = fields_struct.pack(event.key, event.mod & 0xFFFF)
+        if (event.type == pygame.KEYDOWN):
+            unicode_bytes = event.unicode.encode("utf-8")[:255]
+            packed_event += _UNICODE_LENGTH_STRUCT.pack(len(unicode_bytes)) + unicode_bytes
+    elif (event.type == pygame.MOUSEMOTION):
+        buttons_bits = sum(1 << button_index for button_index, held in enumerate(event.buttons) if held)
+        packed_event = fields_struct.pack(*event.pos, *event.rel, buttons_bits)
+    elif (event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)):
+        packed_event = fields_struct.pack(event.button, *event.pos)
+    else:
+        packed_event = fields_struct.pack(int(event.x), int(event.y))
+    return _EVENT_CODE_STRUCT.pack(event_code) + packed_event
+
+class InputRecorder:
+    def __init__(self, file_path: str, window_size: tuple[int, int]):
+        '''
+        Starts a recording at file_path, replacing any file there. Raises OSError.
+        '''
+        self.file_path = file_path
+        self.fileh = open(file_path, "wb")
+        self.fileh.write(_HEADER_STRUCT.pack(INPUT_RECORDING_MAGIC, INPUT_RECORDING_VERSION, *window_size))
+        self.frame_count = 0
+    def record_frame(self, delta_seconds: float, mouse_position: tuple[int, int], events: list[pygame.event.Event]) -> None:
+        '''
+        Events of types not replayed (such as window exposed, or quit) are left out.
+        '''
+        packed_events = [_pack_event(event) for event in events if is_recorded_event(event)]
+        self.fileh.write(_FRAME_STRUCT.pack(min(int(delta_seconds*1e6), 0xFFFFFFFF), *mouse_position, len(packed_events)))
+        self.fileh.write(b"".join(packed_events))
+        self.frame_count += 1
+    def close(self) -> None:
+        if (self.fileh == None):
+            return
+        self.fileh.close()
+        self.fileh = None
+
+class RecordedFrame:
+    def __init__(self, delta_seconds: float, time_seconds: float, mouse_position: tuple[int, int], events: list[pygame.event.Event]):
+        self.delta_seconds = delta_seconds
+        self.time_seconds = time_seconds # since the recording started
+        self.mouse_position = mouse_position
+        self.events = events
+
+class InputPlayer:
+    def __init__(self, file_path: str):
+        '''
+        Reads a whole recording. Raises FileNotFoundError, OSError or InputRecordingFormatError.
+        '''
+        self.file_path = file_path
+        with open(file_path, "rb") as fileh:
+            recording_bytes = fileh.read()
+        if (len(recording_bytes) < _HEADER_STRUCT.size):
+            raise InputRecordingFormatError(f"'{file_path}' is too short to be an input recording")
+        magic, version, window_width, window_height = _HEADER_STRUCT.unpack_from(recording_bytes)
+        if (magic != INPUT_RECORDING_MAGIC):
+            raise InputRecordingFormatError(f"'{file_path}' is not an input recording")
+        if (version != INPUT_RECORDING_VERSION):
+            raise InputRecordingFormatError(f"'{file_path}' is input recording version {version}, only version {INPUT_RECORDING_VERSION} is supported")
+        self.window_size = (window_width, window_height)
+        self.frames: list[RecordedFrame] = []
+        try:
+            self.__read_frames(recording_bytes, _HEADER_STRUCT.size)
+        except (struct.error, KeyError, UnicodeDecodeError):
+            raise InputRecordingFormatError(f"'{file_path}' is cut short or corrupt after frame {len(self.frames)}")
+        self.next_frame_index = 0
+        self.frame_seconds: list[float] = [] # time the editor took for each replayed frame, see add_frame_seconds
+    def __read_frames(self, recording_bytes: bytes, offset: int) -> None:
+        time_seconds = 0
+        while (offset < len(recording_bytes)):
+            delta_microseconds, mouse_x, mouse_y, event_count = _FRAME_STRUCT.unpack_from(recording_bytes, offset)
+            offset += _FRAME_STRUCT.size
+            events = []
+            for _ in range(event_count):
+                event_code = _EVENT_CODE_STRUCT.unpack_from(recording_bytes, offset)[0]
+                offset += _EVENT_CODE_STRUCT.size
+                event_type, fields_struct, field_names = _EVENT_STRUCTS[event_code]
+                fields = fields_struct.unpack_from(recording_bytes, offset)
+                offset += fields_struct.size
+                if (event_type == pygame.MOUSEMOTION):
+                    event_attributes = {"pos": fields[0:2], "rel": fields[2:4], "buttons": tuple(bool(fields[4] & (1 << button_index)) for button_index in range(3))}
+                elif (event_type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)):
+                    event_attributes = {"button": fields[0], "pos": fields[1:3]}
+                else:
+                    event_attributes = dict(zip(field_names, fields))
+                if (event_type == pygame.KEYDOWN):
+                    unicode_length = _UNICODE_LENGTH_STRUCT.unpack_from(recording_bytes, offset)[0]
+                    offset += _UNICODE_LENGTH_STRUCT.size
+                    if (offset + unicode_length > len(recording_bytes)):
+                        raise struct.error("unicode past the end of the recording")
+                    event_attributes["unicode"] = recording_bytes[offset:offset+unicode_length].decode("utf-8")
+                    offset += unicode_length
+                elif (event_type == pygame.KEYUP):
+                    event_attributes["unicode"] = ""
+                events.append(pygame.event.Event(event_type, event_attributes))
+            time_seconds += delta_microseconds/1e6
+            self.frames.append(RecordedFrame(delta_microseconds/1e6, time_seconds, (mouse_x, mouse_y), events))
+    def next_frame(self) -> RecordedFrame or None:
+        '''
+        None once every frame was replayed.
+        '''
+        if (self.next_frame_index >= len(self.frames)):
+            return None
+        self.next_frame_index += 1
+        return self.frames[self.next_frame_index-1]
+    def add_frame_seconds(self, seconds: float) -> None:
+        self.frame_seconds.append(seconds)
+    def get_report_lines(self, wall_seconds: float) -> list[str]:
+        '''
+        The replay time, against the recorded time, and the percentiles of the time taken for each frame.
+        '''
+        recorded_seconds = self.frames[-1].time_seconds if len(self.frames) > 0 else 0
+        report_lines = [f"Replayed {self.next_frame_index}/{len(self.frames)} frames of '{self.file_path}' in {wall_seconds:.3f}s wall time, recorded over {recorded_seconds:.3f}s"]
+        if (len(self.frame_seconds) > 0):
+            sorted_seconds = sorted(self.frame_seconds)
+            report_lines.append(f"Frame ms: mean {sum(sorted_seconds)/len(sorted_seconds)*1000:.3f}"
+                f" p50 {frame_profiler.get_percentile(sorted_seconds, 50)*1000:.3f}"
+                f" p95 {frame_profiler.get_percentile(sorted_seconds, 95)*1000:.3f}"
+                f" p99 {frame_profiler.get_percentile(sorted_seconds, 99)*1000:.3f}"
+                f" max {sorted_seconds[-1]*1000:.3f}")
+        return report_lines
@@ -0,0 +1,145 @@
+import os
+import sys
+import zlib
+import tempfile
+import itertools
+import multiprocessing
+import concurrent.futures
+
+import pygame
+from pygame import (Surface, Rect)
+
+import compositor
+import history
+import layer_io
+import png_writer
+import raw_layer
+
+# Flattening layer files into one image, without opening them in the editor (the '--export' option).
+# The visible layers are blended from the first up, aligned at their top left corners, the same as
+# compositor.LayerCompositor draws them, one band of rows at a time:
+#  1. Every image file is decoded, one per worker, and written out to a raw layer file in a
+#     temporary directory next to the output, in the byte order it was decoded in. SDL rounds
+#     some blends differently between byte orders, this way the output is the same, pixel for
+#     pixel, as the editor composite. Raw layer files are used as they are.
+#  2. Each band of the output is blended by a worker from the memory mapped raw layers, so
+#     only the rows of the band are ever read, then deflated there for PNG output (see png_writer).
+# pygame holds the GIL while blending, so the workers are processes, and each one only holds
+# about one decoded layer, or a band, at a time. Other output formats are put together from
+# the bands and written whole, which holds one layer sized image.
+
+EXPORT_BAND_HEIGHT = png_writer.PNG_BAND_HEIGHT
+_SPILL_DIRECTORY_PREFIX = ".iedit-export-"
+
+def _get_executor(job_count: int) -> concurrent.futures.Executor:
+    # The editor runs at import, so workers are forked rather than started by importing it again.
+    # Without fork, decoding and deflating still run in parallel on threads.
+    if ("fork" in multiprocessing.get_all_start_methods()):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=job_count, mp_context=multiprocessing.get_context("fork"))
+    return concurrent.futures.ThreadPoolExecutor(max_workers=job_count)
+
+def _open_layer_file(file_path: str, spill_path: str or None) -> (tuple[str or None, tuple[int, int]] or None, str):
+    '''
+    Run on a worker. Returns ((path of the layer as a raw layer file, layer size), "") or (None, error string).
+    param: spill_path, where an image file is written as a raw layer file. None to only get the size of the layer.
+    '''
+    try:
+        if (raw_layer.is_raw_layer_path(file_path)):
+            with raw_layer.RawLayerFile(file_path, read_only=True) as raw_layer_file:
+                return (file_path, raw_layer_file.size), ""
+        layer_surface = pygame.image.load(file_path)
+        if (spill_path != None):
+            # In the byte order the editor holds the layer in, so the export matches the editor composite
+            raw_layer.write_raw_layer(layer_surface, spill_path, raw_layer.get_matching_pixel_format(layer_surface))
+        return (spill_path, layer_surface.get_size()), ""
+    except (OSError, pygame.error, raw_layer.RawLayerFormatError):
+        return None, f"Could not load '{file_path}', {sys.exc_info()[1]}"
+
+def flatten_band(raw_layers: list[tuple[str, str, int]], band_rect: Rect) -> Surface:
+    '''
+    Blend band_rect of each raw layer file (path, blend mode, opacity), from the first up, onto a transparent band.
+    '''
+    band_surface = Surface(band_rect.size, pygame.SRCALPHA, 32)
+    band_surface.fill((0, 0, 0, 0))
+    for raw_layer_path, blend_mode, opacity in raw_layers:
+        with raw_layer.RawLayerFile(raw_layer_path, read_only=True) as layer_file:
+            layer_rect = band_rect.clip(Rect((0, 0), layer_file.size))
+            if (layer_rect.width == 0 or layer_rect.height == 0):
+                continue
+            compositor.blend_pixels(band_surface, layer_file.surface.subsurface(layer_rect), (layer_rect.x-band_rect.x, layer_rect.y-band_rect.y), blend_mode, opacity)
+    return band_surface
+
+def _deflate_flattened_band(raw_layers: list[tuple[str, str, int]], band_rect: Rect, is_last_band: bool) -> tuple[bytes, int, int]:
+    '''
+    Run on a worker. Returns (deflated rows, adler32 of the rows, byte size of the rows) of the band, see png_writer.PngStreamWriter.
+    '''
+    band_rows = png_writer.get_filtered_rows(flatten_band(raw_layers, band_rect))
+    # The rows just above the band are blended again for the deflate dictionary, the file is then close to the size of a serial encode
+    previous_row_count = min(band_rect.y, -(-png_writer.DEFLATE_WINDOW_BYTES // (band_rect.width*4+1)))
+    previous_rows = b""
+    if (previous_row_count > 0):
+        previous_rows = png_writer.get_filtered_rows(flatten_band(raw_layers, Rect(0, band_rect.y-previous_row_count, band_rect.width, previous_row_count)))
+    return png_writer.deflate_band(band_rows, is_last_band, previous_rows), zlib.adler32(band_rows), len(band_rows)
+
+def _get_flattened_band_pixels(raw_layers: list[tuple[str, str, int]], band_rect: Rect) -> bytes:
+    '''
+    Run on a worker. RGBA bytes of the flattened band.
+    '''
+    return pygame.image.tobytes(flatten_band(raw_layers, band_rect), "RGBA")
+
+def export_layer_files(export_layers: list[tuple[str, bool, int, str]], output_path: str, job_count: int = None) -> (tuple[int, int] or None, str):
+    '''
+    Flatten the visible layers of export_layers, (file path, visible, opacity, blend mode) of each from the bottom up, into output_path.
+    The output is the size of the largest layer, hidden or not, as in the editor.
+    param: job_count, worker processes, defaults to the number of CPUs.
+    Returns ((width, height), "") or (None, error string).
+    '''
+    job_count = job_count if job_count != None else os.cpu_count()
+    if (len(export_layers) == 0):
+        return None, "No layers to export"
+    output_directory = os.path.dirname(os.path.abspath(output_path))
+    executor = _get_executor(job_count) if job_count > 1 else None
+    worker_map = executor.map if executor != None else map
+    try:
+        # Decoded layers go next to the output rather than the temporary directory, which can be in memory (tmpfs)
+        with tempfile.TemporaryDirectory(prefix=_SPILL_DIRECTORY_PREFIX, dir=output_directory) as spill_directory:
+            spill_paths = [os.path.join(spill_directory, f"{layer_index}{raw_layer.RAW_LAYER_EXTENSION}") if (visible and opacity > 0) else None
+                for layer_index, (_, visible, opacity, _) in enumerate(export_layers)]
+            raw_layers = []
+            export_size = (0, 0)
+            for (file_path, visible, opacity, blend_mode), (opened_layer, error_string) in zip(export_layers, worker_map(_open_layer_file, [export_layer[0] for export_layer in export_layers], spill_paths)):
+                if (opened_layer == None):
+                    return None, error_string
+                raw_layer_path, layer_size = opened_layer
+                export_size = (max(export_size[0], layer_size[0]), max(export_size[1], layer_size[1]))
+                if (visible and opacity > 0):
+                    raw_layers.append((raw_layer_path, blend_mode, opacity))
+            if (export_size[0] == 0 or export_size[1] == 0):
+                return None, f"Layers are {export_size[0]}x{export_size[1]}, there is nothing to export"
+            band_rects = png_writer.get_band_rects(export_size, EXPORT_BAND_HEIGHT)
+            if (output_path.lower().endswith(".png")):
+                file_base, file_extension = os.path.splitext(output_path)
+                temporary_file_path = file_base + ".tmp" + file_extension
+                try:
+                    with open(temporary_file_path, "wb") as fileh:
+                        png_stream = png_writer.PngStreamWriter(fileh, export_size)
+                        last_band_flags = [band_index == len(band_rects)-1 for band_index in range(len(band_rects))]
+                        for deflated_rows, rows_adler32, rows_byte_size in worker_map(_deflate_flattened_band, itertools.repeat(raw_layers), band_rects, last_band_flags):
+                            png_stream.write_band(deflated_rows, rows_adler32, rows_byte_size)
+                        png_stream.close()
+                    os.replace(temporary_file_path, output_path)
+                except BaseException:
+                    if (os.path.exists(temporary_file_path)):
+                        os.remove(temporary_file_path)
+                    raise
+            else:
+                flattened_surface = Surface(export_size, pygame.SRCALPHA, 32)
+                for band_rect, band_pixels in zip(band_rects, worker_map(_get_flattened_band_pixels, itertools.repeat(raw_layers), band_rects)):
+                    history.paste_pixels(flattened_surface, pygame.image.frombuffer(band_pixels, band_rect.size, "RGBA"), band_rect.topleft)
+                layer_io.write_layer_file(flattened_surface, output_path)
+    except (OSError, pygame.error):
+        return None, f"Could not write '{output_path}', {sys.exc_info()[1]}"
+    finally:
+        if (executor != None):
+            executor.shutdown(cancel_futures=True)
+    return export_size, ""
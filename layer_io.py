@@ -0,0 +1,78 @@
+import os
+import sys
+
+import pygame
+from pygame import Surface
+
+import indexed_layer
+import png_writer
+import raw_layer
+from tiled_canvas import TiledCanvas
+
+# Reading and writing whole layer files, shared by the editor and the batch mode.
+# Palette images are kept as indexed layers (see indexed_layer), PNG files are written back with
+# their palette rather than expanded to RGBA.
+
+class ImageLoadStates:
+    NO_ERROR = 0
+    NOT_FOUND = 1
+    PYGAME_ERROR = 2
+    FORMAT_ERROR = 3
+    LOADING = 4 # still being decoded in the background
+
+def load_image_file(path: str, tiled: bool = False) -> (Surface or TiledCanvas or None, int, str):
+    '''
+    Decode an image file, as a TiledCanvas when tiled is set, otherwise palette images as indexed layers. Safe to call from a worker thread.
+    Returns (surface, ImageLoadStates.NO_ERROR, "") or (None, error state, error string).
+    '''
+    try:
+        surface = pygame.image.load(path)
+    except FileNotFoundError:
+        return None, ImageLoadStates.NOT_FOUND, f"Could not load file '{path}'"
+    except pygame.error:
+        return None, ImageLoadStates.PYGAME_ERROR, f"Pygame could not load in the image file '{path}', {sys.exc_info()[1]}"
+    if (tiled):
+        surface = TiledCanvas.from_surface(surface)
+    elif (indexed_layer.is_indexed(surface)):
+        surface = indexed_layer.with_full_palette(surface)
+    return surface, ImageLoadStates.NO_ERROR, ""
+
+def read_layer_file(file_path: str) -> Surface:
+    '''
+    A plain surface with the pixels of an image file, or of a raw layer file (copied out of its mapping).
+    Raises FileNotFoundError, pygame.error or raw_layer.RawLayerFormatError.
+    '''
+    if (raw_layer.is_raw_layer_path(file_path)):
+        with raw_layer.RawLayerFile(file_path, read_only=True) as raw_layer_file:
+            return raw_layer_file.surface.copy()
+    surface = pygame.image.load(file_path)
+    if (indexed_layer.is_indexed(surface)):
+        surface = indexed_layer.with_full_palette(surface)
+    return surface
+
+def write_layer_file(layer_surface: Surface or TiledCanvas, layer_path: str) -> None:
+    '''
+    The file is written next to layer_path and then renamed over it,
+    so a crash part way through the write leaves the last saved file in place. Raises OSError or pygame.error.
+    Safe to call from a worker thread, with a snapshot of the layer.
+    Indexed layers are written as palette PNG files, other formats only keep the palette when it has no transparent entry.
+    '''
+    if (raw_layer.is_raw_layer_path(layer_path)):
+        raw_layer.write_raw_layer(layer_surface, layer_path)
+        return
+    file_base, file_extension = os.path.splitext(layer_path)
+    temporary_file_path = file_base + ".tmp" + file_extension # pygame picks the image format from the extension
+    try:
+        if (isinstance(layer_surface, TiledCanvas)):
+            layer_surface.save(temporary_file_path)
+        elif (indexed_layer.is_indexed(layer_surface) and file_extension.lower() == ".png"):
+            png_writer.write_png(layer_surface, temporary_file_path, palette=indexed_layer.get_file_palette(layer_surface))
+        elif (indexed_layer.is_indexed(layer_surface) and layer_surface.get_colorkey() != None):
+            pygame.image.save(indexed_layer.to_rgba(layer_surface), temporary_file_path)
+        else:
+            pygame.image.save(layer_surface, temporary_file_path)
+        os.replace(temporary_file_path, layer_path)
+    except BaseException:
+        if (os.path.exists(temporary_file_path)):
+            os.remove(temporary_file_path)
+        raise
@@ -0,0 +1,337 @@
+import typing
+
+import pygame
+from pygame import (Surface, Rect)
+
+import logger
+import paint_tools
+import render
+import image_stats
+import history
+import compositor
+import indexed_layer
+from history import (UndoObject, UndoPixelRegions, UndoTiles, UndoResize, UndoPalette, UndoCanvasTiles, UndoCanvasResize)
+from layer_io import ImageLoadStates
+from tiled_canvas import TiledCanvas
+
+# The layers being edited and the edits made to them, without any window or input handling,
+# so the editor core can be used (and benchmarked) on its own. Each layer is an index into
+# the parallel per layer lists.
+
+def get_mask_bounding_rect(mask: pygame.Mask) -> Rect or None:
+    bounding_rects = mask.get_bounding_rects()
+    if (len(bounding_rects) == 0):
+        return None
+    return bounding_rects[0].unionall(bounding_rects[1:])
+
+class LayerStack:
+    def __init__(self, log: logger.LOG, max_undo_bytes: int, max_undo_ram_bytes: int, max_surface_pixels: int):
+        '''
+        param: max_undo_bytes and max_undo_ram_bytes, per layer, see history.LayerHistory.
+        param: max_surface_pixels, resizing a plain layer past this is refused, tiled layers only hold the tiles drawn on.
+        '''
+        self.log = log
+        self.max_undo_bytes = max_undo_bytes
+        self.max_undo_ram_bytes = max_undo_ram_bytes
+        self.max_surface_pixels = max_surface_pixels
+        self.spill_store = history.SpillStore()
+        self.file_paths: list[str] = []
+        self.surfaces: list[Surface or TiledCanvas] = []
+        self.histories: list[history.LayerHistory] = []
+        self.revisions: list[int] = [] # increased every time a layers pixels change, used to invalidate cached renders
+        self.mipmaps: list[render.MipmapPyramid] = []
+        self.statistics: list[image_stats.ImageStatistics] = [] # built on first use
+        self.load_states: list[int] = [] # ImageLoadStates.LOADING while a layers image is decoded in the background, or the error it failed with
+        self.saved_revisions: list[int] = [] # revision of each layer when it was last saved or loaded
+        self.visibilities: list[bool] = [] # how each layer is drawn in the composite of the stack, see compositor.LayerCompositor
+        self.opacities: list[int] = [] # 0 to 255
+        self.blend_modes: list[str] = [] # one of compositor.BLEND_MODES
+        self.stroke_last_point: tuple[int, int] = None # last painted layer pixel of the current stroke, None when not in a stroke
+        self.stroke_undo_object: UndoPixelRegions = None # undo of the whole current stroke, grows each call of paint_stroke
+        self.modified_callback: typing.Callable = None # called with (layer index, modified rect or None) after every change to a layer
+    def __len__(self) -> int:
+        return len(self.surfaces)
+    def add_layer(self, path: str, surface: Surface or TiledCanvas, statistics: image_stats.ImageStatistics = None) -> int:
+        '''
+        Returns the index of the new layer.
+        '''
+        self.log.output_format(logger.LOG_level("INFO"), "Attempting to add new layer path:'{}' surface:{}", path, surface)
+        self.file_paths.append(path)
+        self.surfaces.append(surface)
+        self.histories.append(history.LayerHistory(self.max_undo_bytes, self.max_undo_ram_bytes, self.spill_store))
+        self.revisions.append(0)
+        self.mipmaps.append(render.MipmapPyramid(surface))
+        self.statistics.append(statistics if statistics != None else image_stats.ImageStatistics())
+        self.load_states.append(ImageLoadStates.NO_ERROR)
+        self.saved_revisions.append(0)
+        self.visibilities.append(True)
+        self.opacities.append(255)
+        self.blend_modes.append(compositor.BLEND_MODE_NORMAL)
+        self.log.output(logger.LOG_level("INFO"), f"Successfully added new layer")
+        return len(self.surfaces)-1
+    def mark_modified(self, layer_index: int, modified_rect: Rect = None) -> None:
+        '''
+        param: modified_rect is the area of the layer that changed, None when the whole layer (or the surface itself) changed.
+        '''
+        self.revisions[layer_index] += 1
+        layer_mipmap = self.mipmaps[layer_index]
+        layer_mipmap.set_surface(self.surfaces[layer_index])
+        layer_mipmap.mark_dirty(modified_rect)
+        if (self.modified_callback != None):
+            self.modified_callback(layer_index, modified_rect)
+    def get_statistics(self, layer_index: int) -> image_stats.ImageStatistics:
+        '''
+        Statistics are only built from the whole layer on first use, after that they are updated from each edit.
+        '''
+        layer_statistics = self.statistics[layer_index]
+        if not layer_statistics.is_built:
+            self.log.output(logger.LOG_level("INFO"), f"Building statistics for layer {layer_index}")
+            layer_statistics.rebuild(self.surfaces[layer_index])
+        return layer_statistics
+    def bucket_fill(self, layer_index: int, start_point: pygame.math.Vector2, color: pygame.Color, mask: pygame.Mask = None, connectivity: int = paint_tools.FILL_CONNECTIVITY_4, tolerance: int = 0, before_apply_callback: typing.Callable = None) -> pygame.Mask:
+        '''
+        param: before_apply_callback, called with the fill mask and its bounding rect just before the layer is written to.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        def before_apply(fill_mask: pygame.Mask) -> None:
+            fill_rect = get_mask_bounding_rect(fill_mask)
+            if (before_apply_callback != None):
+                before_apply_callback(fill_mask, fill_rect)
+            layer_statistics.remove_region(layer_surface, fill_rect, fill_mask)
+        fill_mask = paint_tools.paint_tool_bucket(layer_surface, start_point, color, mask, connectivity, tolerance, before_apply)
+        if (fill_mask != None):
+            fill_rect = get_mask_bounding_rect(fill_mask)
+            layer_statistics.add_region(layer_surface, fill_rect, fill_mask)
+            self.mark_modified(layer_index, fill_rect)
+        return fill_mask
+    def bucket_fill_canvas(self, layer_index: int, start_point: pygame.math.Vector2, color: pygame.Color, connectivity: int = paint_tools.FILL_CONNECTIVITY_4, tolerance: int = 0, before_apply_callback: typing.Callable = None) -> dict[tuple[int, int], pygame.Mask]:
+        '''
+        bucket_fill for tiled layers. The fill is worked out, and applied, one tile at a time.
+        param: before_apply_callback, called with {tile key: fill mask of the tile} just before the layer is written to.
+        Returns the fill masks of each tile filled, None when nothing was filled.
+        '''
+        layer_canvas = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        def before_apply(tile_masks: dict[tuple[int, int], pygame.Mask]) -> None:
+            if (before_apply_callback != None):
+                before_apply_callback(tile_masks)
+            layer_statistics.remove_colors(image_stats.count_canvas_colors(layer_canvas, tile_masks))
+        tile_masks = layer_canvas.flood_fill(start_point, color, connectivity, tolerance, before_apply)
+        if (tile_masks != None):
+            layer_statistics.add_colors(image_stats.count_canvas_colors(layer_canvas, tile_masks))
+            tile_rects = [layer_canvas.get_tile_rect(tile_key) for tile_key in tile_masks]
+            self.mark_modified(layer_index, tile_rects[0].unionall(tile_rects[1:]).clip(layer_canvas.get_rect()))
+        return tile_masks
+    def paint_line(self, layer_index: int, start_point: tuple[int, int], end_point: tuple[int, int], color: pygame.Color, brush: paint_tools.Brush = None) -> tuple[Rect, Surface]:
+        '''
+        param: brush, None for single pixel lines.
+        Returns (rect, copy of the pixels in rect from before the line), None when no pixels changed.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        # A tiled layer is painted through a copy of just the pixels under the line, written back after
+        paint_surface, paint_offset = layer_surface, (0, 0)
+        if (isinstance(layer_surface, TiledCanvas)):
+            paint_rect = paint_tools.get_line_rect(start_point, end_point, brush).clip(layer_surface.get_rect())
+            if (paint_rect.width == 0 or paint_rect.height == 0):
+                return None
+            paint_surface, paint_offset = layer_surface.subsurface(paint_rect), paint_rect.topleft
+        old_pixels = []
+        def before_apply(line_rect: Rect, line_pixels_mask: pygame.Mask) -> None:
+            old_pixels.append(paint_surface.subsurface(line_rect).copy())
+            layer_statistics.remove_region(paint_surface.subsurface(line_rect), mask=line_pixels_mask)
+        line = paint_tools.paint_tool_line(paint_surface, (start_point[0]-paint_offset[0], start_point[1]-paint_offset[1]), (end_point[0]-paint_offset[0], end_point[1]-paint_offset[1]), color, before_apply, brush)
+        if (line == None):
+            return None
+        line_rect, line_pixels_mask = line
+        layer_statistics.add_region(paint_surface.subsurface(line_rect), mask=line_pixels_mask)
+        if (paint_surface is not layer_surface):
+            layer_surface.write_region(paint_surface.subsurface(line_rect), (line_rect.x+paint_offset[0], line_rect.y+paint_offset[1]), line_pixels_mask)
+            line_rect = line_rect.move(paint_offset)
+        self.mark_modified(layer_index, line_rect)
+        return line_rect, old_pixels[0]
+    def paint_stroke(self, layer_index: int, points: list[tuple[int, int]], color: pygame.Color, brush: paint_tools.Brush = None) -> None:
+        '''
+        Continue the current stroke through every layer pixel in points, joining them with lines so the stroke has no gaps.
+        The whole stroke is one undo, until end_stroke.
+        '''
+        undo_regions = []
+        for point in points:
+            start_point = self.stroke_last_point if self.stroke_last_point != None else point
+            self.stroke_last_point = point
+            # Pieces of at least 64 pixels, or as long as the brush is wide, keep the total area copied for undo small without a layer write every few pixels
+            line_points = paint_tools.split_line(start_point, point, max(64, brush.size if brush != None else 1))
+            for line_start, line_end in zip(line_points, line_points[1:] or line_points):
+                undo_region = self.paint_line(layer_index, line_start, line_end, color, brush)
+                if (undo_region != None):
+                    undo_regions.append(undo_region)
+        if (len(undo_regions) > 0):
+            layer_history = self.histories[layer_index]
+            if (self.stroke_undo_object == None or layer_history.get_last() is not self.stroke_undo_object):
+                self.stroke_undo_object = UndoPixelRegions(undo_regions)
+                layer_history.add(self.stroke_undo_object)
+            else:
+                self.stroke_undo_object.extend(undo_regions)
+                layer_history.update_last()
+            self.log.output_format(logger.LOG_level("INFO"), "Painted {} line(s) of the stroke with {}, to {}", len(undo_regions), color, self.stroke_last_point)
+    def end_stroke(self, layer_index: int) -> None:
+        self.stroke_last_point = None
+        layer_history = self.histories[layer_index]
+        if (self.stroke_undo_object != None and layer_history.get_last() is self.stroke_undo_object):
+            stroke_undo_tiles = UndoTiles.from_regions(self.stroke_undo_object.regions, self.surfaces[layer_index])
+            layer_history.replace_last(stroke_undo_tiles)
+            self.log.output_format(logger.LOG_level("INFO"), "Ended stroke, {}", stroke_undo_tiles)
+        self.stroke_undo_object = None
+    def resize(self, layer_index: int, size: tuple[int, int]) -> str:
+        '''
+        Tiled layers are cropped or extended, scaling would give every tile pixels of its own. Plain layers are scaled.
+        Returns "", or an error string when the size is refused.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        if (isinstance(layer_surface, TiledCanvas)):
+            self.histories[layer_index].add(UndoCanvasResize.from_canvas_resize(layer_surface, size))
+            layer_surface.resize(size)
+            self.statistics[layer_index].invalidate()
+            self.mark_modified(layer_index)
+            return ""
+        if (size[0]*size[1] > self.max_surface_pixels):
+            return f"{size[0]}x{size[1]} is too large, use a tiled layer"
+        self.histories[layer_index].add(UndoResize.from_whole_surface(layer_surface))
+        self.replace_surface(layer_index, pygame.transform.scale(layer_surface, size))
+        return ""
+    def set_indexed(self, layer_index: int, indexed: bool) -> str:
+        '''
+        Change how a plain layer is stored, as palette indices (see indexed_layer) or as RGBA. Undone like a resize.
+        Returns "", or an error string when the layer can not be stored that way.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        if (isinstance(layer_surface, TiledCanvas)):
+            return "tiled layers are always RGBA"
+        if (indexed_layer.is_indexed(layer_surface) == indexed):
+            return ""
+        if (indexed):
+            if (layer_surface.get_width() == 0 or layer_surface.get_height() == 0):
+                return "the layer is empty"
+            layer_colors = [image_stats.unpack_color(packed_color) for packed_color, _ in self.get_statistics(layer_index).histogram.most_common()]
+            new_surface, error_string = indexed_layer.to_indexed(layer_surface, layer_colors)
+            if (new_surface == None):
+                return error_string
+        else:
+            new_surface = indexed_layer.to_rgba(layer_surface)
+        self.histories[layer_index].add(UndoResize.from_whole_surface(layer_surface))
+        self.replace_surface(layer_index, new_surface)
+        return ""
+    def set_palette_color(self, layer_index: int, palette_index: int, color: pygame.Color) -> str:
+        '''
+        Recolour every pixel of palette entry palette_index of an indexed layer, without changing any pixel.
+        Alpha 0 makes the entry the transparent one, there can only be one.
+        Returns "", or an error string when the colour can not be used.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        color = pygame.Color(color)
+        if not indexed_layer.is_indexed(layer_surface):
+            return "the layer is not indexed"
+        if not (0 <= palette_index < len(layer_surface.get_palette())):
+            return f"palette entries are 0 to {len(layer_surface.get_palette())-1}"
+        if (0 < color.a < 255):
+            return "palette colors are opaque, or alpha 0 for the transparent entry"
+        colorkey_index = indexed_layer.get_colorkey_index(layer_surface)
+        if (color.a == 0 and colorkey_index not in (None, palette_index)):
+            return f"entry {colorkey_index} is already the transparent entry"
+        undo_palette = UndoPalette.from_surface(layer_surface)
+        new_palette = [pygame.Color(palette_color) for palette_color in undo_palette.palette]
+        new_palette[palette_index] = color
+        self.histories[layer_index].add(undo_palette)
+        UndoPalette(new_palette).restore_palette(layer_surface)
+        self.statistics[layer_index].invalidate()
+        self.mark_modified(layer_index)
+        return ""
+    def undo(self, layer_index: int) -> bool:
+        '''
+        Returns False when there is nothing to undo.
+        '''
+        return self.histories[layer_index].undo(lambda undo_object: self.apply_undo_object(layer_index, undo_object))
+    def redo(self, layer_index: int) -> bool:
+        return self.histories[layer_index].redo(lambda undo_object: self.apply_undo_object(layer_index, undo_object))
+    def apply_undo_object(self, layer_index: int, undo_object: UndoObject) -> UndoObject:
+        '''
+        Revert the change undo_object recorded. Returns the undo object that reverses this, used for redo (and undo after a redo).
+        '''
+        layer_surface = self.surfaces[layer_index]
+        self.log.output_format(logger.LOG_level("INFO"), "Applying {}", undo_object)
+        if isinstance(undo_object, UndoPixelRegions):
+            reverse_undo_object = UndoPixelRegions([(rect, layer_surface.subsurface(rect).copy()) for rect, _ in undo_object.regions])
+            self.restore_regions(layer_index, undo_object.regions)
+            return reverse_undo_object
+        elif isinstance(undo_object, UndoCanvasResize):
+            reverse_undo_object = UndoCanvasResize.from_canvas_resize(layer_surface, undo_object.old_size)
+            self.restore_canvas_tiles(layer_index, undo_object)
+            return reverse_undo_object
+        elif isinstance(undo_object, UndoCanvasTiles):
+            reverse_undo_object = UndoCanvasTiles.from_canvas(layer_surface, undo_object.get_tile_keys(layer_surface.tile_size))
+            self.restore_canvas_tiles(layer_index, undo_object)
+            return reverse_undo_object
+        elif isinstance(undo_object, UndoResize):
+            reverse_undo_object = UndoResize.from_whole_surface(layer_surface)
+            self.replace_surface(layer_index, undo_object.rebuild_surface())
+            return reverse_undo_object
+        elif isinstance(undo_object, UndoPalette):
+            reverse_undo_object = UndoPalette.from_surface(layer_surface)
+            undo_object.restore_palette(layer_surface)
+            self.statistics[layer_index].invalidate()
+            self.mark_modified(layer_index)
+            return reverse_undo_object
+        elif isinstance(undo_object, UndoTiles):
+            reverse_undo_object = UndoTiles.from_surface(layer_surface, undo_object.tile_rects)
+            self.restore_tiles(layer_index, undo_object)
+            return reverse_undo_object
+        self.log.output(logger.LOG_level("WARNING"), f"undo object {undo_object} is not handled")
+        return None
+    def restore_regions(self, layer_index: int, regions: list[tuple[Rect, Surface]]) -> None:
+        '''
+        Put back pixels copied before a change, newest region first.
+        '''
+        layer_surface = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        for region_rect, old_pixels in reversed(regions):
+            layer_statistics.remove_region(layer_surface, region_rect)
+            self.paste_pixels(layer_index, old_pixels, region_rect.topleft)
+            layer_statistics.add_region(layer_surface, region_rect)
+            self.mark_modified(layer_index, region_rect)
+    def restore_tiles(self, layer_index: int, undo_tiles: UndoTiles) -> None:
+        layer_surface = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        for tile_rect, tile_pixels in undo_tiles.get_tiles():
+            layer_statistics.remove_region(layer_surface, tile_rect)
+            self.paste_pixels(layer_index, tile_pixels, tile_rect.topleft)
+            layer_statistics.add_region(layer_surface, tile_rect)
+        if (len(undo_tiles.tile_rects) > 0):
+            self.mark_modified(layer_index, undo_tiles.get_bounding_rect())
+    def restore_canvas_tiles(self, layer_index: int, undo_canvas_tiles: UndoCanvasTiles) -> None:
+        '''
+        Put back whole tiles of a tiled layer, including the size of the layer for UndoCanvasResize.
+        '''
+        layer_canvas = self.surfaces[layer_index]
+        layer_statistics = self.statistics[layer_index]
+        if isinstance(undo_canvas_tiles, UndoCanvasResize):
+            undo_canvas_tiles.restore_canvas(layer_canvas)
+            layer_statistics.invalidate()
+            self.mark_modified(layer_index)
+            return
+        tile_masks = {tile_key: pygame.Mask(layer_canvas.get_tile_rect(tile_key).clip(layer_canvas.get_rect()).size, fill=True) for tile_key in undo_canvas_tiles.get_tile_keys(layer_canvas.tile_size)}
+        layer_statistics.remove_colors(image_stats.count_canvas_colors(layer_canvas, tile_masks))
+        undo_canvas_tiles.restore_canvas(layer_canvas)
+        layer_statistics.add_colors(image_stats.count_canvas_colors(layer_canvas, tile_masks))
+        if (len(tile_masks) > 0):
+            self.mark_modified(layer_index, undo_canvas_tiles.get_bounding_rect().clip(layer_canvas.get_rect()))
+    def paste_pixels(self, layer_index: int, pixels: Surface, position: tuple[int, int]) -> None:
+        layer_surface = self.surfaces[layer_index]
+        if (isinstance(layer_surface, TiledCanvas)):
+            layer_surface.write_region(pixels, position)
+        else:
+            history.paste_pixels(layer_surface, pixels, position)
+    def replace_surface(self, layer_index: int, surface: Surface or TiledCanvas) -> None:
+        self.surfaces[layer_index] = surface
+        self.statistics[layer_index].invalidate()
+        self.mark_modified(layer_index)
@@ -1,16 +1,24 @@
 import sys, os
-import inspect
+import linecache
+import threading
+import queue
+import time
+import atexit
+import collections
+import traceback
 
 levels = ["ERROR", "WARNING", "INFO"] 
 
-def get_last_callback (relative_frame = 2):
-    total_stack = inspect.stack()
-    frameinfo = total_stack[relative_frame][0]
-    
+def get_last_callback (relative_frame = 2, include_code = True):
+    # Only the one frame is looked up, inspect.stack() would build every frame with its source context.
+    frameinfo = sys._getframe(relative_frame)
+
     file_path = frameinfo.f_code.co_filename
-    filename = os.path.basename(frameinfo.f_code.co_filename)
+    filename = os.path.basename(file_path)
     line_number = frameinfo.f_lineno
-    code = total_stack[relative_frame][4][0]
+    code = ""
+    if include_code:
+        code = linecache.getline(file_path, line_number)
     return (filename, file_path, line_number, code)
 
 def LOG_level ( name : str ):
@@ -39,13 +47,211 @@ def LOG_LEVEL_TO_STR( level : int ):
 
 
 def debug_info ( msg : str , relative_frame = 1):
-    total_stack = inspect.stack()
-    frameinfo = total_stack[relative_frame][0]
-    
+    frameinfo = sys._getframe(relative_frame)
+
     filename = os.path.basename(frameinfo.f_code.co_filename)
     line_number = frameinfo.f_lineno
     print(" [ DEBUG ] [ INFO ] ( FILE =", filename, ") ( LINE =", line_number, ") MSG =", msg)
 
+class StdoutSink (object):
+    def write_line ( self, line : str ):
+        print(line)
+    def flush ( self ):
+        sys.stdout.flush()
+    def close ( self ):
+        self.flush()
+
+class FileSink (object):
+    # Lines are queued and written by a background thread, so the caller never waits on disk I/O.
+    # When the queue is full, lines are dropped (and counted) rather than blocking the caller.
+    __sentinel = object()
+
+    def __init__ (self, file_path : str, max_bytes : int = 0, max_age_seconds : float = 0, backup_count : int = 3, queue_size : int = 8192, flush_interval : float = 0.5):
+        # max_bytes and max_age_seconds rotate the file when reached, 0 to never rotate on that condition.
+        # Rotated files are named file_path.1 (newest) up to file_path.<backup_count>.
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.dropped_line_count = 0
+        self.write_error = None
+        self.line_queue = queue.Queue(queue_size)
+        self.fileh = None
+        self.file_size = 0
+        self.file_opened_time = 0
+        self.is_closed = False
+        self.writer_thread = threading.Thread(target=self.__writer_loop, name=f"log-writer {file_path}", daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.close)
+
+    def write_line ( self, line : str ):
+        if self.is_closed:
+            return
+        try:
+            self.line_queue.put_nowait(line)
+        except queue.Full:
+            self.dropped_line_count += 1
+
+    def flush ( self ):
+        # Blocks until every line queued so far has been written
+        if self.is_closed:
+            return
+        flushed_event = threading.Event()
+        self.line_queue.put(flushed_event)
+        flushed_event.wait()
+
+    def close ( self ):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.line_queue.put(self.__sentinel)
+        self.writer_thread.join()
+        atexit.unregister(self.close)
+
+    def __open ( self ):
+        self.fileh = open(self.file_path, "a")
+        self.file_size = self.fileh.tell()
+        self.file_opened_time = time.time()
+
+    def __rotate ( self ):
+        self.fileh.close()
+        self.fileh = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.file_path}.{i}"):
+                    os.replace(f"{self.file_path}.{i}", f"{self.file_path}.{i + 1}")
+            os.replace(self.file_path, f"{self.file_path}.1")
+        else:
+            os.remove(self.file_path)
+        self.__open()
+
+    def __should_rotate ( self, pending_size : int, next_write_size : int ):
+        # pending_size has not been written yet, but will be before next_write_size
+        written_size = self.file_size + pending_size
+        if written_size == 0:
+            return False
+        if self.max_bytes > 0 and written_size + next_write_size > self.max_bytes:
+            return True
+        if self.max_age_seconds > 0 and time.time() - self.file_opened_time >= self.max_age_seconds:
+            return True
+        return False
+
+    def __write_chunk ( self, chunk : list, chunk_size : int ):
+        if chunk:
+            self.fileh.write("\n".join(chunk) + "\n")
+            self.file_size += chunk_size
+
+    def __write_batch ( self, lines : list ):
+        # Lines are joined into as few writes as possible, split only where the file has to rotate
+        try:
+            if self.fileh == None:
+                self.__open()
+            chunk = []
+            chunk_size = 0
+            for line in lines:
+                line_size = len(line) + 1
+                if self.__should_rotate(chunk_size, line_size):
+                    self.__write_chunk(chunk, chunk_size)
+                    chunk = []
+                    chunk_size = 0
+                    self.__rotate()
+                chunk.append(line)
+                chunk_size += line_size
+            self.__write_chunk(chunk, chunk_size)
+            self.fileh.flush()
+        except OSError as error:
+            # Reported through write_error, raising here would only kill the writer thread
+            self.write_error = error
+            self.dropped_line_count += len(lines)
+
+    def __writer_loop ( self ):
+        running = True
+        while running:
+            try:
+                items = [self.line_queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # Take everything else already queued, so it is written with one call
+            while True:
+                try:
+                    items.append(self.line_queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is self.__sentinel:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    self.__write_batch(lines)
+                    lines = []
+                    item.set()
+                else:
+                    lines.append(item)
+            self.__write_batch(lines)
+        if self.fileh != None:
+            self.fileh.close()
+            self.fileh = None
+
+class LogRingBuffer (object):
+    # Fixed number of recent log lines. A line repeated back to back is stored once with a repeat count,
+    # and line_counts keeps the total of every line currently held, so adding and counting are both O(1).
+    def __init__ (self, capacity : int = 8192):
+        self.capacity = capacity
+        self.entries = collections.deque() # [line, repeat_count], oldest first
+        self.line_counts = {}
+        self.evicted_count = 0
+
+    def add ( self, line : str ):
+        if self.entries and self.entries[-1][0] == line:
+            self.entries[-1][1] += 1
+        else:
+            if len(self.entries) >= self.capacity:
+                self.__evict_oldest()
+            self.entries.append([line, 1])
+        self.line_counts[line] = self.line_counts.get(line, 0) + 1
+
+    def __evict_oldest ( self ):
+        line, repeat_count = self.entries.popleft()
+        self.evicted_count += repeat_count
+        remaining_count = self.line_counts[line] - repeat_count
+        if remaining_count > 0:
+            self.line_counts[line] = remaining_count
+        else:
+            del self.line_counts[line]
+
+    def clear ( self ):
+        self.entries.clear()
+        self.line_counts.clear()
+        self.evicted_count = 0
+
+    def __len__ ( self ):
+        return len(self.entries)
+
+    def get_last_line ( self ):
+        if self.entries:
+            return self.entries[-1][0]
+        return None
+
+    def get_runs ( self ):
+        # [(line, repeat_count)] in the order they were added, back to back repeats collapsed
+        return [(line, repeat_count) for line, repeat_count in self.entries]
+
+    def get_line_counts ( self ):
+        # [(line, total_count)] of every distinct line held
+        return list(self.line_counts.items())
+
+    def dump ( self, file_path : str, reason : str = "" ):
+        with open(file_path, "a") as fileh:
+            fileh.write(f"==== log dump {time.strftime('%Y-%m-%d %H:%M:%S')} {reason} ====\n")
+            if self.evicted_count > 0:
+                fileh.write(f"( {self.evicted_count} older lines were dropped )\n")
+            for line, repeat_count in self.entries:
+                if repeat_count > 1:
+                    fileh.write(line + "  ( x" + str(repeat_count) + " ) \n")
+                else:
+                    fileh.write(line + "\n")
+
 class LOG (object):
     def __init__ (self, file = None):
         self.warnlevel = LOG_level("INFO")
@@ -53,9 +259,16 @@ class LOG (object):
         self.output_code = False
         self.ignored_files = []
         self.same_print_count = 1
-        self.print_buffer = []
-        self.stack_print_buffer = []
+        self.print_buffer = LogRingBuffer()
+        self.stack_print_buffer = LogRingBuffer()
+        self.recent_lines = LogRingBuffer() # every line output, even with no sinks, for dump_recent_lines
+        self.crash_dump_path = None
+        self.previous_excepthook = None
         self.stack_logs = False
+        self.stdout_sink = StdoutSink()
+        self.stdout_enabled = True
+        self.file_sink = None
+        self.file_sinks_by_path = {} # for the write_file_path argument of output
 
     def ignore_file ( self, filename ):
         if not os.path.exists(filename):
@@ -67,7 +280,50 @@ class LOG (object):
     def set_warnlevel( self, level : int ):
         self.warnlevel = level
 
+    def set_stdout_output( self, enabled : bool ):
+        self.stdout_enabled = enabled
+
+    def set_file_output( self, file_path : str, **file_sink_options ):
+        # Every log line is also written to file_path, None to stop. file_sink_options are passed to FileSink.
+        if self.file_sink != None:
+            self.file_sink.close()
+            self.file_sink = None
+        if file_path != None:
+            self.file_sink = FileSink(file_path, **file_sink_options)
+
+    def flush( self ):
+        self.stdout_sink.flush()
+        if self.file_sink != None:
+            self.file_sink.flush()
+        for file_sink in self.file_sinks_by_path.values():
+            file_sink.flush()
+
+    def close( self ):
+        if self.file_sink != None:
+            self.file_sink.close()
+        for file_sink in self.file_sinks_by_path.values():
+            file_sink.close()
+        self.file_sinks_by_path.clear()
+
+    def __emit_line( self, line : str, write_file_path = None ):
+        if self.stdout_enabled:
+            self.stdout_sink.write_line(line)
+        if self.file_sink != None:
+            self.file_sink.write_line(line)
+        if write_file_path != None:
+            file_sink = self.file_sinks_by_path.get(write_file_path)
+            if file_sink == None:
+                file_sink = FileSink(write_file_path)
+                self.file_sinks_by_path[write_file_path] = file_sink
+            file_sink.write_line(line)
+
+    def is_enabled_for( self, level : int ):
+        # Check before building an expensive message, when the level would be filtered out anyway.
+        return level <= self.warnlevel
+
     def stack( self, level : int, *data ):
+        if level > self.warnlevel:
+            return
         if len(data) == 1:
             data = data[0]
         elif len(data) > 1 :
@@ -78,104 +334,95 @@ class LOG (object):
                     tmp += " "
             data = tmp
 
-        if level <= self.warnlevel:
-            file_line = get_last_callback()
-            if self.output_code:
-                code_str = "  CODE = \"" + str(file_line[3][:-1]) + "\"" 
-            else:
-                code_str = ""
-            if not ( file_line[0] in self.ignored_files ):
-                out = "[ " + str(LOG_LEVEL_TO_STR( level ) + " ] FILE = " + str(file_line[0]) + "  LINE = " + str(file_line[2]) + str(code_str) + "  MSG = " + str(data))
-                self.stack_print_buffer.append(out)
+        file_line = get_last_callback(include_code = self.output_code)
+        if self.output_code:
+            code_str = "  CODE = \"" + str(file_line[3][:-1]) + "\"" 
+        else:
+            code_str = ""
+        if not ( file_line[0] in self.ignored_files ):
+            out = "[ " + str(LOG_LEVEL_TO_STR( level ) + " ] FILE = " + str(file_line[0]) + "  LINE = " + str(file_line[2]) + str(code_str) + "  MSG = " + str(data))
+            self.stack_print_buffer.add(out)
+            self.recent_lines.add(out)
 
-                if level <= self.stop_on_level:
-                    sys.exit()
+            if level <= self.stop_on_level:
+                sys.exit()
 
     def print_stack ( self ):
-        count = []
-        print_str = []
-        for prt in self.stack_print_buffer:
-            if not( prt in print_str ):
-                print_str.append(prt)
-                count.append (1)
-            elif prt in print_str:
-                count[print_str.index(prt)] += 1
+        for line, count in self.stack_print_buffer.get_line_counts():
+            self.__emit_line(line + "  ( x" + str(count) + " ) ")
         self.stack_print_buffer.clear()
 
-        for i, log in enumerate(print_str):
-            print(log, " ( x" + str(count[i]) + " ) ")
-
-    def clear_buffer (self):
-        if len(self.print_buffer) > 1:
-            count = [1]
-            print_str = [self.print_buffer[0]]
-            for i in range(1, len(self.print_buffer)):
-                if not(self.print_buffer[i] == print_str[-1]):
-                    print_str.append(self.print_buffer[i])
-                    count.append (1)
-                elif self.print_buffer[i] == print_str[-1]:
-                    count[-1] += 1
-                else:
-                    print(self.print_buffer[i])
+    def clear_buffer ( self, write_file_path = None ):
+        for line, count in self.print_buffer.get_runs():
+            self.__emit_line(line + "  ( x" + str(count) + " ) ", write_file_path)
+        self.print_buffer.clear()
 
-            for i in range(len(print_str)):
-                print(print_str[i], " ( x" + str(count[i]) + " ) ")
-        else:
-            print(self.print_buffer[0])
+    def dump_recent_lines ( self, file_path : str, reason : str = "" ):
+        self.recent_lines.dump(file_path, reason)
+
+    def enable_crash_dump ( self, file_path : str ):
+        # Dump the recent lines to file_path on an unhandled exception, or on exit unless mark_clean_exit was called first.
+        if self.crash_dump_path == None:
+            self.previous_excepthook = sys.excepthook
+            sys.excepthook = self.__crash_excepthook
+            atexit.register(self.__crash_dump_at_exit)
+        self.crash_dump_path = file_path
+
+    def mark_clean_exit ( self ):
+        if self.crash_dump_path != None:
+            atexit.unregister(self.__crash_dump_at_exit)
+            sys.excepthook = self.previous_excepthook
+            self.crash_dump_path = None
+
+    def __crash_excepthook ( self, exception_type, exception, exception_traceback ):
+        self.previous_excepthook(exception_type, exception, exception_traceback)
+        self.recent_lines.add("".join(traceback.format_exception(exception_type, exception, exception_traceback)).rstrip("\n"))
+        self.__crash_dump_at_exit("unhandled exception")
+
+    def __crash_dump_at_exit ( self, reason : str = "exit" ):
+        if self.crash_dump_path == None:
+            return
+        crash_dump_path = self.crash_dump_path
+        self.mark_clean_exit() # only dump once
+        try:
+            self.dump_recent_lines(crash_dump_path, reason)
+            print(" [ logger ] recent log lines written to", crash_dump_path, file=sys.stderr)
+        except OSError as error:
+            print(" [ logger ] [ ERROR ] could not write log dump to", crash_dump_path, error, file=sys.stderr)
 
-        self.print_buffer.clear()
-    
     def output ( self,  level : int, *data, write_file_path = None ):
+        if level > self.warnlevel:
+            return
         tmp = ""
         for string in data:
             tmp += str(string)
-        data = tmp
-            
-        if level <= self.warnlevel:
-            file_line = get_last_callback()
-            if self.output_code:
-                code_str = "  CODE = \"" + str(file_line[3][:-1]) + "\"" 
+        self.__write_output(level, tmp, write_file_path)
+
+    def output_format ( self, level : int, message_format : str, *args, write_file_path = None ):
+        # Same as output, but message_format.format(*args) is only built when the level is not filtered out.
+        if level > self.warnlevel:
+            return
+        self.__write_output(level, message_format.format(*args), write_file_path)
+
+    def __write_output ( self, level : int, data : str, write_file_path ):
+        # 0 = get_last_callback, 1 = __write_output, 2 = output or output_format, 3 = the caller
+        file_line = get_last_callback(3, self.output_code)
+        if self.output_code:
+            code_str = "  CODE = \"" + str(file_line[3][:-1]) + "\"" 
+        else:
+            code_str = ""
+        if not( file_line[0] in self.ignored_files ):
+            out = "[ " + str(LOG_LEVEL_TO_STR( level ) + " ] FILE = " + str(file_line[0]) + "  LINE = " + str(file_line[2]) + str(code_str) + "  MSG = " + str(data))
+            self.recent_lines.add(out)
+            if self.stack_logs:
+                # Back to back repeats are held until a different line comes in, then output once with their count
+                if self.print_buffer.get_last_line() not in (None, out):
+                    self.clear_buffer(write_file_path)
+                self.print_buffer.add(out)
             else:
-                code_str = ""
-            if not( file_line[0] in self.ignored_files ):
-                out = "[ " + str(LOG_LEVEL_TO_STR( level ) + " ] FILE = " + str(file_line[0]) + "  LINE = " + str(file_line[2]) + str(code_str) + "  MSG = " + str(data))
-                self.print_buffer.append(out)
-                if self.stack_logs:
-
-                    if len(self.print_buffer) > 1:
-                        count = 1
-                        if self.print_buffer[-1] != self.print_buffer[-2]:
-                            for i in range(1, len(self.print_buffer)):
-                                if self.print_buffer[i-1] == self.print_buffer[i]:
-                                    count += 1
-                                else:
-                                    break
-                            print(self.print_buffer[0], " ( x" + str(count) + " ) ")
-                            if (write_file_path != None):
-                                fileh = open(write_file_path, "a")
-                                fileh.write(str(self.print_buffer[0]), "(", "x"+str(count), ")")
-                                fileh.write("\n")
-                                fileh.close()
-                            if not(self.print_buffer[-1] in self.print_buffer[len(self.print_buffer)-1:]):
-                                print(self.print_buffer[-1])
-                                if (write_file_path != None):
-                                    fileh = open(write_file_path, "a")
-                                    fileh.write(str(self.print_buffer[-1]))
-                                    fileh.write("\n")
-                                    fileh.close()
-                            self.print_buffer.clear()
-                        
-                else:
-                    print(out)
-                    self.print_buffer.pop()
-                    if (write_file_path != None):
-                        file_mode = "a"
-                        fileh = open(write_file_path, file_mode)
-                        fileh.write(out)
-                        fileh.write("\n")
-                        fileh.close()
-                if level <= self.stop_on_level:
-                    sys.exit()
+                self.__emit_line(out, write_file_path)
+            if level <= self.stop_on_level:
+                sys.exit()
     
 log = LOG()
 
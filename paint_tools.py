@@ -0,0 +1,311 @@
+import typing
+
+import pygame
+from pygame import Surface
+
+import indexed_layer
+
+# Tools work on whole spans of pixels at a time, rather than one pixel at a time.
+# Colour matching is done by pygame in C (mask.from_threshold), and the fill walk
+# runs over a flat byte buffer of candidate pixels with bytes.find/rfind, so each
+# scanline span only costs a handful of C calls. On indexed layers colours are matched on an
+# RGBA copy, and painted colours are first moved to the nearest palette entry.
+
+FILL_CONNECTIVITY_4 = 4
+FILL_CONNECTIVITY_8 = 8
+
+_CANDIDATE_BYTE = b'\xff'
+_BLOCKED_BYTE = b'\x00'
+
+def color_match_mask(surface: Surface, color: pygame.Color, tolerance: int = 0) -> pygame.Mask:
+    '''
+    Get a mask of every pixel where each RGBA channel is within tolerance of color.
+    '''
+    if (indexed_layer.is_indexed(surface)):
+        surface = indexed_layer.to_rgba(surface)
+    color = pygame.Color(color)
+    tolerance = max(0, int(tolerance))
+    if (tolerance >= 255):
+        return pygame.Mask(surface.get_size(), fill=True)
+    # from_threshold only matches a difference strictly less than the threshold, and ignores alpha.
+    threshold = tolerance+1
+    match_mask = pygame.mask.from_threshold(surface, color, (threshold, threshold, threshold, 255))
+    if (surface.get_flags() & pygame.SRCALPHA):
+        lowest_alpha = color.a - tolerance
+        highest_alpha = color.a + tolerance
+        if (lowest_alpha > 0):
+            too_transparent_mask = pygame.mask.from_surface(surface, lowest_alpha-1)
+            too_transparent_mask.invert()
+            match_mask.erase(too_transparent_mask, (0, 0))
+        if (highest_alpha < 255):
+            match_mask.erase(pygame.mask.from_surface(surface, highest_alpha), (0, 0))
+    return match_mask
+
+def mask_to_bytes(mask: pygame.Mask) -> bytearray:
+    '''
+    One byte per pixel, row major. 0xff for set bits, 0x00 for unset bits.
+    '''
+    mask_surface = Surface(mask.get_size(), 0, 8)
+    mask_surface.set_palette([(0, 0, 0)]*255 + [(255, 255, 255)])
+    mask.to_surface(surface=mask_surface, setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 255))
+    return bytearray(pygame.image.tobytes(mask_surface, "P"))
+
+def bytes_to_mask(buffer: bytearray, size: tuple[int, int]) -> pygame.Mask:
+    '''
+    Inverse of mask_to_bytes, any non zero byte is a set bit.
+    '''
+    buffer_surface = pygame.image.frombuffer(buffer, size, "P")
+    buffer_surface.set_colorkey(0)
+    return pygame.mask.from_surface(buffer_surface)
+
+def _scanline_fill(candidate_mask: pygame.Mask, start_x: int, start_y: int, connectivity: int) -> pygame.Mask:
+    width, height = candidate_mask.get_size()
+    # 8-connected spans also touch the diagonal pixel past each end of the span
+    diagonal_reach = 1 if connectivity == FILL_CONNECTIVITY_8 else 0
+    buffer = mask_to_bytes(candidate_mask)
+    span_stack = [(start_x, start_y)]
+    while span_stack:
+        x, y = span_stack.pop()
+        row_start = y*width
+        if (buffer[row_start+x] == 0):
+            continue # Already filled by an earlier span
+        span_left = buffer.rfind(_BLOCKED_BYTE, row_start, row_start+x) + 1
+        if (span_left == 0):
+            span_left = row_start
+        span_right = buffer.find(_BLOCKED_BYTE, row_start+x, row_start+width)
+        if (span_right == -1):
+            span_right = row_start+width
+        buffer[span_left:span_right] = bytes(span_right-span_left)
+        for next_y in (y-1, y+1):
+            if (next_y < 0 or next_y >= height):
+                continue
+            row_offset = (next_y-y)*width
+            next_row_start = next_y*width
+            search_start = max(span_left+row_offset-diagonal_reach, next_row_start)
+            search_end = min(span_right+row_offset+diagonal_reach, next_row_start+width)
+            run_start = buffer.find(_CANDIDATE_BYTE, search_start, search_end)
+            while run_start != -1:
+                span_stack.append((run_start-next_row_start, next_y))
+                run_end = buffer.find(_BLOCKED_BYTE, run_start, search_end)
+                if (run_end == -1):
+                    break
+                run_start = buffer.find(_CANDIDATE_BYTE, run_end, search_end)
+    # Whatever candidates were cleared during the walk is the filled region.
+    fill_mask = candidate_mask.copy()
+    fill_mask.erase(bytes_to_mask(buffer, (width, height)), (0, 0))
+    return fill_mask
+
+def fill_candidates(candidate_mask: pygame.Mask, start_point: tuple[int, int], connectivity: int = FILL_CONNECTIVITY_4) -> pygame.Mask:
+    '''
+    Get the pixels of candidate_mask connected to start_point, for fills that work out their own candidates.
+    Returns an empty mask when start_point is not a candidate.
+    '''
+    start_x, start_y = int(start_point[0]), int(start_point[1])
+    if not (0 <= start_x < candidate_mask.get_size()[0] and 0 <= start_y < candidate_mask.get_size()[1]) or not candidate_mask.get_at((start_x, start_y)):
+        return pygame.Mask(candidate_mask.get_size())
+    return _scanline_fill(candidate_mask, start_x, start_y, connectivity)
+
+def flood_fill_mask(surface: Surface, start_point: pygame.math.Vector2, connectivity: int = FILL_CONNECTIVITY_4, tolerance: int = 0, mask: pygame.Mask = None) -> pygame.Mask:
+    '''
+    Get the region a fill started at start_point would cover, without modifying the surface.
+    param: mask, when given only pixels set in the mask can be filled.
+    Returns None when start_point is outside of the surface or not inside mask.
+    '''
+    if (connectivity not in (FILL_CONNECTIVITY_4, FILL_CONNECTIVITY_8)):
+        raise ValueError(f"Unsupported fill connectivity {connectivity}, expected {FILL_CONNECTIVITY_4} or {FILL_CONNECTIVITY_8}")
+    start_x, start_y = int(start_point[0]), int(start_point[1])
+    if not (0 <= start_x < surface.get_width() and 0 <= start_y < surface.get_height()):
+        return None
+    if (mask != None and not mask.get_at((start_x, start_y))):
+        return None
+    if (indexed_layer.is_indexed(surface)):
+        surface = indexed_layer.to_rgba(surface)
+    candidate_mask = color_match_mask(surface, surface.get_at((start_x, start_y)), tolerance)
+    if (mask != None):
+        candidate_mask = candidate_mask.overlap_mask(mask, (0, 0))
+    return _scanline_fill(candidate_mask, start_x, start_y, connectivity)
+
+def apply_mask_color(surface: Surface, fill_mask: pygame.Mask, new_color: pygame.Color) -> None:
+    '''
+    Set every pixel in fill_mask to new_color in one bulk write. Pixels are replaced, not blended.
+    '''
+    if (indexed_layer.is_indexed(surface)):
+        new_color = indexed_layer.get_color_index(surface, new_color)
+    fill_mask.to_surface(surface=surface, setcolor=new_color, unsetcolor=None)
+
+BRUSH_SHAPE_SQUARE = "square"
+BRUSH_SHAPE_CIRCLE = "circle"
+BRUSH_SHAPE_STAMP = "stamp"
+
+class Brush:
+    def __init__(self, stamp: pygame.Mask, shape: str = BRUSH_SHAPE_STAMP, description: str = ""):
+        '''
+        A stamp placed, centered, on every pixel of a stroke. Built once, then reused for every line of every stroke.
+        param: description, shown to the user, such as "circle 12".
+        '''
+        if (stamp.count() == 0):
+            raise ValueError("Brush stamp has no set pixels")
+        self.stamp: pygame.Mask = stamp
+        self.shape = shape
+        self.description = description
+        self.center = (stamp.get_size()[0]//2, stamp.get_size()[1]//2)
+        self.size = max(stamp.get_size())
+    def __str__(self):
+        return self.description
+
+def make_square_brush(size: int) -> Brush:
+    if (size < 1):
+        raise ValueError(f"Brush size must be at least 1, given {size}")
+    return Brush(pygame.Mask((size, size), fill=True), BRUSH_SHAPE_SQUARE, f"{BRUSH_SHAPE_SQUARE} {size}")
+
+def make_circle_brush(size: int) -> Brush:
+    '''
+    param: size, diameter in pixels.
+    '''
+    if (size < 1):
+        raise ValueError(f"Brush size must be at least 1, given {size}")
+    stamp = pygame.Mask((size, size))
+    radius = size/2
+    for y in range(size):
+        # Each row of the circle is one span, set with a single draw of a row mask
+        distance_y = y+0.5-radius
+        half_span = (radius*radius - distance_y*distance_y)**0.5
+        span_start = max(0, round(radius-half_span))
+        span_end = min(size, round(radius+half_span))
+        if (span_end > span_start):
+            stamp.draw(pygame.Mask((span_end-span_start, 1), fill=True), (span_start, y))
+    return Brush(stamp, BRUSH_SHAPE_CIRCLE, f"{BRUSH_SHAPE_CIRCLE} {size}")
+
+def load_stamp_brush(path: str) -> Brush:
+    '''
+    Brush from an image file. Pixels that are not transparent are part of the stamp,
+    or for images without alpha, pixels darker than mid grey.
+    Raises FileNotFoundError or pygame.error when the image can not be loaded, ValueError when it has no stamp pixels.
+    '''
+    stamp_surface = pygame.image.load(path)
+    if (stamp_surface.get_flags() & pygame.SRCALPHA):
+        stamp = pygame.mask.from_surface(stamp_surface, 127)
+    else:
+        stamp = pygame.mask.from_threshold(stamp_surface.convert(32, 0), (0, 0, 0), (128, 128, 128, 255))
+    return Brush(stamp, BRUSH_SHAPE_STAMP, f"{BRUSH_SHAPE_STAMP} {path}")
+
+def bresenham_line(start_point: tuple[int, int], end_point: tuple[int, int]) -> list[tuple[int, int]]:
+    '''
+    Get every pixel of the 8-connected line from start_point to end_point, both included, in order.
+    '''
+    x, y = int(start_point[0]), int(start_point[1])
+    end_x, end_y = int(end_point[0]), int(end_point[1])
+    delta_x, delta_y = abs(end_x-x), -abs(end_y-y)
+    step_x = 1 if x < end_x else -1
+    step_y = 1 if y < end_y else -1
+    error = delta_x+delta_y
+    points = [(x, y)]
+    while x != end_x or y != end_y:
+        double_error = 2*error
+        if (double_error >= delta_y):
+            error += delta_y
+            x += step_x
+        if (double_error <= delta_x):
+            error += delta_x
+            y += step_y
+        points.append((x, y))
+    return points
+
+def get_line_rect(start_point: tuple[int, int], end_point: tuple[int, int], brush: "Brush" = None) -> pygame.Rect:
+    '''
+    Get the rect the line from start_point to end_point covers, brush included, not clipped to any surface.
+    '''
+    start_x, start_y = int(start_point[0]), int(start_point[1])
+    end_x, end_y = int(end_point[0]), int(end_point[1])
+    line_rect = pygame.Rect(min(start_x, end_x), min(start_y, end_y), abs(end_x-start_x)+1, abs(end_y-start_y)+1)
+    if (brush == None):
+        return line_rect
+    return pygame.Rect(line_rect.x-brush.center[0], line_rect.y-brush.center[1], line_rect.width+brush.stamp.get_size()[0]-1, line_rect.height+brush.stamp.get_size()[1]-1)
+
+def line_mask(surface_size: tuple[int, int], start_point: tuple[int, int], end_point: tuple[int, int], brush: "Brush" = None) -> tuple[pygame.Rect, pygame.Mask]:
+    '''
+    Get the pixels of the 8-connected line from start_point to end_point (both included), with brush stamped on every pixel of it.
+    Without a brush the line is drawn by pygame (Bresenham, in C) into a buffer just covering the line.
+    With a brush, the brush stamp mask is drawn into the buffer once per line pixel.
+    param: brush, None for a one pixel wide line.
+    Returns (rect, mask) where mask covers rect of the surface, or None when the line is fully outside of the surface.
+    '''
+    start_x, start_y = int(start_point[0]), int(start_point[1])
+    end_x, end_y = int(end_point[0]), int(end_point[1])
+    surface_rect = pygame.Rect((0, 0), surface_size)
+    if (brush != None):
+        stroke_rect = get_line_rect(start_point, end_point, brush).clip(surface_rect)
+        if (stroke_rect.width == 0 or stroke_rect.height == 0):
+            return None
+        stroke_pixels_mask = pygame.Mask(stroke_rect.size)
+        offset_x, offset_y = -brush.center[0]-stroke_rect.x, -brush.center[1]-stroke_rect.y
+        for x, y in bresenham_line((start_x, start_y), (end_x, end_y)):
+            stroke_pixels_mask.draw(brush.stamp, (x+offset_x, y+offset_y)) # clipped to the mask by pygame
+        return stroke_rect, stroke_pixels_mask
+    line_rect = get_line_rect(start_point, end_point).clip(surface_rect)
+    if (line_rect.width == 0 or line_rect.height == 0):
+        return None
+    line_surface = Surface(line_rect.size, 0, 8)
+    line_surface.set_palette([(0, 0, 0)]*255 + [(255, 255, 255)])
+    line_surface.set_colorkey((0, 0, 0))
+    pygame.draw.line(line_surface, (255, 255, 255), (start_x-line_rect.x, start_y-line_rect.y), (end_x-line_rect.x, end_y-line_rect.y))
+    return line_rect, pygame.mask.from_surface(line_surface)
+
+def split_line(start_point: tuple[int, int], end_point: tuple[int, int], max_segment_length: int = 64) -> list[tuple[int, int]]:
+    '''
+    Get points along the line, start_point and end_point included, no more than max_segment_length apart on either axis.
+    Used to keep the bounding rect of each drawn piece small, a long diagonal line would otherwise cover a huge rect.
+    '''
+    start_x, start_y = int(start_point[0]), int(start_point[1])
+    end_x, end_y = int(end_point[0]), int(end_point[1])
+    segment_count = max(1, -(-max(abs(end_x-start_x), abs(end_y-start_y)) // max_segment_length))
+    return [(start_x + round((end_x-start_x)*i/segment_count), start_y + round((end_y-start_y)*i/segment_count)) for i in range(segment_count+1)]
+
+def paint_tool_line(surface: Surface, start_point: tuple[int, int], end_point: tuple[int, int], new_color: pygame.Color, before_apply_callback: typing.Callable = None, brush: "Brush" = None) -> tuple[pygame.Rect, pygame.Mask]:
+    '''
+    Set the pixels of the line from start_point to end_point to new_color, in one bulk write.
+    param: before_apply_callback, called with (rect, mask) just before the surface is written to.
+    param: brush, stamped on every pixel of the line, None for a one pixel wide line.
+    Returns (rect, mask) of the pixels changed, mask covering rect of the surface. None when nothing would change.
+    '''
+    line = line_mask(surface.get_size(), start_point, end_point, brush)
+    if (line == None):
+        return None
+    if (indexed_layer.is_indexed(surface)):
+        new_color = indexed_layer.get_nearest_color(surface, new_color)
+    line_rect, line_pixels_mask = line
+    line_surface = surface.subsurface(line_rect)
+    # Pixels already new_color are left out, so they are not counted as changed
+    line_pixels_mask.erase(color_match_mask(line_surface, new_color), (0, 0))
+    if (line_pixels_mask.count() == 0):
+        return None
+    if (before_apply_callback != None):
+        before_apply_callback(line_rect, line_pixels_mask)
+    apply_mask_color(line_surface, line_pixels_mask, new_color)
+    return line_rect, line_pixels_mask
+
+def paint_tool_bucket(surface: Surface, start_point: pygame.math.Vector2, new_color: pygame.Color, mask: pygame.Mask = None, connectivity: int = FILL_CONNECTIVITY_4, tolerance: int = 0, before_apply_callback: typing.Callable = None) -> pygame.Mask:
+    '''
+    Fill the region connected to start_point with new_color.
+    param: before_apply_callback, called with the fill mask just before the surface is written to.
+    Returns the fill mask, or None when the position is invalid or nothing would change.
+    '''
+    if (mask != None and surface.get_size() != mask.get_size()):
+        raise ValueError(f"Fill mask size {mask.get_size()} does not match surface size {surface.get_size()}")
+    match_surface = surface
+    if (indexed_layer.is_indexed(surface)):
+        new_color = indexed_layer.get_nearest_color(surface, new_color)
+        match_surface = indexed_layer.to_rgba(surface)
+    try:
+        search_color = match_surface.get_at((int(start_point[0]), int(start_point[1])))
+    except IndexError:
+        return None
+    if (search_color == new_color and tolerance == 0):
+        return None
+    fill_mask = flood_fill_mask(match_surface, start_point, connectivity, tolerance, mask)
+    if (fill_mask == None):
+        return None
+    if (before_apply_callback != None):
+        before_apply_callback(fill_mask)
+    apply_mask_color(surface, fill_mask, new_color)
+    return fill_mask
@@ -0,0 +1,121 @@
+import os
+import struct
+import zlib
+import collections
+import concurrent.futures
+
+import pygame
+from pygame import (Surface, Rect)
+
+# Streaming PNG encoder, for images too large to encode in one piece.
+# The image is read a band of rows at a time and every band is deflated on its own, as a
+# run of deflate blocks ending on a byte boundary (a sync flush), so the bands can be
+# compressed on different threads, or processes, and written one after another into a
+# single zlib stream (the way pigz compresses in parallel). zlib releases the GIL while it
+# compresses, so a thread per CPU keeps every core busy. Each band starts from the last
+# 32KiB of the band before it as its dictionary, which keeps the file close to the size of
+# a serial encode. Rows are written with filter type 0 (none), as 8 bit RGBA, or as 8 bit
+# palette indices for indexed layers (see indexed_layer).
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION_LEVEL = 6
+PNG_BAND_HEIGHT = 256 # rows read and deflated at a time
+DEFLATE_WINDOW_BYTES = 32768 # how far back deflate looks, the dictionary a band is started with
+_ZLIB_HEADER = b"\x78\x9c" # deflate, 32KiB window, default compression
+_ADLER32_BASE = 65521
+
+def write_png_chunk(fileh, chunk_type: bytes, chunk_data: bytes) -> None:
+    fileh.write(struct.pack(">I", len(chunk_data)))
+    fileh.write(chunk_type)
+    fileh.write(chunk_data)
+    fileh.write(struct.pack(">I", zlib.crc32(chunk_data, zlib.crc32(chunk_type))))
+
+def get_filtered_rows(pixels: Surface, pixel_format: str = "RGBA") -> bytes:
+    '''
+    The pixels as PNG scanlines, each row of bytes after its filter type byte.
+    param: pixel_format, "RGBA", or "P" for the palette indices of an 8 bit surface.
+    '''
+    pixel_bytes = pygame.image.tobytes(pixels, pixel_format)
+    row_byte_size = pixels.get_width()*len(pixel_format)
+    return b"".join(b"\x00" + pixel_bytes[row_start:row_start+row_byte_size] for row_start in range(0, len(pixel_bytes), row_byte_size))
+
+def deflate_band(band_rows: bytes, is_last_band: bool, previous_rows: bytes = b"") -> bytes:
+    '''
+    Raw deflate blocks of band_rows, to follow the blocks of the band before it in the zlib stream.
+    param: previous_rows, the end of the band before, used as the dictionary. Empty for the first band.
+    '''
+    if (len(previous_rows) > 0):
+        compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=previous_rows[-DEFLATE_WINDOW_BYTES:])
+    else:
+        compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(band_rows) + compressor.flush(zlib.Z_FINISH if is_last_band else zlib.Z_SYNC_FLUSH)
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    '''
+    Adler-32 of two pieces of data one after another, from the checksum of each and the length of the second, as zlib adler32_combine.
+    '''
+    remainder = length2 % _ADLER32_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder*sum1) % _ADLER32_BASE
+    sum1 = (sum1 + (adler2 & 0xFFFF) + _ADLER32_BASE - 1) % _ADLER32_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + _ADLER32_BASE - remainder) % _ADLER32_BASE
+    return sum1 | (sum2 << 16)
+
+def get_band_rects(size: tuple[int, int], band_height: int = PNG_BAND_HEIGHT) -> list[Rect]:
+    width, height = size
+    return [Rect(0, band_top, width, min(band_height, height-band_top)) for band_top in range(0, height, band_height)]
+
+class PngStreamWriter:
+    def __init__(self, fileh, size: tuple[int, int], palette: list[pygame.Color] = None):
+        '''
+        Writes the header of an 8 bit RGBA image of size to the open binary file fileh.
+        Bands of deflated rows (see deflate_band) are then added from the top down with write_band, and close ends the file.
+        param: palette, up to 256 RGBA colours for an image of 8 bit palette indices instead.
+        '''
+        self.fileh = fileh
+        self.adler32 = 1 # of every row written so far, the zlib stream ends with it
+        self.fileh.write(PNG_SIGNATURE)
+        if (palette == None):
+            write_png_chunk(self.fileh, b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, 6, 0, 0, 0)) # 8 bit RGBA, no interlacing
+        else:
+            write_png_chunk(self.fileh, b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, 3, 0, 0, 0)) # 8 bit palette indices
+            write_png_chunk(self.fileh, b"PLTE", b"".join(bytes(palette_color[:3]) for palette_color in palette))
+            palette_alphas = bytes(palette_color[3] for palette_color in palette).rstrip(b"\xff") # entries past the alphas given are opaque
+            if (len(palette_alphas) > 0):
+                write_png_chunk(self.fileh, b"tRNS", palette_alphas)
+        write_png_chunk(self.fileh, b"IDAT", _ZLIB_HEADER)
+    def write_band(self, deflated_rows: bytes, rows_adler32: int, rows_byte_size: int) -> None:
+        write_png_chunk(self.fileh, b"IDAT", deflated_rows)
+        self.adler32 = adler32_combine(self.adler32, rows_adler32, rows_byte_size)
+    def close(self) -> None:
+        write_png_chunk(self.fileh, b"IDAT", struct.pack(">I", self.adler32))
+        write_png_chunk(self.fileh, b"IEND", b"")
+
+def write_png(image: Surface, file_path: str, job_count: int = None, palette: list[pygame.Color] = None) -> None:
+    '''
+    Write image as a PNG file, deflating a band of rows per task on job_count threads (defaults to the number of CPUs).
+    image can be anything with get_size and subsurface, such as a tiled_canvas.TiledCanvas, only a few bands are read at once.
+    param: palette, for an 8 bit image, written as its palette indices with palette (see indexed_layer.get_file_palette).
+    Raises OSError.
+    '''
+    job_count = job_count if job_count != None else os.cpu_count()
+    pixel_format = "RGBA" if palette == None else "P"
+    band_rects = get_band_rects(image.get_size())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=job_count) as executor, open(file_path, "wb") as fileh:
+        png_stream = PngStreamWriter(fileh, image.get_size(), palette)
+        band_futures = collections.deque() # (future of the deflated rows, adler32 of the rows, byte size of the rows), in band order
+        previous_rows = b""
+        for band_index, band_rect in enumerate(band_rects):
+            band_rows = get_filtered_rows(image.subsurface(band_rect), pixel_format)
+            band_futures.append((executor.submit(deflate_band, band_rows, band_index == len(band_rects)-1, previous_rows), zlib.adler32(band_rows), len(band_rows)))
+            previous_rows = band_rows
+            # Keeps the bands read ahead, and so the memory used, to a few per thread
+            while (len(band_futures) > job_count*2 or (len(band_futures) > 0 and band_futures[0][0].done())):
+                band_future, rows_adler32, rows_byte_size = band_futures.popleft()
+                png_stream.write_band(band_future.result(), rows_adler32, rows_byte_size)
+        while (len(band_futures) > 0):
+            band_future, rows_adler32, rows_byte_size = band_futures.popleft()
+            png_stream.write_band(band_future.result(), rows_adler32, rows_byte_size)
+        if (len(band_rects) == 0):
+            png_stream.write_band(deflate_band(b"", True), 1, 0)
+        png_stream.close()
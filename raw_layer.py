@@ -0,0 +1,131 @@
+import os
+import mmap
+import struct
+
+import pygame
+from pygame import (Surface, Rect)
+
+import indexed_layer
+
+# Uncompressed layer files, opened by mapping the file into memory and handing the
+# mapped pixels to pygame as the layer surface, so opening costs no decoding and no copy.
+# Edits write straight into the mapping, and saving only has to flush the pages that
+# were changed. PNG stays the format for exporting.
+#
+# File layout, little endian:
+#   8 bytes   magic, RAW_LAYER_MAGIC
+#   uint32    format version
+#   uint32    width
+#   uint32    height
+#   4 bytes   pixel byte order, "BGRA" (the order SDL keeps SRCALPHA surfaces in) or "RGBA"
+#   ...       zero padding up to RAW_LAYER_HEADER_SIZE
+#   width*height*4 bytes of pixels, row major, no row padding
+
+RAW_LAYER_EXTENSION = ".ielayer"
+RAW_LAYER_MAGIC = b"IEDITLYR"
+RAW_LAYER_VERSION = 1
+RAW_LAYER_HEADER_SIZE = 64
+_HEADER_STRUCT = struct.Struct("<8sIII4s")
+_WRITE_STRIP_HEIGHT = 256 # rows written at a time when saving a whole layer
+
+class RawLayerFormatError(Exception):
+    pass
+
+def is_raw_layer_path(file_path: str) -> bool:
+    return file_path.lower().endswith(RAW_LAYER_EXTENSION)
+
+def _get_pixel_format() -> str:
+    return "BGRA" if Surface((1, 1), pygame.SRCALPHA, 32).get_masks()[:3] == (0xFF0000, 0xFF00, 0xFF) else "RGBA"
+
+def get_matching_pixel_format(layer: Surface) -> str:
+    '''
+    The raw layer pixel byte order of layer, so it is blended the same once written, the SDL order for anything else.
+    SDL rounds some blends differently when the source is in another byte order than the destination.
+    '''
+    for pixel_format in ("BGRA", "RGBA"):
+        if (layer.get_masks() == pygame.image.frombuffer(bytes(4), (1, 1), pixel_format).get_masks()):
+            return pixel_format
+    return _get_pixel_format()
+
+class RawLayerFile:
+    def __init__(self, file_path: str, read_only: bool = False):
+        '''
+        An open, memory mapped, raw layer file. surface is the layer pixels, backed by the file itself.
+        param: read_only, map the file for reading only, such as to blend it into another image. Writing to surface then fails.
+        Raises FileNotFoundError, PermissionError (read only files, unless read_only) or RawLayerFormatError.
+        '''
+        self.file_path = file_path
+        self.fileh = open(file_path, "rb" if read_only else "r+b")
+        try:
+            header = self.fileh.read(RAW_LAYER_HEADER_SIZE)
+            if (len(header) < RAW_LAYER_HEADER_SIZE):
+                raise RawLayerFormatError(f"'{file_path}' is too short to be a raw layer file")
+            magic, version, width, height, pixel_format = _HEADER_STRUCT.unpack_from(header)
+            if (magic != RAW_LAYER_MAGIC):
+                raise RawLayerFormatError(f"'{file_path}' is not a raw layer file")
+            if (version != RAW_LAYER_VERSION):
+                raise RawLayerFormatError(f"'{file_path}' is raw layer version {version}, only version {RAW_LAYER_VERSION} is supported")
+            pixel_format = pixel_format.decode("ascii", "replace")
+            if (pixel_format not in ("BGRA", "RGBA")):
+                raise RawLayerFormatError(f"'{file_path}' has unsupported pixel format '{pixel_format}'")
+            pixel_byte_size = width*height*4
+            if (os.fstat(self.fileh.fileno()).st_size < RAW_LAYER_HEADER_SIZE + pixel_byte_size):
+                raise RawLayerFormatError(f"'{file_path}' is shorter than its {width}x{height} pixels")
+            self.size = (width, height)
+            self.mapping = mmap.mmap(self.fileh.fileno(), RAW_LAYER_HEADER_SIZE + pixel_byte_size, access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+        except Exception:
+            self.fileh.close()
+            raise
+        # A slice of a memoryview is not a copy, the surface pixels are the mapped file
+        self.pixels_view = memoryview(self.mapping)[RAW_LAYER_HEADER_SIZE:]
+        self.surface: Surface = pygame.image.frombuffer(self.pixels_view, self.size, pixel_format)
+    def close(self) -> None:
+        '''
+        Unmap and close the file. surface, and any subsurface of it, must not be used after, copy the pixels first to keep them.
+        '''
+        if (self.mapping.closed):
+            return
+        self.surface = None
+        self.pixels_view.release()
+        self.mapping.close()
+        self.fileh.close()
+    def __enter__(self) -> "RawLayerFile":
+        return self
+    def __exit__(self, *exception_info) -> None:
+        self.close()
+    def flush(self) -> None:
+        '''
+        Write the changed pages of the mapping back to the file.
+        '''
+        self.mapping.flush()
+    def __str__(self):
+        return f"RawLayerFile(path='{self.file_path}', size={self.size})"
+
+def write_raw_layer(layer: Surface, file_path: str, pixel_format: str = None) -> None:
+    '''
+    Write the whole of layer to a new raw layer file, a strip of rows at a time.
+    layer can be anything with get_size and subsurface, such as a tiled_canvas.TiledCanvas.
+    The file is written next to file_path then renamed over it, so a mapping of the old file stays valid.
+    Raw layer files are always RGBA, indexed layers are expanded.
+    param: pixel_format, "BGRA" or "RGBA" byte order, defaults to the order SDL keeps SRCALPHA surfaces in.
+    '''
+    width, height = layer.get_size()
+    pixel_format = pixel_format if pixel_format != None else _get_pixel_format()
+    temporary_file_path = file_path + ".tmp"
+    with open(temporary_file_path, "wb") as fileh:
+        fileh.write(_HEADER_STRUCT.pack(RAW_LAYER_MAGIC, RAW_LAYER_VERSION, width, height, pixel_format.encode("ascii")).ljust(RAW_LAYER_HEADER_SIZE, b"\x00"))
+        for strip_top in range(0, height, _WRITE_STRIP_HEIGHT):
+            strip_pixels = layer.subsurface(Rect(0, strip_top, width, min(_WRITE_STRIP_HEIGHT, height-strip_top)))
+            if (indexed_layer.is_indexed(strip_pixels)):
+                strip_pixels = indexed_layer.to_rgba(strip_pixels)
+            fileh.write(pygame.image.tobytes(strip_pixels, pixel_format))
+    os.replace(temporary_file_path, file_path)
+
+def create_raw_layer(file_path: str, size: tuple[int, int], color: pygame.Color) -> RawLayerFile:
+    '''
+    Make a new raw layer file filled with color, and open it.
+    '''
+    surface = Surface(size, pygame.SRCALPHA, 32)
+    surface.fill(color)
+    write_raw_layer(surface, file_path)
+    return RawLayerFile(file_path)
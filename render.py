@@ -0,0 +1,379 @@
+import math
+
+import pygame
+from pygame.math import Vector2 as Vec2
+from pygame import (Surface, Rect)
+
+from tiled_canvas import TiledCanvas
+
+def world_to_screen(vec2f_position, camera_position, screen_size) -> tuple[float, float]:
+    return (vec2f_position[0] - camera_position[0] + screen_size[0]/2, vec2f_position[1] - camera_position[1] + screen_size[1]/2)
+
+def screen_to_world(vec2f_position, camera_position, screen_size) -> tuple[float, float]:
+    return (vec2f_position[0] + camera_position[0] - screen_size[0]/2, vec2f_position[1] + camera_position[1] - screen_size[1]/2)
+
+def _smoothscale_compatible(surface: Surface) -> Surface:
+    '''
+    smoothscale only accepts 24 and 32 bit surfaces, palette surfaces get expanded.
+    '''
+    if (surface.get_bitsize() >= 24):
+        return surface
+    expanded_surface = Surface(surface.get_size(), pygame.SRCALPHA, 32)
+    expanded_surface.blit(surface, (0, 0))
+    return expanded_surface
+
+class MipmapPyramid:
+    def __init__(self, surface_ptr: Surface, tile_size: int = 256):
+        '''
+        Lazily built chain of downsampled copies of a surface (1/2, 1/4, ...), used when drawing zoomed out.
+        Edits are reported with mark_dirty, only the tiles touching the edit are rebuilt on the next get_level.
+        '''
+        self.surface_ptr = surface_ptr
+        self.tile_size = tile_size
+        self.levels: list[Surface] = [surface_ptr]
+        self.dirty_tiles: list[set[tuple[int, int]]] = [set()]
+    def set_surface(self, surface_ptr: Surface) -> None:
+        if (surface_ptr is self.surface_ptr):
+            return
+        self.surface_ptr = surface_ptr
+        self.levels = [surface_ptr]
+        self.dirty_tiles = [set()]
+    def get_max_level(self) -> int:
+        '''
+        Level where the surface is (about) 1 pixel in its largest dimension.
+        '''
+        return max(0, math.ceil(math.log2(max(self.surface_ptr.get_width(), self.surface_ptr.get_height(), 1))))
+    def get_level_size(self, level: int) -> tuple[int, int]:
+        divisor = 2**level
+        return (max(1, -(-self.surface_ptr.get_width()//divisor)), max(1, -(-self.surface_ptr.get_height()//divisor)))
+    def mark_dirty(self, source_rect: Rect = None) -> None:
+        '''
+        param: source_rect is in level 0 pixels, None marks the whole surface.
+        '''
+        if (source_rect == None):
+            # Cheaper to drop the built levels, they will be rebuilt lazily.
+            self.levels = [self.surface_ptr]
+            self.dirty_tiles = [set()]
+            return
+        source_rect = Rect(source_rect)
+        for level in range(1, len(self.levels)):
+            divisor = 2**level
+            left = source_rect.left//divisor
+            top = source_rect.top//divisor
+            right = -(-source_rect.right//divisor)
+            bottom = -(-source_rect.bottom//divisor)
+            for tile_y in range(top//self.tile_size, (bottom-1)//self.tile_size+1):
+                for tile_x in range(left//self.tile_size, (right-1)//self.tile_size+1):
+                    self.dirty_tiles[level].add((tile_x, tile_y))
+    def get_level(self, level: int) -> Surface:
+        level = max(0, min(level, self.get_max_level()))
+        while len(self.levels) <= level:
+            # New levels are built tile by tile as well, so a rebuilt tile always matches its neighbours exactly.
+            level_size = self.get_level_size(len(self.levels))
+            if (isinstance(self.surface_ptr, TiledCanvas)):
+                # Levels of a tiled canvas are sparse as well, a level tile only gets pixels of its own when its source has them.
+                self.levels.append(TiledCanvas(level_size, self.surface_ptr.default_color, self.tile_size))
+            else:
+                self.levels.append(Surface(level_size, pygame.SRCALPHA, 32))
+            self.dirty_tiles.append({(tile_x, tile_y) for tile_x in range(-(-level_size[0]//self.tile_size)) for tile_y in range(-(-level_size[1]//self.tile_size))})
+        for rebuild_level in range(1, level+1):
+            if (len(self.dirty_tiles[rebuild_level]) == 0):
+                continue
+            level_surface = self.levels[rebuild_level]
+            previous_level = self.levels[rebuild_level-1]
+            for tile_x, tile_y in self.dirty_tiles[rebuild_level]:
+                tile_rect = Rect(tile_x*self.tile_size, tile_y*self.tile_size, self.tile_size, self.tile_size).clip(level_surface.get_rect())
+                if (tile_rect.width == 0 or tile_rect.height == 0):
+                    continue
+                previous_rect = Rect(tile_rect.left*2, tile_rect.top*2, tile_rect.width*2, tile_rect.height*2).clip(previous_level.get_rect())
+                if (isinstance(level_surface, TiledCanvas) and previous_level.get_region_color(previous_rect) != None):
+                    level_surface.fill_region(tile_rect, previous_level.get_region_color(previous_rect))
+                    continue
+                downsampled_tile = pygame.transform.smoothscale(_smoothscale_compatible(previous_level.subsurface(previous_rect)), tile_rect.size)
+                if (isinstance(level_surface, TiledCanvas)):
+                    level_surface.write_region(downsampled_tile, tile_rect.topleft)
+                    continue
+                # Adding onto a cleared area copies the pixels exactly, a normal blit would alpha blend them.
+                level_surface.fill((0, 0, 0, 0), tile_rect)
+                level_surface.blit(downsampled_tile, tile_rect, special_flags=pygame.BLEND_RGBA_ADD)
+            self.dirty_tiles[rebuild_level].clear()
+        return self.levels[level]
+
+class RenderImage:
+    def __init__(self, surface_ptr: Surface, position: Vec2 = Vec2(0, 0), revision: int = 0):
+        '''
+        Viewport onto a surface, scaled and centered on position (in world space).
+        Only the source pixels under the screen are scaled, and the scaled result is
+        cached until the surface revision, scale or screen size changes.
+        param: revision should be increased by the owner each time the surface pixels are modified.
+        '''
+        self.surface_ptr = surface_ptr
+        self.position = Vec2(position)
+        self.revision = revision
+        self.scale_xy = (1.0, 1.0)
+        # Extra source pixels scaled around the visible area, so small camera moves reuse the cache.
+        self.cache_margin_fraction = 0.25
+        self.mipmap = None
+        self.cache_surface = None
+        self.cache_source_rect = None
+        self.cache_source_surface = None
+        self.cache_key = None
+    def set_surface(self, surface_ptr: Surface, revision: int) -> None:
+        self.surface_ptr = surface_ptr
+        self.revision = revision
+    def set_scale(self, scale_xy: tuple[float, float]) -> None:
+        self.scale_xy = (float(scale_xy[0]), float(scale_xy[1]))
+    def invalidate(self) -> None:
+        self.cache_surface = None
+        self.cache_source_rect = None
+        self.cache_source_surface = None
+        self.cache_key = None
+    def get_twidth(self) -> int:
+        '''
+        Get transformed surface pixel width
+        '''
+        return int(self.surface_ptr.get_width()*self.scale_xy[0])
+    def get_theight(self) -> int:
+        '''
+        Get transformed surface pixel height
+        '''
+        return int(self.surface_ptr.get_height()*self.scale_xy[1])
+    def get_tsize(self) -> Vec2:
+        '''
+        Get transformed surface pixel size
+        '''
+        return Vec2(self.get_twidth(), self.get_theight())
+    def get_owidth(self) -> int:
+        '''
+        Get original surface pixel width
+        '''
+        return self.surface_ptr.get_width()
+    def get_oheight(self) -> int:
+        '''
+        Get original surface pixel height
+        '''
+        return self.surface_ptr.get_height()
+    def get_osize(self) -> Vec2:
+        '''
+        Get original surface pixel size
+        '''
+        return Vec2(self.surface_ptr.get_size())
+    def get_cpos(self) -> Vec2:
+        '''
+        Get image center pixel position
+        '''
+        return Vec2(self.position)
+    def get_tpos(self) -> Vec2:
+        '''
+        Get transformed surface top left pixel position
+        '''
+        return Vec2(self.position.x - self.get_twidth()//2, self.position.y - self.get_theight()//2)
+    def set_mipmap(self, mipmap: MipmapPyramid) -> None:
+        '''
+        param: mipmap of surface_ptr, used when the scale is below 1. None to always draw from surface_ptr.
+        '''
+        self.mipmap = mipmap
+    def get_mipmap_level(self) -> int:
+        '''
+        Get the smallest mipmap level that still has at least one source pixel per screen pixel.
+        '''
+        if (self.mipmap == None):
+            return 0
+        smallest_scale = min(self.scale_xy)
+        if (smallest_scale >= 1.0):
+            return 0
+        return min(math.floor(math.log2(1.0/smallest_scale)), self.mipmap.get_max_level())
+    def get_source_scale(self, source_surface: Surface) -> tuple[float, float]:
+        '''
+        Scale from source_surface pixels (surface_ptr or one of its mipmap levels) to transformed pixels.
+        '''
+        if (source_surface is self.surface_ptr):
+            return self.scale_xy
+        return (self.get_twidth()/source_surface.get_width(), self.get_theight()/source_surface.get_height())
+    def get_visible_source_rect(self, camera_position, screen_size, source_surface: Surface = None) -> Rect:
+        '''
+        Get the rect of source pixels that are (at least partly) on the screen, clipped to the surface.
+        '''
+        if (source_surface == None):
+            source_surface = self.surface_ptr
+        source_scale = self.get_source_scale(source_surface)
+        top_left = self.get_tpos()
+        screen_world_left, screen_world_top = screen_to_world((0, 0), camera_position, screen_size)
+        screen_world_right, screen_world_bottom = screen_to_world(screen_size, camera_position, screen_size)
+        left = max(0, math.floor((screen_world_left - top_left.x)/source_scale[0]))
+        top = max(0, math.floor((screen_world_top - top_left.y)/source_scale[1]))
+        right = min(source_surface.get_width(), math.ceil((screen_world_right - top_left.x)/source_scale[0]))
+        bottom = min(source_surface.get_height(), math.ceil((screen_world_bottom - top_left.y)/source_scale[1]))
+        return Rect(left, top, max(0, right-left), max(0, bottom-top))
+    def source_to_transformed_rect(self, source_rect: Rect, source_surface: Surface = None) -> Rect:
+        '''
+        Get where source_rect is drawn, relative to the top left of the transformed surface.
+        Pixel edges are floored, so neighbouring rects never overlap or leave gaps.
+        '''
+        if (source_surface == None):
+            source_surface = self.surface_ptr
+        source_scale = self.get_source_scale(source_surface)
+        left = int(source_rect.left*source_scale[0])
+        top = int(source_rect.top*source_scale[1])
+        right = int(source_rect.right*source_scale[0])
+        bottom = int(source_rect.bottom*source_scale[1])
+        return Rect(left, top, right-left, bottom-top)
+    def calc_transform(self, source_rect: Rect, source_surface: Surface) -> None:
+        transformed_rect = self.source_to_transformed_rect(source_rect, source_surface)
+        self.cache_surface = pygame.transform.scale(source_surface.subsurface(source_rect), transformed_rect.size)
+        self.cache_source_rect = Rect(source_rect)
+        self.cache_source_surface = source_surface
+    def render(self, render_surface: Surface, camera_position, screen_size) -> Rect or None:
+        '''
+        Draw the visible part of the surface. Returns the screen rect drawn to, or None when nothing is visible.
+        '''
+        if (self.scale_xy[0] <= 0 or self.scale_xy[1] <= 0 or self.get_twidth() == 0 or self.get_theight() == 0):
+            return None
+        mipmap_level = self.get_mipmap_level()
+        source_surface = self.surface_ptr
+        if (mipmap_level > 0):
+            source_surface = self.mipmap.get_level(mipmap_level)
+        visible_source_rect = self.get_visible_source_rect(camera_position, screen_size, source_surface)
+        if (visible_source_rect.width == 0 or visible_source_rect.height == 0):
+            return None
+        cache_key = (self.surface_ptr, self.revision, self.scale_xy, tuple(screen_size), mipmap_level)
+        if (cache_key != self.cache_key or not self.cache_source_rect.contains(visible_source_rect)):
+            margin_x = int(visible_source_rect.width*self.cache_margin_fraction)+1
+            margin_y = int(visible_source_rect.height*self.cache_margin_fraction)+1
+            cache_source_rect = visible_source_rect.inflate(margin_x*2, margin_y*2).clip(source_surface.get_rect())
+            self.calc_transform(cache_source_rect, source_surface)
+            self.cache_key = cache_key
+        cache_offset = self.source_to_transformed_rect(self.cache_source_rect, self.cache_source_surface).topleft
+        top_left = self.get_tpos()
+        screen_position = world_to_screen((top_left.x + cache_offset[0], top_left.y + cache_offset[1]), camera_position, screen_size)
+        return render_surface.blit(self.cache_surface, screen_position)
+
+class DirtyRegionTracker:
+    def __init__(self, max_rects: int = 8):
+        '''
+        Tracks which parts of the screen need to be redrawn and presented.
+        Each drawn element is registered every frame with its screen rect and the state it was drawn from,
+        the old and new rects of an element are dirty whenever either of those change.
+        param: max_rects, past this many dirty rects they are merged into one, to bound the redraw passes.
+        '''
+        self.max_rects = max_rects
+        self.elements: dict[str, tuple[Rect, object]] = {}
+        self.dirty_rects: list[Rect] = []
+        self.all_dirty = True
+    def mark_all_dirty(self) -> None:
+        self.all_dirty = True
+    def add_dirty_rect(self, rect: Rect) -> None:
+        rect = Rect(rect)
+        if (rect.width > 0 and rect.height > 0):
+            self.dirty_rects.append(rect)
+    def update_element(self, name: str, screen_rect: Rect, state: object) -> None:
+        '''
+        param: state, anything comparable with == that changes when the element would be drawn differently.
+        '''
+        screen_rect = Rect(screen_rect)
+        previous_element = self.elements.get(name)
+        if (previous_element == None):
+            self.add_dirty_rect(screen_rect)
+        elif (previous_element[0] != screen_rect or previous_element[1] != state):
+            self.add_dirty_rect(previous_element[0])
+            self.add_dirty_rect(screen_rect)
+        self.elements[name] = (screen_rect, state)
+    def remove_element(self, name: str) -> None:
+        previous_element = self.elements.pop(name, None)
+        if (previous_element != None):
+            self.add_dirty_rect(previous_element[0])
+    def pop_dirty_rects(self, screen_rect: Rect) -> list[Rect]:
+        '''
+        Get the screen rects to redraw this frame, clipped to the screen, and reset for the next frame.
+        '''
+        if (self.all_dirty):
+            self.all_dirty = False
+            self.dirty_rects.clear()
+            return [Rect(screen_rect)]
+        merged_rects: list[Rect] = []
+        for rect in self.dirty_rects:
+            rect = rect.clip(screen_rect)
+            if (rect.width == 0 or rect.height == 0):
+                continue
+            # Merge with anything touching it, repeated as the merged rect grows.
+            overlap_index = rect.collidelist(merged_rects)
+            while overlap_index != -1:
+                rect.union_ip(merged_rects.pop(overlap_index))
+                overlap_index = rect.collidelist(merged_rects)
+            merged_rects.append(rect)
+        self.dirty_rects.clear()
+        if (len(merged_rects) > self.max_rects):
+            return [merged_rects[0].unionall(merged_rects[1:])]
+        return merged_rects
+
+class GridOverlay:
+    def __init__(self, min_cell_size_px: int = 4):
+        '''
+        Pixel grid lines over a RenderImage. Only the lines inside the visible area are drawn, into a cached
+        surface that is reused until the scale, screen size, colour or surface size changes, or the camera
+        moves past the cached area.
+        param: min_cell_size_px, when cells get smaller than this only every 2nd, 4th, ... line is drawn.
+        '''
+        self.min_cell_size_px = min_cell_size_px
+        self.cache_margin_fraction = 0.25
+        self.cache_surface = None
+        self.cache_world_rect = None
+        self.cache_key = None
+    def get_line_step(self, scale_xy: tuple[float, float]) -> int:
+        '''
+        Draw every Nth line (N is a power of 2), so drawn lines stay at least min_cell_size_px apart.
+        '''
+        smallest_scale = min(scale_xy)
+        if (smallest_scale <= 0):
+            return 0
+        line_step = 1
+        while line_step*smallest_scale < self.min_cell_size_px:
+            line_step *= 2
+        return line_step
+    def __get_line_indices(self, first_index: int, last_index: int, visible_start: float, visible_end: float, scale: float, line_step: int) -> list[int]:
+        '''
+        Line k is at k*scale in world space, from first_index to last_index. The outer lines are always kept.
+        '''
+        start_index = max(first_index, math.ceil(visible_start/scale))
+        end_index = min(last_index, math.floor(visible_end/scale))
+        line_indices = list(range(math.ceil(start_index/line_step)*line_step, end_index+1, line_step))
+        for border_index in (first_index, last_index):
+            if (start_index <= border_index <= end_index and border_index % line_step != 0):
+                line_indices.append(border_index)
+        return line_indices
+    def calc_lines(self, render_image: RenderImage, color: pygame.Color) -> None:
+        source_width, source_height = render_image.get_owidth(), render_image.get_oheight()
+        scale_xy = render_image.scale_xy
+        top_left = render_image.get_tpos()
+        bottom_right = render_image.get_tsize()//2
+        line_step = self.get_line_step(scale_xy)
+        world_rect = self.cache_world_rect
+        # Colour key instead of per pixel alpha, it is cheaper to blit.
+        key_color = (0, 0, 0) if tuple(color[:3]) != (0, 0, 0) else (255, 255, 255)
+        self.cache_surface = Surface(world_rect.size)
+        self.cache_surface.fill(key_color)
+        self.cache_surface.set_colorkey(key_color)
+        for x_index in self.__get_line_indices(-source_width//2, source_width//2, world_rect.left, world_rect.right-1, scale_xy[0], line_step):
+            line_x = x_index*scale_xy[0] - world_rect.left
+            pygame.draw.line(self.cache_surface, color, (line_x, top_left.y - world_rect.top), (line_x, bottom_right.y - world_rect.top))
+        for y_index in self.__get_line_indices(-source_height//2, source_height//2, world_rect.top, world_rect.bottom-1, scale_xy[1], line_step):
+            line_y = y_index*scale_xy[1] - world_rect.top
+            pygame.draw.line(self.cache_surface, color, (top_left.x - world_rect.left, line_y), (bottom_right.x - world_rect.left, line_y))
+    def render(self, render_surface: Surface, render_image: RenderImage, color: pygame.Color, camera_position, screen_size) -> Rect or None:
+        if (self.get_line_step(render_image.scale_xy) == 0):
+            return None
+        top_left = render_image.get_tpos()
+        bottom_right = render_image.get_tsize()//2
+        grid_world_rect = Rect(top_left.x, top_left.y, bottom_right.x - top_left.x + 1, bottom_right.y - top_left.y + 1)
+        screen_world_top_left = screen_to_world((0, 0), camera_position, screen_size)
+        visible_world_rect = Rect(screen_world_top_left, screen_size).inflate(2, 2).clip(grid_world_rect)
+        if (visible_world_rect.width == 0 or visible_world_rect.height == 0):
+            return None
+        cache_key = (render_image.scale_xy, tuple(screen_size), tuple(color), render_image.get_owidth(), render_image.get_oheight())
+        if (cache_key != self.cache_key or not self.cache_world_rect.contains(visible_world_rect)):
+            margin_x = int(visible_world_rect.width*self.cache_margin_fraction)+1
+            margin_y = int(visible_world_rect.height*self.cache_margin_fraction)+1
+            self.cache_world_rect = visible_world_rect.inflate(margin_x*2, margin_y*2).clip(grid_world_rect)
+            self.calc_lines(render_image, color)
+            self.cache_key = cache_key
+        return render_surface.blit(self.cache_surface, world_to_screen(self.cache_world_rect.topleft, camera_position, screen_size))
@@ -0,0 +1,47 @@
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import batch
+import indexed_layer
+import layer_io
+
+GREY_PALETTE = [pygame.Color(0, 0, 0), pygame.Color(85, 85, 85), pygame.Color(170, 170, 170), pygame.Color(255, 255, 255)]
+
+def write_grey_palette_png(file_path: str) -> None:
+    # A file with only these 4 palette entries, pygame.image.save would write all 256
+    surface = Surface((8, 8), pygame.SRCALPHA, 32)
+    surface.fill(GREY_PALETTE[1])
+    surface.fill(GREY_PALETTE[2], (4, 0, 4, 8))
+    indexed_surface, error_string = indexed_layer.to_indexed(surface, GREY_PALETTE)
+    assert error_string == ""
+    layer_io.write_layer_file(indexed_surface, file_path)
+    assert len(pygame.image.load(file_path).get_palette()) == len(GREY_PALETTE)
+
+def run_script(file_path: str, script: str) -> (str, list[str]):
+    operations, error_string = batch.parse_operation_script(script)
+    assert error_string == ""
+    return batch.process_file(file_path, operations)
+
+def test_fill_palette_image_with_color_outside_palette(tmp_path):
+    file_path = str(tmp_path / "grey.png")
+    write_grey_palette_png(file_path)
+    error_string, written_paths = run_script(file_path, "color 0 255 0\nfill 0 0\n")
+    assert error_string == "" and written_paths == [file_path]
+    surface = pygame.image.load(file_path)
+    assert surface.get_at((0, 0)) == pygame.Color(0, 255, 0, 255)
+    assert surface.get_at((3, 7)) == pygame.Color(0, 255, 0, 255)
+    assert surface.get_at((4, 0)) == pygame.Color(170, 170, 170, 255)
+
+def test_fill_palette_image_with_palette_color_stays_indexed(tmp_path):
+    file_path = str(tmp_path / "grey.png")
+    write_grey_palette_png(file_path)
+    error_string, written_paths = run_script(file_path, "color 255 255 255\nfill 0 0\n")
+    assert error_string == "" and written_paths == [file_path]
+    surface = pygame.image.load(file_path)
+    assert indexed_layer.is_indexed(surface)
+    assert surface.get_at((0, 0)) == pygame.Color(255, 255, 255, 255)
+    assert surface.get_at((4, 0)) == pygame.Color(170, 170, 170, 255)
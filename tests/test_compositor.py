@@ -0,0 +1,46 @@
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+import pytest
+
+import compositor
+
+def make_backdrop(color: tuple) -> Surface:
+    backdrop = Surface((4, 4), pygame.SRCALPHA, 32)
+    backdrop.fill(color)
+    return backdrop
+
+def make_source(bitsize: int, color: tuple) -> Surface:
+    # 24 bit, and 32 bit without an alpha mask, have no per pixel alpha
+    source = Surface((4, 4), 0, bitsize)
+    source.fill(color)
+    return source
+
+@pytest.mark.parametrize("bitsize", [24, 32])
+def test_normal_opacity_without_alpha_channel(bitsize: int):
+    backdrop = make_backdrop((0, 0, 0, 255))
+    compositor.blend_pixels(backdrop, make_source(bitsize, (200, 100, 0)), (0, 0), compositor.BLEND_MODE_NORMAL, 128)
+    color = backdrop.get_at((1, 1))
+    assert abs(color.r-100) <= 1 and abs(color.g-50) <= 1 and color.b == 0 and color.a == 255
+
+@pytest.mark.parametrize("bitsize", [24, 32])
+@pytest.mark.parametrize("blend_mode, expected_color", [
+    (compositor.BLEND_MODE_MULTIPLY, (50, 50, 0)),
+    (compositor.BLEND_MODE_ADD, (228, 228, 100)),
+    (compositor.BLEND_MODE_SCREEN, (178, 178, 100)),
+])
+def test_blend_modes_without_alpha_channel(bitsize: int, blend_mode: str, expected_color: tuple):
+    backdrop = make_backdrop((100, 100, 100, 255))
+    compositor.blend_pixels(backdrop, make_source(bitsize, (128, 128, 0)), (0, 0), blend_mode)
+    color = backdrop.get_at((2, 2))
+    for channel, expected in zip(color[:3], expected_color):
+        assert abs(channel-expected) <= 2
+    assert color.a == 255
+
+def test_source_is_not_changed():
+    source = make_source(24, (10, 20, 30))
+    compositor.blend_pixels(make_backdrop((0, 0, 0, 255)), source, (0, 0), compositor.BLEND_MODE_ADD, 64)
+    assert source.get_at((0, 0)) == pygame.Color(10, 20, 30, 255) and source.get_bitsize() == 24
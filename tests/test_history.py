@@ -0,0 +1,34 @@
+import sys, os, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import logger
+from layer_stack import LayerStack
+
+def make_layer_stack(surface: Surface, max_undo_bytes: int) -> LayerStack:
+    log = logger.LOG()
+    log.set_warnlevel(logger.LOG_level("WARNING"))
+    layers = LayerStack(log, max_undo_bytes, max_undo_bytes, 8192*8192)
+    layers.add_layer("test.png", surface)
+    return layers
+
+def test_redo_undo_over_max_bytes():
+    # Noise does not compress, redoing the resize needs the 1024x1024 layer, about 4MiB, over max_undo_bytes
+    surface = Surface((512, 512), pygame.SRCALPHA, 32)
+    surface.get_buffer().write(random.Random(1).randbytes(512*512*4))
+    layers = make_layer_stack(surface, 600*1024)
+    assert layers.resize(0, (1024, 1024)) == ""
+    assert layers.undo(0) and layers.surfaces[0].get_size() == (512, 512)
+    assert layers.histories[0].get_redo_count() == 1
+    assert layers.redo(0) and layers.surfaces[0].get_size() == (1024, 1024)
+    assert layers.undo(0) and layers.surfaces[0].get_size() == (512, 512)
+
+def test_redo_dropped_by_new_action():
+    layers = make_layer_stack(Surface((64, 64), pygame.SRCALPHA, 32), 1024*1024)
+    assert layers.resize(0, (32, 32)) == ""
+    assert layers.undo(0)
+    assert layers.resize(0, (16, 16)) == ""
+    assert layers.histories[0].get_redo_count() == 0 and not layers.redo(0)
@@ -0,0 +1,35 @@
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import logger
+import indexed_layer
+from layer_stack import LayerStack
+
+def make_layer_stack(surface: Surface) -> LayerStack:
+    log = logger.LOG()
+    log.set_warnlevel(logger.LOG_level("WARNING"))
+    layers = LayerStack(log, 64*1024*1024, 64*1024*1024, 8192*8192)
+    layers.add_layer("test.png", surface)
+    return layers
+
+def test_set_indexed_empty_layer():
+    layers = make_layer_stack(Surface((0, 0), pygame.SRCALPHA, 32))
+    assert layers.set_indexed(0, True) == "the layer is empty"
+    assert not indexed_layer.is_indexed(layers.surfaces[0])
+
+def test_set_indexed_round_trip():
+    surface = Surface((16, 8), pygame.SRCALPHA, 32)
+    surface.fill((0, 0, 0, 0))
+    surface.fill((255, 0, 0, 255), (0, 0, 8, 8))
+    layers = make_layer_stack(surface)
+    assert layers.set_indexed(0, True) == ""
+    assert indexed_layer.is_indexed(layers.surfaces[0])
+    assert indexed_layer.get_color_at(layers.surfaces[0], (1, 1)) == pygame.Color(255, 0, 0, 255)
+    assert indexed_layer.get_color_at(layers.surfaces[0], (12, 1)).a == 0
+    assert layers.set_indexed(0, False) == ""
+    assert layers.surfaces[0].get_at((1, 1)) == pygame.Color(255, 0, 0, 255) and layers.surfaces[0].get_at((12, 1)).a == 0
+    assert layers.undo(0) and indexed_layer.is_indexed(layers.surfaces[0])
@@ -0,0 +1,56 @@
+import sys, os, gc, random, warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import logger
+import compositor
+import layer_io
+import layer_export
+import raw_layer
+from layer_stack import LayerStack
+
+LAYER_SETTINGS = [(True, 255, compositor.BLEND_MODE_NORMAL), (True, 180, compositor.BLEND_MODE_MULTIPLY), (False, 255, compositor.BLEND_MODE_NORMAL), (True, 200, compositor.BLEND_MODE_SCREEN), (True, 90, compositor.BLEND_MODE_ADD)]
+
+def write_noise_png(file_path: str, size: tuple[int, int], has_alpha: bool, random_generator: random.Random) -> None:
+    surface = Surface(size, pygame.SRCALPHA if has_alpha else 0, 32 if has_alpha else 24)
+    surface.get_buffer().write(random_generator.randbytes(surface.get_pitch()*size[1]))
+    pygame.image.save(surface, file_path)
+
+def test_export_matches_editor_composite(tmp_path):
+    random_generator = random.Random(1)
+    layer_paths = []
+    for layer_index, size in enumerate([(300, 280), (280, 300), (64, 64), (300, 300), (200, 260)]):
+        layer_paths.append(str(tmp_path / f"layer{layer_index}.png"))
+        write_noise_png(layer_paths[-1], size, layer_index != 3, random_generator)
+    log = logger.LOG()
+    log.set_warnlevel(logger.LOG_level("WARNING"))
+    layers = LayerStack(log, 64*1024*1024, 64*1024*1024, 8192*8192)
+    for layer_path, (visible, opacity, blend_mode) in zip(layer_paths, LAYER_SETTINGS):
+        layer_surface, _, error_string = layer_io.load_image_file(layer_path)
+        assert error_string == ""
+        layer_index = layers.add_layer(layer_path, layer_surface)
+        layers.visibilities[layer_index] = visible
+        layers.opacities[layer_index] = opacity
+        layers.blend_modes[layer_index] = blend_mode
+    layer_compositor = compositor.LayerCompositor(layers)
+    layer_compositor.update()
+    export_path = str(tmp_path / "export.png")
+    export_size, error_string = layer_export.export_layer_files([(layer_path, *layer_settings) for layer_path, layer_settings in zip(layer_paths, LAYER_SETTINGS)], export_path, job_count=1)
+    assert error_string == "" and export_size == (300, 300)
+    exported_surface = pygame.image.load(export_path)
+    composite_surface = layer_compositor.canvas.subsurface(layer_compositor.canvas.get_rect())
+    assert pygame.image.tobytes(exported_surface, "RGBA") == pygame.image.tobytes(composite_surface, "RGBA")
+
+def test_export_closes_raw_layers(tmp_path):
+    layer_paths = [str(tmp_path / "layer0.png"), str(tmp_path / f"layer1{raw_layer.RAW_LAYER_EXTENSION}")]
+    write_noise_png(layer_paths[0], (40, 300), True, random.Random(2))
+    raw_layer.write_raw_layer(pygame.image.load(layer_paths[0]), layer_paths[1])
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always", ResourceWarning)
+        export_size, error_string = layer_export.export_layer_files([(layer_path, *LAYER_SETTINGS[0]) for layer_path in layer_paths], str(tmp_path / "export.png"), job_count=1)
+        gc.collect()
+    assert error_string == "" and export_size == (40, 300)
+    assert not any(issubclass(caught_warning.category, ResourceWarning) for caught_warning in caught_warnings)
@@ -0,0 +1,32 @@
+import sys, os, gc, warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from pygame import Surface
+
+import layer_io
+import raw_layer
+
+def write_test_layer(file_path: str) -> None:
+    surface = Surface((16, 8), pygame.SRCALPHA, 32)
+    surface.fill((10, 20, 30, 40))
+    raw_layer.write_raw_layer(surface, file_path)
+
+def test_read_layer_file_closes_raw_layer(tmp_path):
+    file_path = str(tmp_path / f"test{raw_layer.RAW_LAYER_EXTENSION}")
+    write_test_layer(file_path)
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always", ResourceWarning)
+        surface = layer_io.read_layer_file(file_path)
+        gc.collect()
+    assert not any(issubclass(caught_warning.category, ResourceWarning) for caught_warning in caught_warnings)
+    assert surface.get_size() == (16, 8) and surface.get_at((3, 3)) == pygame.Color(10, 20, 30, 40)
+
+def test_close(tmp_path):
+    file_path = str(tmp_path / f"test{raw_layer.RAW_LAYER_EXTENSION}")
+    write_test_layer(file_path)
+    with raw_layer.RawLayerFile(file_path, read_only=True) as raw_layer_file:
+        assert raw_layer_file.surface.get_at((0, 0)) == pygame.Color(10, 20, 30, 40)
+    assert raw_layer_file.fileh.closed and raw_layer_file.mapping.closed and raw_layer_file.surface == None
+    raw_layer_file.close()
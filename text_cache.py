@@ -0,0 +1,63 @@
+import collections
+
+import pygame
+from pygame import Surface
+
+class FontCache:
+    def __init__(self, font_path: str = None):
+        '''
+        One pygame.font.Font per size, so changing size (such as on a window resize) only loads a font once.
+        param: font_path, None for the pygame default font.
+        '''
+        self.font_path = font_path
+        self.fonts: dict[int, pygame.font.Font] = {}
+    def get_font(self, size: int) -> pygame.font.Font:
+        font = self.fonts.get(size)
+        if (font == None):
+            font = pygame.font.Font(self.font_path, size)
+            self.fonts[size] = font
+        return font
+
+class TextCache:
+    def __init__(self, font_cache: FontCache, max_entries: int = 256):
+        '''
+        Least recently used cache of rendered text, and of the plain background surfaces drawn behind text.
+        The returned surfaces are shared, they must not be drawn on.
+        '''
+        self.font_cache = font_cache
+        self.max_entries = max_entries
+        self.text_surfaces: collections.OrderedDict = collections.OrderedDict()
+        self.background_surfaces: collections.OrderedDict = collections.OrderedDict()
+        self.render_count = 0 # number of times text was actually rasterised, for checking the cache is being hit
+    def __get_cached(self, cache: collections.OrderedDict, key: tuple) -> Surface or None:
+        surface = cache.get(key)
+        if (surface != None):
+            cache.move_to_end(key)
+        return surface
+    def __add_cached(self, cache: collections.OrderedDict, key: tuple, surface: Surface) -> None:
+        cache[key] = surface
+        if (len(cache) > self.max_entries):
+            cache.popitem(last=False)
+    def render(self, text: str, size: int, color: tuple) -> Surface:
+        '''
+        Antialiased text, like pygame.font.Font.render.
+        '''
+        key = (text, size, tuple(color))
+        text_surface = self.__get_cached(self.text_surfaces, key)
+        if (text_surface == None):
+            text_surface = self.font_cache.get_font(size).render(text, True, color)
+            self.render_count += 1
+            self.__add_cached(self.text_surfaces, key, text_surface)
+        return text_surface
+    def get_background(self, size: tuple[int, int], color: tuple, alpha: int) -> Surface:
+        '''
+        Surface of size filled with color, drawn with a surface wide alpha.
+        '''
+        key = (int(size[0]), int(size[1]), tuple(color), alpha)
+        background_surface = self.__get_cached(self.background_surfaces, key)
+        if (background_surface == None):
+            background_surface = Surface(key[:2])
+            background_surface.fill(color)
+            background_surface.set_alpha(alpha)
+            self.__add_cached(self.background_surfaces, key, background_surface)
+        return background_surface
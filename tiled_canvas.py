@@ -0,0 +1,326 @@
+import typing
+
+import pygame
+from pygame import (Surface, Rect)
+
+import indexed_layer
+import paint_tools
+import png_writer
+
+# A layer made of fixed size tiles held in a dict, so a huge canvas only costs memory
+# for the parts that have been drawn on. Each tile is one of:
+#  - missing, every pixel is the canvas default colour
+#  - a colour tuple, every pixel is that colour (such as after a fill covering the tile)
+#  - a tile_size x tile_size Surface, allocated on the first write that needs one
+# Reads go through subsurface, which gives back a copy of the pixels rather than a view,
+# and writes through write_region, fill_region and set_tile.
+#
+# Pixels of edge tiles past the canvas size are never read. They are set back to the
+# default colour when a resize shows them again.
+
+CANVAS_TILE_SIZE = 256
+
+def _paste_pixels(destination: Surface, pixels: Surface, position: tuple[int, int]) -> None:
+    # Same as history.paste_pixels, copies exactly rather than alpha blending
+    destination.fill((0, 0, 0, 0), Rect(position, pixels.get_size()))
+    destination.blit(pixels, position, special_flags=pygame.BLEND_RGBA_ADD)
+
+class TiledCanvas:
+    def __init__(self, size: tuple[int, int], default_color: pygame.Color = (0, 0, 0, 0), tile_size: int = CANVAS_TILE_SIZE):
+        '''
+        Sparse layer pixels, only tiles that have been written to take memory.
+        Has the parts of the Surface interface the editor reads layers through (get_size, get_at, subsurface, copy, ...).
+        param: default_color, what every pixel is until it is written to.
+        '''
+        self.size = (int(size[0]), int(size[1]))
+        self.default_color = tuple(pygame.Color(default_color))
+        self.tile_size = tile_size
+        self.tiles: dict[tuple[int, int], Surface or tuple] = {}
+    @classmethod
+    def from_surface(cls, surface: Surface, default_color: pygame.Color = None, tile_size: int = CANVAS_TILE_SIZE) -> "TiledCanvas":
+        '''
+        Split surface into tiles. Tiles of one colour are kept as just that colour. Indexed layers are split as RGBA.
+        param: default_color, defaults to the colour of the top left pixel.
+        '''
+        if (indexed_layer.is_indexed(surface)):
+            surface = indexed_layer.to_rgba(surface)
+        if (default_color == None):
+            default_color = surface.get_at((0, 0)) if surface.get_width() > 0 and surface.get_height() > 0 else (0, 0, 0, 0)
+        canvas = cls(surface.get_size(), default_color, tile_size)
+        for tile_key in canvas.get_tile_keys(canvas.get_rect()):
+            tile_rect = canvas.get_tile_rect(tile_key).clip(canvas.get_rect())
+            tile_pixels = surface.subsurface(tile_rect)
+            tile_color = tile_pixels.get_at((0, 0))
+            if (paint_tools.color_match_mask(tile_pixels, tile_color).count() == tile_rect.width*tile_rect.height):
+                canvas.set_tile(tile_key, tile_color)
+            else:
+                canvas.write_region(tile_pixels, tile_rect.topleft)
+        return canvas
+    def get_size(self) -> tuple[int, int]:
+        return self.size
+    def get_width(self) -> int:
+        return self.size[0]
+    def get_height(self) -> int:
+        return self.size[1]
+    def get_rect(self) -> Rect:
+        return Rect((0, 0), self.size)
+    def get_bitsize(self) -> int:
+        return 32
+    def get_masks(self) -> tuple[int, int, int, int]:
+        '''
+        Masks of the tile surfaces, for code that picks a pixel byte order from the layer.
+        '''
+        return Surface((1, 1), pygame.SRCALPHA, 32).get_masks()
+    def get_tile_key(self, position: tuple[int, int]) -> tuple[int, int]:
+        return (int(position[0])//self.tile_size, int(position[1])//self.tile_size)
+    def get_tile_rect(self, tile_key: tuple[int, int]) -> Rect:
+        '''
+        Get the whole rect of the tile, which can reach past the canvas size at the right and bottom edges.
+        '''
+        return Rect(tile_key[0]*self.tile_size, tile_key[1]*self.tile_size, self.tile_size, self.tile_size)
+    def get_tile_keys(self, rect: Rect) -> list[tuple[int, int]]:
+        '''
+        Get the keys of every tile overlapping rect, inside the canvas, allocated or not.
+        '''
+        rect = Rect(rect).clip(self.get_rect())
+        if (rect.width == 0 or rect.height == 0):
+            return []
+        return [(tile_x, tile_y) for tile_y in range(rect.top//self.tile_size, (rect.bottom-1)//self.tile_size+1) for tile_x in range(rect.left//self.tile_size, (rect.right-1)//self.tile_size+1)]
+    def get_tile(self, tile_key: tuple[int, int]) -> Surface or tuple or None:
+        '''
+        Get what is held for the tile, None when it is the default colour. A returned surface is the tile itself, not a copy.
+        '''
+        return self.tiles.get(tile_key)
+    def set_tile(self, tile_key: tuple[int, int], tile: Surface or tuple or None) -> None:
+        '''
+        param: tile, a tile_size x tile_size surface (kept, not copied), a colour for the whole tile, or None for the default colour.
+        '''
+        if (tile == None or (not isinstance(tile, Surface) and tuple(pygame.Color(tile)) == self.default_color)):
+            self.tiles.pop(tile_key, None)
+        elif (isinstance(tile, Surface)):
+            self.tiles[tile_key] = tile
+        else:
+            self.tiles[tile_key] = tuple(pygame.Color(tile))
+    def get_tile_color(self, tile_key: tuple[int, int]) -> tuple or None:
+        '''
+        Get the colour of every pixel of the tile, None when the tile has its own pixels.
+        '''
+        tile = self.tiles.get(tile_key, self.default_color)
+        return None if isinstance(tile, Surface) else tile
+    def get_region_color(self, rect: Rect) -> tuple or None:
+        '''
+        Get the colour of every pixel in rect when the tiles overlapping it are all that one colour, otherwise None.
+        Only looks at which tiles are held, not at their pixels.
+        '''
+        region_color = None
+        for tile_key in self.get_tile_keys(rect):
+            tile_color = self.get_tile_color(tile_key)
+            if (tile_color == None or (region_color != None and tile_color != region_color)):
+                return None
+            region_color = tile_color
+        return region_color
+    def get_allocated_tile_count(self) -> int:
+        return sum(1 for tile in self.tiles.values() if isinstance(tile, Surface))
+    def get_byte_size(self) -> int:
+        '''
+        Memory taken by the allocated tile pixels.
+        '''
+        return self.get_allocated_tile_count()*self.tile_size*self.tile_size*4
+    def __get_tile_surface(self, tile_key: tuple[int, int]) -> Surface:
+        '''
+        Get the tile surface to write to, allocating it first when the tile is one colour.
+        '''
+        tile = self.tiles.get(tile_key, self.default_color)
+        if (isinstance(tile, Surface)):
+            return tile
+        tile_surface = Surface((self.tile_size, self.tile_size), pygame.SRCALPHA, 32)
+        tile_surface.fill(tile)
+        self.tiles[tile_key] = tile_surface
+        return tile_surface
+    def get_at(self, position: tuple[int, int]) -> pygame.Color:
+        x, y = int(position[0]), int(position[1])
+        if not (0 <= x < self.size[0] and 0 <= y < self.size[1]):
+            raise IndexError("pixel index out of range")
+        tile_key = self.get_tile_key((x, y))
+        tile = self.tiles.get(tile_key, self.default_color)
+        if (isinstance(tile, Surface)):
+            return tile.get_at((x-tile_key[0]*self.tile_size, y-tile_key[1]*self.tile_size))
+        return pygame.Color(tile)
+    def subsurface(self, rect: Rect) -> Surface:
+        '''
+        Get a copy of the pixels in rect. Unlike Surface.subsurface, changes to it are not seen by the canvas.
+        '''
+        rect = Rect(rect)
+        if not self.get_rect().contains(rect):
+            raise ValueError("subsurface rectangle outside surface area")
+        pixels = Surface(rect.size, pygame.SRCALPHA, 32)
+        pixels.fill(self.default_color)
+        for tile_key in self.get_tile_keys(rect):
+            tile = self.tiles.get(tile_key)
+            if (tile == None):
+                continue
+            tile_rect = self.get_tile_rect(tile_key)
+            overlap_rect = tile_rect.clip(rect)
+            if (isinstance(tile, Surface)):
+                _paste_pixels(pixels, tile.subsurface(overlap_rect.move(-tile_rect.x, -tile_rect.y)), (overlap_rect.x-rect.x, overlap_rect.y-rect.y))
+            else:
+                pixels.fill(tile, overlap_rect.move(-rect.x, -rect.y))
+        return pixels
+    def write_region(self, pixels: Surface, position: tuple[int, int], mask: pygame.Mask = None) -> None:
+        '''
+        Copy pixels onto the canvas exactly, alpha included, clipped to the canvas.
+        param: mask, same size as pixels, tiles where none of its pixels are set are left as they are.
+        '''
+        region_rect = Rect(position, pixels.get_size())
+        for tile_key in self.get_tile_keys(region_rect):
+            tile_rect = self.get_tile_rect(tile_key)
+            overlap_rect = tile_rect.clip(region_rect).clip(self.get_rect())
+            if (mask != None and mask.overlap(pygame.Mask(overlap_rect.size, fill=True), (overlap_rect.x-region_rect.x, overlap_rect.y-region_rect.y)) == None):
+                continue
+            _paste_pixels(self.__get_tile_surface(tile_key), pixels.subsurface(overlap_rect.move(-region_rect.x, -region_rect.y)), (overlap_rect.x-tile_rect.x, overlap_rect.y-tile_rect.y))
+    def fill_region(self, rect: Rect, color: pygame.Color) -> None:
+        '''
+        Set every pixel in rect to color. Tiles rect covers completely are kept as just that colour.
+        '''
+        color = tuple(pygame.Color(color))
+        rect = Rect(rect).clip(self.get_rect())
+        for tile_key in self.get_tile_keys(rect):
+            tile_rect = self.get_tile_rect(tile_key)
+            if (rect.contains(tile_rect.clip(self.get_rect()))):
+                self.set_tile(tile_key, color)
+            elif (self.get_tile_color(tile_key) != color):
+                self.__get_tile_surface(tile_key).fill(color, tile_rect.clip(rect).move(-tile_rect.x, -tile_rect.y))
+    def clear_region(self, rect: Rect) -> None:
+        self.fill_region(rect, self.default_color)
+    def resize(self, size: tuple[int, int]) -> None:
+        '''
+        Change the canvas size, keeping the pixels where they are. New area is the default colour.
+        Only tiles past the new size are touched, the rest of the canvas is not read or copied.
+        '''
+        old_size = self.size
+        self.size = (int(size[0]), int(size[1]))
+        canvas_rect = self.get_rect()
+        for tile_key in [tile_key for tile_key in self.tiles if not self.get_tile_rect(tile_key).colliderect(canvas_rect)]:
+            del self.tiles[tile_key]
+        if (self.size[0] > old_size[0]):
+            self.clear_region(Rect(old_size[0], 0, self.size[0]-old_size[0], self.size[1]))
+        if (self.size[1] > old_size[1]):
+            self.clear_region(Rect(0, old_size[1], self.size[0], self.size[1]-old_size[1]))
+    def copy(self) -> "TiledCanvas":
+        canvas_copy = TiledCanvas(self.size, self.default_color, self.tile_size)
+        canvas_copy.tiles = {tile_key: tile.copy() if isinstance(tile, Surface) else tile for tile_key, tile in self.tiles.items()}
+        return canvas_copy
+    def flood_fill(self, start_point: tuple[int, int], new_color: pygame.Color, connectivity: int = paint_tools.FILL_CONNECTIVITY_4, tolerance: int = 0, before_apply_callback: typing.Callable = None) -> dict[tuple[int, int], pygame.Mask] or None:
+        '''
+        Fill the region connected to start_point with new_color, one tile at a time, so only the tiles the fill reaches are read.
+        Tiles the fill covers completely are kept as just new_color, without allocating them.
+        param: before_apply_callback, called with the fill masks just before the canvas is written to.
+        Returns {tile key: fill mask of the tile, covering the tile rect clipped to the canvas}, or None when the position is invalid or nothing would change.
+        '''
+        if (connectivity not in (paint_tools.FILL_CONNECTIVITY_4, paint_tools.FILL_CONNECTIVITY_8)):
+            raise ValueError(f"Unsupported fill connectivity {connectivity}, expected {paint_tools.FILL_CONNECTIVITY_4} or {paint_tools.FILL_CONNECTIVITY_8}")
+        try:
+            search_color = self.get_at(start_point)
+        except IndexError:
+            return None
+        new_color = pygame.Color(new_color)
+        if (search_color == new_color and tolerance == 0):
+            return None
+        candidate_masks: dict[tuple[int, int], pygame.Mask] = {} # pixels that could still be filled, from the colours before the fill
+        full_candidate_keys: set[tuple[int, int]] = set() # tiles where every pixel is a candidate, and so all connected
+        fill_masks: dict[tuple[int, int], pygame.Mask] = {}
+        start_key = self.get_tile_key(start_point)
+        start_tile_rect = self.get_tile_rect(start_key)
+        seed_stack = [(start_key, pygame.Mask((1, 1), fill=True), (int(start_point[0])-start_tile_rect.x, int(start_point[1])-start_tile_rect.y))]
+        while seed_stack:
+            tile_key, seed_mask, seed_offset = seed_stack.pop()
+            if (tile_key not in candidate_masks):
+                candidate_masks[tile_key] = self.__get_candidate_mask(tile_key, search_color, tolerance)
+                fill_masks[tile_key] = pygame.Mask(candidate_masks[tile_key].get_size())
+                if (candidate_masks[tile_key].count() == candidate_masks[tile_key].get_size()[0]*candidate_masks[tile_key].get_size()[1]):
+                    full_candidate_keys.add(tile_key)
+            candidate_mask = candidate_masks[tile_key]
+            # Seeds are on one row or column of the tile, next to pixels filled in a neighbouring tile
+            seed_line = seed_mask.overlap_mask(candidate_mask, (-seed_offset[0], -seed_offset[1]))
+            if (seed_line.count() == 0):
+                continue
+            new_fill_mask = pygame.Mask(candidate_mask.get_size())
+            if (tile_key in full_candidate_keys):
+                new_fill_mask = candidate_mask.copy()
+                full_candidate_keys.discard(tile_key)
+            else:
+                seed_bytes = paint_tools.mask_to_bytes(seed_line)
+                is_row = seed_line.get_size()[0] > 1
+                seed_index = seed_bytes.find(b'\xff')
+                while seed_index != -1:
+                    seed_point = (seed_offset[0]+seed_index, seed_offset[1]) if is_row else (seed_offset[0], seed_offset[1]+seed_index)
+                    if (candidate_mask.get_at(seed_point)):
+                        new_fill_mask.draw(paint_tools.fill_candidates(candidate_mask, seed_point, connectivity), (0, 0))
+                        candidate_mask.erase(new_fill_mask, (0, 0))
+                    next_blocked_index = seed_bytes.find(b'\x00', seed_index)
+                    seed_index = -1 if next_blocked_index == -1 else seed_bytes.find(b'\xff', next_blocked_index)
+            candidate_mask.erase(new_fill_mask, (0, 0))
+            fill_masks[tile_key].draw(new_fill_mask, (0, 0))
+            self.__push_neighbour_seeds(seed_stack, tile_key, new_fill_mask, connectivity)
+        fill_masks = {tile_key: fill_mask for tile_key, fill_mask in fill_masks.items() if fill_mask.count() > 0}
+        if (len(fill_masks) == 0):
+            return None
+        if (before_apply_callback != None):
+            before_apply_callback(fill_masks)
+        for tile_key, fill_mask in fill_masks.items():
+            if (fill_mask.count() == fill_mask.get_size()[0]*fill_mask.get_size()[1]):
+                self.set_tile(tile_key, new_color)
+            else:
+                paint_tools.apply_mask_color(self.__get_tile_surface(tile_key), fill_mask, new_color)
+        return fill_masks
+    def __get_candidate_mask(self, tile_key: tuple[int, int], search_color: pygame.Color, tolerance: int) -> pygame.Mask:
+        tile_rect = self.get_tile_rect(tile_key).clip(self.get_rect())
+        tile_color = self.get_tile_color(tile_key)
+        if (tile_color == None):
+            return paint_tools.color_match_mask(self.tiles[tile_key].subsurface(Rect((0, 0), tile_rect.size)), search_color, tolerance)
+        # A tile of one colour is either all candidates or none, no need to look at its pixels
+        return pygame.Mask(tile_rect.size, fill=all(abs(channel-search_channel) <= tolerance for channel, search_channel in zip(tile_color, search_color)))
+    def __push_neighbour_seeds(self, seed_stack: list, tile_key: tuple[int, int], fill_mask: pygame.Mask, connectivity: int) -> None:
+        '''
+        For each edge of the tile the fill reached, seed the next tile with the pixels across that edge.
+        '''
+        width, height = fill_mask.get_size()
+        tile_x, tile_y = tile_key
+        diagonal_reach = 1 if connectivity == paint_tools.FILL_CONNECTIVITY_8 else 0
+        # (neighbour key, edge of this tile as (x, y) to draw from, seed line size, seed line offset in the neighbour)
+        neighbours = [
+            ((tile_x-1, tile_y), (0, 0), (1, height), (self.tile_size-1, 0)),
+            ((tile_x+1, tile_y), (width-1, 0), (1, height), (0, 0)),
+            ((tile_x, tile_y-1), (0, 0), (width, 1), (0, self.tile_size-1)),
+            ((tile_x, tile_y+1), (0, height-1), (width, 1), (0, 0)),
+        ]
+        for neighbour_key, edge_position, seed_size, seed_offset in neighbours:
+            if (neighbour_key[0] < 0 or neighbour_key[1] < 0 or not self.get_tile_rect(neighbour_key).colliderect(self.get_rect())):
+                continue
+            seed_mask = pygame.Mask(seed_size)
+            for reach in range(-diagonal_reach, diagonal_reach+1):
+                # Along the edge, a diagonal step reaches one pixel either side
+                reach_x, reach_y = (0, reach) if seed_size[0] == 1 else (reach, 0)
+                seed_mask.draw(fill_mask, (-edge_position[0]+reach_x, -edge_position[1]+reach_y))
+            if (seed_mask.count() > 0):
+                seed_stack.append((neighbour_key, seed_mask, seed_offset))
+        if (diagonal_reach == 0):
+            return
+        for corner_x, corner_y, step_x, step_y in ((0, 0, -1, -1), (width-1, 0, 1, -1), (0, height-1, -1, 1), (width-1, height-1, 1, 1)):
+            neighbour_key = (tile_x+step_x, tile_y+step_y)
+            if (neighbour_key[0] < 0 or neighbour_key[1] < 0 or not self.get_tile_rect(neighbour_key).colliderect(self.get_rect())):
+                continue
+            if (fill_mask.get_at((corner_x, corner_y))):
+                seed_stack.append((neighbour_key, pygame.Mask((1, 1), fill=True), (self.tile_size-1 if step_x < 0 else 0, self.tile_size-1 if step_y < 0 else 0)))
+    def save(self, file_path: str) -> None:
+        '''
+        PNG files are written a band of rows at a time, deflated in parallel, so the whole canvas is never held in memory at once.
+        Other formats are saved by pygame from a full copy of the canvas.
+        Raises OSError when the file can not be written.
+        '''
+        if (not file_path.lower().endswith(".png")):
+            pygame.image.save(self.subsurface(self.get_rect()), file_path)
+            return
+        png_writer.write_png(self, file_path)
+    def __str__(self):
+        return f"TiledCanvas(size={self.size}, tiles={len(self.tiles)}, allocated={self.get_allocated_tile_count()})"